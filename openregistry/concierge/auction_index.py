@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+import logging
+import time
+from datetime import datetime, timedelta
+from threading import RLock
+
+from couchdb.http import ResourceConflict
+from isodate import parse_datetime
+from pytz import utc
+
+logger = logging.getLogger(__name__)
+
+PENDING = 'pending'
+CREATED = 'created'
+DONE = 'done'
+
+
+class AuctionLookupIncomplete(Exception):
+    """Raised when auctions feed wasn't scanned back to the time of POST."""
+
+
+class AuctionIndex(object):
+    """
+    Durable index of auctions, created from auctions of lots, which is
+    consulted before every auction POST.
+
+    Index is stored in a single db document, where every auction of a lot
+    has an entry {'state': ..., 'auction_id': ..., 'started': ...}:
+    'pending' is saved before POST and means that auction could have been
+    created, 'created' - POST succeeded, 'done' - lot auction was patched
+    with the auction id. Done entries are removed after 'retention' seconds.
+
+    Unlike lots journal, every change is saved immediately: POST is made
+    only if 'pending' entry was saved.
+    """
+
+    def __init__(self, db, doc_id='auctions_index', retention=604800):
+        self.db = db
+        self.doc_id = doc_id
+        self.retention = retention
+        self._lock = RLock()
+        self._changed = set()
+        self._doc = db.get(doc_id) or {'_id': doc_id}
+
+    @staticmethod
+    def key(lot_id, lot_auction_id):
+        return '{}/{}'.format(lot_id, lot_auction_id)
+
+    def get(self, lot_id, lot_auction_id):
+        with self._lock:
+            entry = self._doc.get(self.key(lot_id, lot_auction_id))
+            return dict(entry) if entry else None
+
+    def _update(self, lot_id, lot_auction_id, **fields):
+        with self._lock:
+            key = self.key(lot_id, lot_auction_id)
+            previous = self._doc.get(key)
+            self._doc[key] = dict(previous or {}, updated=time.time(), **fields)
+            expired = [k for k, v in self._doc.items() if not k.startswith('_') and v.get('state') == DONE
+                       and v['updated'] < time.time() - self.retention]
+            for k in expired:
+                del self._doc[k]
+            self._changed.update([key] + expired)
+            try:
+                self._save()
+            except Exception as e:
+                # whatever storage backend failed, POST must not be made
+                logger.error('Failed to save auctions index: {!r}'.format(e))
+                if previous is None:
+                    del self._doc[key]
+                else:
+                    self._doc[key] = previous
+                self._changed.discard(key)
+                return False
+            return True
+
+    def _save(self):
+        try:
+            self.db.save(self._doc)
+        except ResourceConflict:
+            # document was saved by another instance, only entries changed by this one are written over it
+            stored = self.db.get(self.doc_id) or {'_id': self.doc_id}
+            for key in self._changed:
+                if key in self._doc:
+                    stored[key] = self._doc[key]
+                else:
+                    stored.pop(key, None)
+            self._doc = stored
+            self.db.save(self._doc)
+        self._changed.clear()
+
+    def pending(self, lot_id, lot_auction_id, tender_attempts):
+        """
+        Returns:
+            bool: True if entry was saved and auction could be POSTed.
+        """
+        # clock of API could be slightly behind
+        started = (datetime.now(utc) - timedelta(minutes=1)).isoformat()
+        return self._update(lot_id, lot_auction_id, state=PENDING, auction_id=None,
+                            tender_attempts=tender_attempts, started=started)
+
+    def created(self, lot_id, lot_auction_id, auction_id):
+        return self._update(lot_id, lot_auction_id, state=CREATED, auction_id=auction_id)
+
+    def done(self, lot_id, lot_auction_id):
+        return self._update(lot_id, lot_auction_id, state=DONE)
+
+
+def find_auction(client, lot_id, tender_attempts, since, page_size=100, max_pages=50):
+    """
+    Looks for auction created from the lot in the auctions feed, from
+    newest auctions to ones modified at 'since' (ISO date).
+
+    Returns:
+        dict: auction with 'id' or None if it wasn't created.
+
+    Raises:
+        AuctionLookupIncomplete: if 'max_pages' pages were read.
+    """
+    url = '{}?descending=1&limit={}&opt_fields=merchandisingObject%2CtenderAttempts'.format(
+        client.prefix_path, page_size)
+    for _ in range(max_pages):
+        page = client._get_resource_item(url)
+        for auction in page['data']:
+            if parse_datetime(auction['dateModified']) < parse_datetime(since):
+                return
+            if auction.get('merchandisingObject') == lot_id and auction.get('tenderAttempts') == tender_attempts:
+                return auction
+        if not page['data']:
+            return
+        url = page['next_page']['uri']
+    raise AuctionLookupIncomplete('Auction of lot {} not found in {} pages'.format(lot_id, max_pages))
+
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Memory benchmark of catching up a changes feed backlog.
+
+Runs 'continuous_changes_feed' over a generated backlog of lot changes
+and prints resident memory of the process while lots are consumed, e.g.:
+
+    python -m openregistry.concierge.benchmarks.feed_memory --changes 1000000 --stream
+    python -m openregistry.concierge.benchmarks.feed_memory --changes 1000000 --limit 10000
+
+With '--stream' RSS should stay flat regardless of backlog size and page limit.
+"""
+import argparse
+import json
+import logging
+import os
+import resource
+import time
+
+from openregistry.concierge.utils import continuous_changes_feed
+
+logger = logging.getLogger(__name__)
+
+
+def rss():
+    """
+    Returns:
+        float: current resident set size of the process in MB.
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize() / 1024.0 / 1024
+    except IOError:
+        # no procfs, fall back to peak RSS (kilobytes on Linux, bytes on OS X)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def change_line(seq):
+    return json.dumps({'seq': seq, 'id': 'lot_{}'.format(seq), 'doc': {
+        '_id': 'lot_{}'.format(seq), '_rev': '1-{:032x}'.format(seq), 'status': 'verification',
+        'assets': ['asset_{}_{}'.format(seq, i) for i in range(3)],
+        'lotID': 'UA-LR-{:010d}'.format(seq), 'lotType': 'loki',
+        'decisions': [{'decisionID': 'decision_{}'.format(seq), 'decisionOf': 'lot'}],
+    }})
+
+
+class BacklogDB(object):
+    """
+    Stand-in for couchdb.Database, which serves 'total' changes.
+    Responses are built as JSON text and parsed like couchdb-python does:
+    normal feed as a whole, continuous feed line by line.
+    """
+
+    def __init__(self, total):
+        self.total = total
+
+    def _seqs(self, since, limit):
+        return range(since + 1, min(since + limit, self.total) + 1)
+
+    def changes(self, feed=None, since=0, limit=100, **options):
+        seqs = self._seqs(since, limit)
+        last_seq = seqs[-1] if seqs else since
+        if feed == 'continuous':
+            return self._continuous(seqs, last_seq)
+        body = '{{"results":[{}],"last_seq":{}}}'.format(','.join(change_line(seq) for seq in seqs), last_seq)
+        return json.loads(body)
+
+    def _continuous(self, seqs, last_seq):
+        for seq in seqs:
+            yield json.loads(change_line(seq))
+        yield json.loads(json.dumps({'last_seq': last_seq}))
+
+
+def run(changes, limit, stream, every):
+    """
+    Consumes the whole backlog and samples RSS every 'every' lots.
+
+    Returns:
+        list: (consumed lots, RSS in MB) samples.
+    """
+    samples = [(0, rss())]
+    state = {}
+    started = time.time()
+    for number, lot in enumerate(continuous_changes_feed(BacklogDB(changes), logger, limit=limit,
+                                                         state=state, stream=stream), 1):
+        if number % every == 0:
+            samples.append((number, rss()))
+    samples.append((state.get('processed_seq', 0), rss()))
+    logger.info('Consumed %s changes in %.1fs', state.get('processed_seq', 0), time.time() - started)
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description='---- Changes feed memory benchmark ----')
+    parser.add_argument('--changes', type=int, default=1000000, help='Size of the backlog')
+    parser.add_argument('--limit', type=int, default=1000, help='Changes page limit')
+    parser.add_argument('--stream', action='store_true', default=False,
+                        help='Parse changes pages as they arrive')
+    parser.add_argument('--every', type=int, default=100000, help='Sample RSS every n lots')
+    params = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    samples = run(params.changes, params.limit, params.stream, params.every)
+    print('{:>12} {:>10}'.format('lots', 'RSS, MB'))
+    for number, memory in samples:
+        print('{:>12} {:>10.1f}'.format(number, memory))
+    print('RSS growth: {:.1f} MB (pid {})'.format(samples[-1][1] - samples[0][1], os.getpid()))
+
+
+if __name__ == '__main__':
+    main()
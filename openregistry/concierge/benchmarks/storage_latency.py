@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+Write latency benchmark of storage backends.
+
+Saves broken lots doc with a growing number of records to every backend
+and prints latency percentiles of 'save', e.g.:
+
+    python -m openregistry.concierge.benchmarks.storage_latency --writes 1000
+    python -m openregistry.concierge.benchmarks.storage_latency --couchdb http://127.0.0.1:5984
+
+CouchDB backend is measured only if '--couchdb' server url is passed,
+a temporary db is created and deleted there.
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import uuid
+
+from couchdb import Server
+
+from openregistry.concierge.storage import MemoryStorage, SQLiteStorage
+
+
+def percentile(values, share):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * share))]
+
+
+def measure(storage, writes, records):
+    """
+    Returns:
+        list: latencies of 'writes' saves of broken lots doc in seconds.
+    """
+    doc = {'_id': 'broken_lots'}
+    latencies = []
+    for number in range(writes):
+        lot_id = 'lot_{}'.format(number % records)
+        doc[lot_id] = {'id': lot_id, 'rev': '1-{:032x}'.format(number), 'status': 'verification',
+                       'assets': ['asset_{}'.format(number)], 'resolved': False, 'message': 'patching assets to active'}
+        started = time.time()
+        storage.save(doc)
+        latencies.append(time.time() - started)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description='---- Storage backends write latency ----')
+    parser.add_argument('--writes', type=int, default=1000, help='Number of saves')
+    parser.add_argument('--records', type=int, default=100, help='Maximum number of records in the doc')
+    parser.add_argument('--couchdb', type=str, default=None, help='CouchDB server url')
+    params = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    backends = [
+        ('memory', MemoryStorage()),
+        ('sqlite', SQLiteStorage(os.path.join(directory, 'state.sqlite'))),
+    ]
+    server = db_name = None
+    if params.couchdb:
+        server = Server(params.couchdb)
+        db_name = 'concierge_benchmark_{}'.format(uuid.uuid4().hex)
+        backends.append(('couchdb', server.create(db_name)))
+
+    print('{:<10} {:>10} {:>10} {:>10} {:>10}'.format('backend', 'p50, ms', 'p90, ms', 'p99, ms', 'max, ms'))
+    try:
+        for name, storage in backends:
+            latencies = measure(storage, params.writes, params.records)
+            print('{:<10} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f}'.format(
+                name, *[v * 1000 for v in (percentile(latencies, 0.5), percentile(latencies, 0.9),
+                                           percentile(latencies, 0.99), max(latencies))]
+            ))
+    finally:
+        shutil.rmtree(directory)
+        if server is not None:
+            del server[db_name]
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+import argparse
+import json
+import logging
+import logging.config
+import os
+import sys
+import threading
+import time
+import yaml
+from collections import Counter
+from Queue import Queue
+
+from openregistry.concierge.changes import ChangesPage, lot_from_row
+from openregistry.concierge.constants import DEFAULTS, DEFERRED, PROCESSED
+from openregistry.concierge.log import log_context
+from openregistry.concierge.pipelines import RateLimiter
+from openregistry.concierge.redrive import process_broken_lot
+from openregistry.concierge.utils import update_broken_lot
+from openregistry.concierge.worker import BotWorker
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+MISSING = 'missing'
+UNSUPPORTED = 'unsupported'
+ERROR = 'error'
+
+
+def ids_from_file(path):
+    with open(path) as ids:
+        for line in ids:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                yield line
+
+
+def ids_from_broken_lots(errors_doc):
+    for lot_id, record in errors_doc.items():
+        if not lot_id.startswith('_') and isinstance(record, dict) and not record.get('resolved', True):
+            yield lot_id
+
+
+def ids_from_statuses(db, statuses, page_size=1000):
+    """
+    Yields ids of lots with given statuses, reading the whole changes feed
+    of the db page by page.
+    """
+    since = 0
+    while True:
+        page = ChangesPage(db, since, page_size, None, stream=True)
+        for row in page:
+            doc = row.get('doc') or {}
+            if not row.get('deleted') and 'lotType' in doc and doc.get('status') in statuses:
+                yield doc['_id']
+        if page.count == 0:
+            break
+        since = page.last_seq
+
+
+class BulkRedrive(object):
+    """
+    Runs lots by id through processors of BotWorker in 'concurrency'
+    threads, not faster than 'rate' lots per second (0 - no limit).
+    """
+
+    def __init__(self, worker, concurrency=10, rate=0, progress_interval=5, out=sys.stdout):
+        self.worker = worker
+        self.concurrency = concurrency
+        self.rate_limiter = RateLimiter(rate)
+        self.progress_interval = progress_interval
+        self.out = out
+        self.queue = Queue(concurrency * 10)
+        self.outcomes = Counter()
+        self.results = []
+        self._lock = threading.Lock()
+
+    def redrive(self, lot_id):
+        """
+        Processes current version of the lot from db. Broken lot is
+        resolved only if processing was completed, lot with half-done
+        transition, which can't be resumed, is left for a human.
+
+        Returns:
+            str: outcome of processing (see 'process_broken_lot').
+        """
+        doc = self.worker.db.get(lot_id)
+        if doc is None:
+            return MISSING
+        lot = lot_from_row({'doc': doc})
+        processing = self.worker.lot_type_processing_configurator.get(lot['lotType'])
+        if processing is None:
+            return UNSUPPORTED
+        if not self.worker.upstreams_available(lot):
+            return DEFERRED
+        with log_context(lot_id=lot_id, lot_type=lot['lotType'], step=lot['status']):
+            outcome = process_broken_lot(self.worker, processing, lot)
+        record = self.worker.errors_doc.get(lot_id)
+        if outcome == PROCESSED and record and not record.get('resolved', True):
+            update_broken_lot(self.worker.storage, logger, self.worker.errors_doc, lot_id, resolved=True)
+        return outcome
+
+    def _work(self):
+        while True:
+            lot_id = self.queue.get()
+            if lot_id is _STOP:
+                break
+            self.rate_limiter.wait()
+            started = time.time()
+            try:
+                outcome = self.redrive(lot_id)
+            except Exception as e:
+                logger.error('Failed to re-drive lot {}: {!r}'.format(lot_id, e))
+                outcome = ERROR
+            with self._lock:
+                self.outcomes[outcome] += 1
+                self.results.append({'id': lot_id, 'outcome': outcome, 'duration': time.time() - started})
+
+    def report_progress(self, started):
+        done = sum(self.outcomes.values())
+        elapsed = time.time() - started
+        self.out.write('{} lots in {:.0f}s, {:.1f} lots/s: {}\n'.format(
+            done, elapsed, done / elapsed if elapsed else 0,
+            ', '.join('{} {}'.format(v, k) for k, v in sorted(self.outcomes.items()))
+        ))
+        self.out.flush()
+
+    def run(self, lot_ids):
+        """
+        Returns:
+            dict: summary with number of lots of every outcome, duration
+                  and throughput.
+        """
+        started = time.time()
+        threads = [threading.Thread(target=self._work, name='bulk-redrive-{}'.format(i))
+                   for i in range(self.concurrency)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        reported = time.time()
+        seen = set()
+        for lot_id in lot_ids:
+            if lot_id in seen:
+                continue
+            seen.add(lot_id)
+            self.queue.put(lot_id)
+            if time.time() - reported >= self.progress_interval:
+                self.report_progress(started)
+                reported = time.time()
+        for _ in threads:
+            self.queue.put(_STOP)
+        for thread in threads:
+            thread.join()
+        self.report_progress(started)
+        duration = time.time() - started
+        return {
+            'total': len(self.results),
+            'outcomes': dict(self.outcomes),
+            'duration': duration,
+            'throughput': len(self.results) / duration if duration else 0,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='---- OpenRegistry Concierge bulk re-drive ----')
+    parser.add_argument('config', type=str, help='Path to configuration file')
+    parser.add_argument('--ids', dest='ids', type=str, default=None,
+                        help='File with lot ids, one per line')
+    parser.add_argument('--broken', dest='broken', action='store_true', default=False,
+                        help='Re-drive unresolved lots from broken lots doc')
+    parser.add_argument('--status', dest='statuses', action='append', default=[],
+                        help='Re-drive lots with the status (could be repeated)')
+    parser.add_argument('-c', '--concurrency', dest='concurrency', type=int, default=10,
+                        help='Number of lots processed in parallel')
+    parser.add_argument('--rate', dest='rate', type=float, default=0,
+                        help='Maximum number of lots started per second (0 - no limit)')
+    parser.add_argument('--summary', dest='summary', type=str, default=None,
+                        help='File to write outcomes summary to')
+    params = parser.parse_args()
+    if not (params.ids or params.broken or params.statuses):
+        parser.error('one of --ids, --broken or --status is required')
+
+    config = {}
+    if os.path.isfile(params.config):
+        with open(params.config) as config_object:
+            config = yaml.load(config_object.read())
+        logging.config.dictConfig(config)
+    DEFAULTS.update(config)
+    worker = BotWorker(DEFAULTS)
+
+    if params.ids:
+        lot_ids = ids_from_file(params.ids)
+    elif params.broken:
+        lot_ids = list(ids_from_broken_lots(worker.errors_doc))
+    else:
+        lot_ids = ids_from_statuses(worker.db, params.statuses)
+
+    bulk = BulkRedrive(worker, params.concurrency, params.rate)
+    if worker.leases is not None:
+        worker.leases.start()
+    summary = bulk.run(lot_ids)
+    worker.flush()
+    if worker.leases is not None:
+        worker.leases.stop()
+    if params.summary:
+        with open(params.summary, 'w') as summary_file:
+            json.dump(dict(summary, lots=bulk.results), summary_file, indent=2)
+    sys.stdout.write(json.dumps(summary) + '\n')
+
+
+if __name__ == "__main__":
+    main()
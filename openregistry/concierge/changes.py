@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+LOT_CHANGE_FIELDS = ('id', 'rev', 'status', 'assets', 'lotID', 'lotType', 'decisions', 'auctions')
+
+
+class LotChange(object):
+    """
+    Compact record of a lot received from changes feed.
+
+    Behaves like a dictionary with fixed keys, so it could be passed
+    everywhere lot dictionaries are used, but thanks to __slots__ takes
+    several times less memory than a dictionary with the same keys.
+    """
+    __slots__ = LOT_CHANGE_FIELDS
+
+    def __init__(self, **fields):
+        for field in LOT_CHANGE_FIELDS:
+            setattr(self, field, fields.get(field))
+
+    def __getitem__(self, key):
+        if key not in LOT_CHANGE_FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in LOT_CHANGE_FIELDS:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in LOT_CHANGE_FIELDS
+
+    def __iter__(self):
+        return iter(LOT_CHANGE_FIELDS)
+
+    def __len__(self):
+        return len(LOT_CHANGE_FIELDS)
+
+    def __eq__(self, other):
+        if isinstance(other, (LotChange, dict)):
+            return self.to_dict() == dict(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __repr__(self):
+        return 'LotChange({!r})'.format(self.to_dict())
+
+    def __getstate__(self):
+        return tuple(getattr(self, field) for field in LOT_CHANGE_FIELDS)
+
+    def __setstate__(self, state):
+        for field, value in zip(LOT_CHANGE_FIELDS, state):
+            setattr(self, field, value)
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in LOT_CHANGE_FIELDS else default
+
+    def keys(self):
+        return list(LOT_CHANGE_FIELDS)
+
+    def values(self):
+        return [getattr(self, field) for field in LOT_CHANGE_FIELDS]
+
+    def items(self):
+        return zip(LOT_CHANGE_FIELDS, self.values())
+
+    def to_dict(self):
+        return dict(self.items())
+
+
+def lot_from_row(row):
+    doc = row['doc']
+    return LotChange(
+        id=doc['_id'],
+        rev=doc['_rev'],
+        status=doc['status'],
+        assets=doc['assets'],
+        lotID=doc['lotID'],
+        lotType=doc['lotType'],
+        decisions=doc.get('decisions'),
+        auctions=doc.get('auctions'),
+    )
+
+
+class ChangesPage(object):
+    """
+    Single request to db changes feed.
+
+    If 'stream' is True, changes are requested as continuous feed, which
+    couchdb-python parses line by line, so rows are yielded as they arrive
+    and the whole response is never kept in memory. 'timeout=0' closes the
+    feed as soon as there are no more changes, instead of waiting for new ones.
+
+    If 'filter_doc' is None, all changes of the db are requested.
+    'last_seq' and 'count' are known after the page is iterated.
+    """
+
+    def __init__(self, db, since, limit, filter_doc, stream=False):
+        self.db = db
+        self.since = since
+        self.limit = limit
+        self.filter_doc = filter_doc
+        self.stream = stream
+        self.last_seq = since
+        self.count = 0
+
+    def _rows(self):
+        options = {'include_docs': True, 'since': self.since, 'limit': self.limit}
+        if self.filter_doc:
+            options['filter'] = self.filter_doc
+        if self.stream:
+            return self.db.changes(feed='continuous', timeout=0, **options)
+        data = self.db.changes(**options)
+        self.last_seq = data['last_seq']
+        return data['results']
+
+    def __iter__(self):
+        for row in self._rows():
+            if 'last_seq' in row:
+                self.last_seq = row['last_seq']
+                continue
+            self.count += 1
+            yield row
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+import logging
+import time
+from socket import error
+from threading import Lock
+
+from requests.exceptions import ConnectionError, Timeout
+from openprocurement_client.exceptions import ResourceError
+
+from openregistry.concierge.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+NETWORK_ERRORS = (error, ConnectionError, Timeout)
+
+
+class CircuitOpen(Exception):
+    """
+    Raised instead of calling an upstream, which circuit breaker is open.
+    It isn't a RequestFailed, so it's not handled by processors as a failed
+    request (which could mark lot as broken), but interrupts processing
+    of the lot, which is deferred until the upstream is available.
+    """
+
+    def __init__(self, upstream):
+        self.upstream = upstream
+        self.message = 'Circuit breaker for {} is open'.format(upstream)
+        super(CircuitOpen, self).__init__(self.message)
+
+
+def is_upstream_failure(exception):
+    if isinstance(exception, CircuitOpen):
+        return False
+    if isinstance(exception, ResourceError):
+        return exception.status_code is None or exception.status_code >= 500 or exception.status_code == 429
+    return isinstance(exception, NETWORK_ERRORS)
+
+
+class CircuitBreaker(object):
+    """
+    Tracks health of a single upstream API.
+
+    In 'closed' state all calls are passed to the upstream. After
+    'failure_threshold' consecutive upstream failures breaker switches to
+    'open' state and rejects calls with CircuitOpen during 'reset_timeout'
+    seconds. After that, breaker is 'half_open': 'half_open_calls' trial
+    calls are allowed, success closes breaker, failure opens it again.
+    """
+
+    def __init__(self, upstream, failure_threshold=5, reset_timeout=30, half_open_calls=1):
+        self.upstream = upstream
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_calls = half_open_calls
+        self._lock = Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trials = 0
+        self._state = CLOSED
+        self._publish()
+
+    def _publish(self):
+        metrics.set('circuit_breaker.{}.state'.format(self.upstream), self._state)
+        metrics.set('circuit_breaker.{}.failures'.format(self.upstream), self._failures)
+
+    def _switch(self, state):
+        if self._state != state:
+            logger.warning('Circuit breaker for {} switched from {} to {}'.format(self.upstream, self._state, state))
+        self._state = state
+        if state == OPEN:
+            self._opened_at = time.time()
+        if state in (OPEN, HALF_OPEN):
+            self._trials = 0
+        if state == CLOSED:
+            self._failures = 0
+        self._publish()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == OPEN and time.time() - self._opened_at >= self.reset_timeout:
+                self._switch(HALF_OPEN)
+            return self._state
+
+    @property
+    def available(self):
+        """
+        Returns:
+            bool: True if call to upstream would not be rejected right now.
+        """
+        state = self.state
+        return state == CLOSED or (state == HALF_OPEN and self._trials < self.half_open_calls)
+
+    def _acquire(self):
+        with self._lock:
+            if self._state == OPEN and time.time() - self._opened_at >= self.reset_timeout:
+                self._switch(HALF_OPEN)
+            if self._state == OPEN:
+                return False
+            if self._state == HALF_OPEN:
+                if self._trials >= self.half_open_calls:
+                    return False
+                self._trials += 1
+            return True
+
+    def record_success(self):
+        with self._lock:
+            if self._state != CLOSED or self._failures:
+                self._switch(CLOSED)
+        metrics.set('upstream.{}.last_success'.format(self.upstream), time.time())
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == HALF_OPEN or self._failures >= self.failure_threshold:
+                self._switch(OPEN)
+            else:
+                self._publish()
+
+    def call(self, func, *args, **kwargs):
+        if not self._acquire():
+            metrics.incr('circuit_breaker.{}.rejected'.format(self.upstream))
+            raise CircuitOpen(self.upstream)
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            if is_upstream_failure(e):
+                self.record_failure()
+            else:
+                self.record_success()
+            raise
+        self.record_success()
+        return result
+
+
+class CircuitBreakerClient(object):
+    """
+    Proxy around API client, which passes every method call
+    through the circuit breaker of the client's upstream.
+    """
+
+    def __init__(self, client, breaker):
+        self._client = client
+        self._breaker = breaker
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            return self._breaker.call(attr, *args, **kwargs)
+        return call
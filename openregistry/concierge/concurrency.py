@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+import logging
+import math
+import time
+from threading import Condition
+
+from openregistry.concierge.circuit_breaker import is_upstream_failure
+from openregistry.concierge.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class AdaptiveLimit(object):
+    """
+    Limit of lots processed at once, adjusted to latency and errors of
+    upstream calls in the manner of gradient concurrency limits.
+
+    Calls are recorded in windows of 'window' calls. Median latency of the
+    window is compared with long-term latency: while it's within
+    'tolerance' times of the long-term one, limit grows by sqrt(limit),
+    otherwise it's decreased in proportion to the latency growth. Limit
+    doesn't grow while less than half of it is used. If more than
+    'max_error_rate' of calls failed, limit is multiplied by 'backoff'.
+    Changes are smoothed by 'smoothing' and limit is kept within
+    'min_limit' and 'max_limit'.
+    """
+
+    def __init__(self, min_limit=1, max_limit=16, initial_limit=None, window=20, smoothing=0.2,
+                 tolerance=1.5, max_error_rate=0.1, backoff=0.8):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.window = window
+        self.smoothing = smoothing
+        self.tolerance = tolerance
+        self.max_error_rate = max_error_rate
+        self.backoff = backoff
+        self._limit = float(initial_limit or min_limit)
+        self._long_latency = None
+        self._samples = []
+        self._errors = 0
+        self._in_flight = 0
+        self._cond = Condition()
+        metrics.set('adaptive_concurrency.limit', self.limit)
+
+    @property
+    def limit(self):
+        return int(self._limit)
+
+    def record(self, latency, failed=False):
+        with self._cond:
+            self._samples.append(latency)
+            self._errors += bool(failed)
+            if len(self._samples) >= self.window:
+                self._update()
+
+    def _update(self):
+        samples = sorted(self._samples)
+        latency = samples[len(samples) // 2]
+        error_rate = self._errors / float(len(samples))
+        self._samples = []
+        self._errors = 0
+        if self._long_latency is None:
+            self._long_latency = latency
+        else:
+            self._long_latency = self._long_latency * 0.95 + latency * 0.05
+            if self._long_latency > latency * 2:
+                # upstreams became faster, long-term latency catches up
+                self._long_latency *= 0.9
+
+        if error_rate > self.max_error_rate:
+            limit = self._limit * self.backoff
+        else:
+            gradient = max(0.5, min(1.0, self.tolerance * self._long_latency / latency)) if latency else 1.0
+            target = self._limit * gradient + math.sqrt(self._limit)
+            if self._in_flight * 2 < self._limit:
+                target = min(target, self._limit)
+            limit = self._limit * (1 - self.smoothing) + target * self.smoothing
+        previous = self.limit
+        self._limit = min(self.max_limit, max(self.min_limit, limit))
+        if self.limit != previous:
+            logger.debug('Concurrency limit changed from {} to {}'.format(previous, self.limit))
+        metrics.set('adaptive_concurrency.limit', self.limit)
+        metrics.set('adaptive_concurrency.latency', round(latency, 6))
+        metrics.set('adaptive_concurrency.error_rate', round(error_rate, 3))
+        self._cond.notify_all()
+
+    def acquire(self, timeout=None):
+        """
+        Takes a slot for processing of a lot, waiting while limit is reached.
+
+        Returns:
+            bool: False if slot wasn't free within 'timeout' seconds.
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        with self._cond:
+            while self._in_flight >= self.limit:
+                remaining = deadline - time.time() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            self._in_flight += 1
+            metrics.set('adaptive_concurrency.in_flight', self._in_flight)
+            return True
+
+    def release(self):
+        with self._cond:
+            self._in_flight -= 1
+            metrics.set('adaptive_concurrency.in_flight', self._in_flight)
+            self._cond.notify()
+
+
+class AdaptiveLimitClient(object):
+    """
+    Proxy around API client, which records latency and failures of every
+    call to the adaptive limit. It's placed under circuit breaker, so calls
+    rejected by breaker aren't recorded.
+    """
+
+    def __init__(self, client, limit):
+        self._client = client
+        self._limit = limit
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            started = time.time()
+            try:
+                result = attr(*args, **kwargs)
+            except Exception as e:
+                self._limit.record(time.time() - started, is_upstream_failure(e))
+                raise
+            self._limit.record(time.time() - started)
+            return result
+        return call
+
+
+def init_adaptive_limit(config):
+    """
+    Creates adaptive limit, if 'adaptive_concurrency' section is present
+    in configuration.
+
+    Returns:
+        AdaptiveLimit or None
+    """
+    if not config.get('adaptive_concurrency'):
+        return
+    return AdaptiveLimit(**config['adaptive_concurrency'])
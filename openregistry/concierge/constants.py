@@ -7,8 +7,31 @@ DEFAULTS = {
         "password": "",
         "filter": "lots/status"
     },
+    "stream_changes": False,
+    "singleflight": False,
+    "storage": {
+        "backend": "couchdb"
+    },
     "errors_doc": "broken_lots",
+    "journal": {
+        "doc_id": "lots_journal",
+        "batch_size": 10,
+        "retention": 604800
+    },
+    "auction_index": {
+        "doc_id": "auctions_index",
+        "retention": 604800
+    },
     "time_to_sleep": 10,
+    "shutdown_timeout": 30,
+    "processes": {
+        "workers": 0,
+        "queue_size": 100
+    },
+    "circuit_breaker": {
+        "failure_threshold": 5,
+        "reset_timeout": 30
+    },
     "lots": {
         "api": {
             "url": "http://0.0.0.0:6543",
@@ -17,6 +40,7 @@ DEFAULTS = {
         },
         "basic": {
             'aliases': ["basic"],
+            'conditional_patch': False,
             'assets': {
                 "basic": ["basic"],
                 "compound": ["compound"],
@@ -25,6 +49,11 @@ DEFAULTS = {
         },
         "loki": {
             'aliases': ["loki"],
+            'conditional_patch': False,
+            'salable_fingerprints': {
+                "max_size": 10000,
+                "ttl": 3600
+            },
             'assets': {
                 "bounce": ["bounce", "domain"]
             }
@@ -44,6 +73,19 @@ DEFAULTS = {
             "version": 0.1
         }
     },
+    "logging_pipeline": {
+        "queue_size": 10000,
+        "sampling": {
+            "patch_asset": {
+                "every": 1,
+                "per_second": 100
+            },
+            "get_asset": {
+                "every": 1,
+                "per_second": 100
+            }
+        }
+    },
     "formatters": {
         "simple": {
             "format": "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
@@ -69,3 +111,11 @@ DEFAULTS = {
         }
     }
 }
+
+# outcomes of processing of a lot
+PROCESSED = 'processed'
+SKIPPED = 'skipped'
+FAILED = 'failed'
+BROKEN = 'broken'
+DEFERRED = 'deferred'
+MANUAL = 'manual'
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from openprocurement_client.exceptions import RequestFailed
+
+from openregistry.concierge.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+class DeadlineExceeded(RequestFailed):
+    """
+    Raised instead of calling an upstream, when processing deadline
+    of the lot has passed. Behaves as a server error for the existing
+    error handling, so patched assets are rolled back, but is never
+    retried.
+    """
+    status_code = 504
+
+    def __init__(self, lot_id, timeout):
+        super(DeadlineExceeded, self).__init__()
+        self.lot_id = lot_id
+        self.timeout = timeout
+        self.message = 'Processing deadline of {}s for lot {} exceeded'.format(timeout, lot_id)
+
+
+class LotDeadline(object):
+    """
+    Deadline and timings of upstream calls of the lot in processing.
+
+    After 'timeout' seconds calls are rejected, except compensation
+    (see 'compensation'), which is allowed 'compensation_timeout'
+    seconds more.
+    """
+
+    def __init__(self, lot_id, timeout, compensation_timeout=30):
+        self.lot_id = lot_id
+        self.timeout = timeout
+        self.compensation_timeout = compensation_timeout
+        self.started = time.time()
+        self.expires = self.started + timeout
+        self.compensating = False
+        self.exceeded = False
+        self.calls = {}
+
+    def check(self):
+        limit = self.expires + self.compensation_timeout if self.compensating else self.expires
+        if time.time() >= limit:
+            self.exceeded = True
+            raise DeadlineExceeded(self.lot_id, self.timeout)
+
+    def record(self, operation, duration):
+        count, total = self.calls.get(operation, (0, 0))
+        self.calls[operation] = (count + 1, total + duration)
+
+    def slowest(self):
+        """
+        Returns:
+            str: operation, which took the most time, or None.
+        """
+        if self.calls:
+            return max(self.calls, key=lambda operation: self.calls[operation][1])
+
+    def timing(self):
+        return {
+            'timeout': self.timeout,
+            'elapsed': round(time.time() - self.started, 3),
+            'slowest': self.slowest(),
+            'calls': dict((operation, {'count': count, 'duration': round(total, 3)})
+                          for operation, (count, total) in self.calls.items()),
+        }
+
+
+def current_deadline():
+    return getattr(_local, 'deadline', None)
+
+
+@contextmanager
+def compensation():
+    """Lets calls, which undo partially done work, run after the deadline."""
+    deadline = current_deadline()
+    if deadline is None:
+        yield
+        return
+    previous, deadline.compensating = deadline.compensating, True
+    try:
+        yield
+    finally:
+        deadline.compensating = previous
+
+
+class DeadlineClient(object):
+    """
+    Proxy around API client, which checks deadline of the lot, processed
+    by the current thread, before every call and records call timings.
+    """
+
+    def __init__(self, client, upstream):
+        self._client = client
+        self._upstream = upstream
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            deadline = current_deadline()
+            if deadline is None:
+                return attr(*args, **kwargs)
+            deadline.check()
+            started = time.time()
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                deadline.record('{}.{}'.format(self._upstream, name), time.time() - started)
+        return call
+
+
+class Watchdog(object):
+    """
+    Bounds processing time of a lot: 'timeout' seconds, or the value for
+    lot status from 'steps'. Processing isn't interrupted in the middle
+    of HTTP request, remaining upstream calls are rejected with
+    DeadlineExceeded instead, so the processors stop and roll back as
+    on server error.
+    """
+
+    def __init__(self, timeout=300, compensation_timeout=30, steps=None):
+        self.timeout = timeout
+        self.compensation_timeout = compensation_timeout
+        self.steps = steps or {}
+
+    def start(self, lot):
+        """
+        Binds deadline of the lot to the current thread.
+
+        Returns:
+            LotDeadline
+        """
+        _local.deadline = LotDeadline(lot['id'], self.steps.get(lot['status'], self.timeout),
+                                      self.compensation_timeout)
+        return _local.deadline
+
+    def stop(self):
+        deadline, _local.deadline = current_deadline(), None
+        if deadline is not None and deadline.exceeded:
+            metrics.incr('watchdog.timeouts')
+            logger.warning('Lot {} exceeded processing deadline of {}s, slowest step: {}'.format(
+                deadline.lot_id, deadline.timeout, deadline.slowest()))
+        return deadline
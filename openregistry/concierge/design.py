@@ -1,6 +1,19 @@
 # -*- coding: utf-8 -*-
+import hashlib
+import json
+import logging
+import threading
+
 from couchdb.design import ViewDefinition
 
+logger = logging.getLogger(__name__)
+
+# concierge views live in their own design doc, so changes of other design
+# docs (e.g. 'lots', which holds filters) don't touch their indexes
+DESIGN_DOC = 'concierge'
+HASH_FIELD = 'concierge_hash'
+# views, which were kept in the design doc of filters by previous versions
+LEGACY_VIEWS = {'lots': ['check_lot']}
 
 FIELDS = [
     'status',
@@ -14,12 +27,114 @@ def add_index_options(doc):
     doc['options'] = {'local_seq': True}
 
 
-def sync_design(db):
-    views = [j for i, j in globals().items() if "_view" in i]
-    ViewDefinition.sync_many(db, views, callback=add_index_options)
+def design_content(views):
+    """
+    Builds the body of the design doc from view definitions.
+
+    Returns:
+        dict: 'language', 'views' and 'options' of the design doc.
+    """
+    content = {'language': 'javascript', 'views': {}}
+    for view in views:
+        funcs = {'map': view.map_fun}
+        if view.reduce_fun:
+            funcs['reduce'] = view.reduce_fun
+        content['views'][view.name] = funcs
+    add_index_options(content)
+    return content
+
+
+def content_hash(content):
+    return hashlib.sha1(json.dumps(content, sort_keys=True)).hexdigest()
+
+
+def warm_up(db, doc_id, content, digest):
+    """
+    Builds indexes of the changed design doc before switching over to it.
+
+    New definition is saved under a temporary id and its views are queried,
+    which blocks until indexes are built. Indexes are shared between design
+    docs with the same definition, so saving it under 'doc_id' afterwards
+    reuses already built indexes, and the old ones are used until then.
+    """
+    staging_id = '{}_{}'.format(doc_id, digest[:8])
+    staging = db.get(staging_id, {'_id': staging_id})
+    staging.update(content)
+    db.save(staging)
+    for name in content['views']:
+        list(db.view('{}/{}'.format(staging_id[len('_design/'):], name), limit=1))
+    doc = db.get(doc_id, {'_id': doc_id})
+    doc.update(content)
+    doc[HASH_FIELD] = digest
+    db.save(doc)
+    db.delete(db[staging_id])
+    logger.info('Switched {} to warmed up definition {}'.format(doc_id, digest))
+
+
+def migrate_design(db):
+    """
+    Removes views, moved to the concierge design doc, from their old
+    design docs, so CouchDB doesn't keep updating their indexes.
+    """
+    for name, view_names in LEGACY_VIEWS.items():
+        doc_id = '_design/{}'.format(name)
+        doc = db.get(doc_id)
+        if doc is None or not any(view in doc.get('views', {}) for view in view_names):
+            continue
+        for view in view_names:
+            doc['views'].pop(view, None)
+        if not doc['views']:
+            del doc['views']
+        db.save(doc)
+        logger.info('Removed legacy views {} from {}'.format(', '.join(view_names), doc_id))
+
+
+def sync_design(db, background=True):
+    """
+    Writes concierge views to the db only if their definition has changed,
+    which is detected by content hash stored in the design doc. So restarts
+    don't create new design doc revisions and don't trigger index rebuilds.
+    Views of previous versions are removed from their old design docs.
+
+    If the design doc already exists, new indexes are built by 'warm_up'
+    before switch over, in a background thread if 'background' is True.
+
+    Returns:
+        threading.Thread: started warm up thread or None.
+    """
+    migrate_design(db)
+    views = [j for i, j in sorted(globals().items()) if "_view" in i]
+    content = design_content(views)
+    digest = content_hash(content)
+    doc_id = '_design/{}'.format(DESIGN_DOC)
+    doc = db.get(doc_id)
+    if doc is not None and doc.get(HASH_FIELD) == digest:
+        logger.debug('Design doc {} is up to date.'.format(doc_id))
+        return
+    if doc is None:
+        doc = {'_id': doc_id}
+        doc.update(content)
+        doc[HASH_FIELD] = digest
+        db.save(doc)
+        logger.info('Created design doc {}'.format(doc_id))
+        return
+    if not background:
+        warm_up(db, doc_id, content, digest)
+        return
+    thread = threading.Thread(target=warm_up_safely, args=(db, doc_id, content, digest), name='design-warm-up')
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def warm_up_safely(db, doc_id, content, digest):
+    try:
+        warm_up(db, doc_id, content, digest)
+    except Exception as e:
+        logger.error('Failed to warm up design doc {}: {!r}'.format(doc_id, e))
 
 
-concierge_view = ViewDefinition('lots', 'check_lot', '''function(doc) {
+concierge_view = ViewDefinition(DESIGN_DOC, 'check_lot', '''function(doc) {
     var statuses = ['verification', 'pending.dissolution', 'recomposed', 'pending.sold']
     if(doc.doc_type == 'Lot' && statuses.indexOf(doc.status) != 1) {
         var fields=%s, data={};
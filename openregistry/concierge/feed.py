@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+from Queue import Queue, Empty, Full
+from socket import error
+
+from openregistry.concierge.metrics import metrics
+from openregistry.concierge.changes import ChangesPage, lot_from_row
+
+_END = object()
+
+
+class PrefetchingFeed(object):
+    """
+    Changes feed, which pages are fetched by a background reader thread
+    into a bounded queue, while consumer processes lots, so fetch latency
+    is hidden behind processing time.
+
+    If queue is full, reader waits (backpressure) and the next page is
+    requested with halved limit; if consumer drained queue while page was
+    fetched, limit is doubled. So page size follows consumer rate within
+    'min_limit' and 'max_limit'.
+
+    Yields the same items and updates 'state' the same way as
+    'continuous_changes_feed'.
+    """
+
+    def __init__(self, db, logger, filter_doc='lots/status', state=None,
+                 queue_size=500, min_limit=10, max_limit=1000, limit=100, stream=False):
+        self.db = db
+        self.logger = logger
+        self.filter_doc = filter_doc
+        self.state = state if state is not None else {}
+        self.queue = Queue(queue_size)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = limit
+        self.stream = stream
+        self._stop = threading.Event()
+
+    def _put(self, item):
+        """
+        Puts item to the queue, waiting while queue is full.
+
+        Returns:
+            bool: True if reader had to wait for the consumer.
+        """
+        waited = False
+        while not self._stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return waited
+            except Full:
+                waited = True
+        return waited
+
+    def _adapt_limit(self, starved, waited):
+        if waited:
+            self.limit = max(self.min_limit, self.limit // 2)
+        elif starved:
+            self.limit = min(self.max_limit, self.limit * 2)
+        metrics.set('feed.page_size', self.limit)
+
+    def _read(self):
+        last_seq_id = 0
+        try:
+            while not self._stop.is_set():
+                started = time.time()
+                page = ChangesPage(self.db, last_seq_id, self.limit, self.filter_doc, stream=self.stream)
+                starved = waited = False
+                try:
+                    for row in page:
+                        if page.count == 1:
+                            # consumer waited for the first row of the page
+                            metrics.set('feed.fetch_time', time.time() - started)
+                            starved = self.queue.empty()
+                        waited = self._put((lot_from_row(row), row['seq'])) or waited
+                        metrics.set('feed.queue_size', self.queue.qsize())
+                except error as e:
+                    self.logger.error('Failed to get lots from DB: [Errno {}] {}'.format(e.errno, e.strerror))
+                    break
+                last_seq_id = page.last_seq
+                if page.count == 0:
+                    self._put((_END, last_seq_id))
+                    return
+                self._adapt_limit(starved, waited)
+        except Exception as e:
+            self.logger.error('Feed reader failed: {!r}'.format(e))
+        self._put((_END, None))
+
+    def __iter__(self):
+        reader = threading.Thread(target=self._read, name='feed-reader')
+        reader.daemon = True
+        reader.start()
+        try:
+            while True:
+                item, seq = self.queue.get()
+                if item is _END:
+                    if seq is not None:
+                        self.state['processed_seq'] = seq
+                        self.state['caught_up_seq'] = seq
+                        self.state['caught_up_at'] = time.time()
+                    break
+                yield item
+                self.state['processed_seq'] = seq
+        finally:
+            self._stop.set()
+            # unblock reader, if it waits for free space in the queue
+            while True:
+                try:
+                    self.queue.get_nowait()
+                except Empty:
+                    break
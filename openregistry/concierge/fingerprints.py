@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from openregistry.concierge.metrics import metrics
+
+
+def fingerprint(*parts):
+    return hashlib.sha1(json.dumps(parts, sort_keys=True)).hexdigest()
+
+
+class FingerprintIndex(object):
+    """
+    Bounded in-memory index of fingerprints of lots, which were evaluated
+    without any action, so unchanged lots could be skipped next time.
+
+    Entries are kept for 'ttl' seconds, so conditions, which are not part
+    of fingerprint, are re-checked eventually. When 'max_size' entries are
+    stored, the oldest ones are evicted.
+    """
+
+    def __init__(self, name, max_size=10000, ttl=3600):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def unchanged(self, lot_id, value):
+        """
+        Returns:
+            bool: True if lot was evaluated with the same fingerprint.
+        """
+        with self._lock:
+            entry = self._entries.get(lot_id)
+            if entry is not None and (entry[0] != value or entry[1] <= time.time()):
+                del self._entries[lot_id]
+                entry = None
+        if entry is not None:
+            metrics.incr('{}.skipped'.format(self.name))
+        return entry is not None
+
+    def remember(self, lot_id, value):
+        with self._lock:
+            self._entries.pop(lot_id, None)
+            self._entries[lot_id] = (value, time.time() + self.ttl)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            metrics.set('{}.size'.format(self.name), len(self._entries))
+
+    def forget(self, lot_id):
+        with self._lock:
+            self._entries.pop(lot_id, None)
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+from openregistry.concierge.metrics import metrics
+from openregistry.concierge.utils import seq_number
+
+logger = logging.getLogger(__name__)
+
+
+class HealthCheck(object):
+    """
+    Collects numbers, which describe whether concierge is keeping up
+    with the lots db.
+    """
+
+    def __init__(self, worker, stall_timeout=300, backlog_limit=1000):
+        self.worker = worker
+        self.stall_timeout = stall_timeout
+        self.backlog_limit = backlog_limit
+
+    def alive(self):
+        """
+        Returns:
+            bool: False if worker loop made no progress for 'stall_timeout' seconds.
+        """
+        return time.time() - self.worker.heartbeat < self.stall_timeout
+
+    def ready(self):
+        return self.alive() and self.worker.breakers['lots'].available
+
+    def backlog(self, since):
+        """
+        Estimates number of handled-status lots changed after 'since'
+        by filtered changes request, limited by 'backlog_limit'.
+        """
+        data = self.worker.db.changes(since=since, limit=self.backlog_limit,
+                                      filter=self.worker.config['db']['filter'])
+        return len(data['results'])
+
+    def status(self):
+        state = self.worker.feed_state
+        now = time.time()
+        processed_seq = state.get('processed_seq', 0)
+        result = {
+            'alive': self.alive(),
+            'ready': self.ready(),
+            'processed_seq': processed_seq,
+            'in_flight': self.worker.in_flight,
+            'deferred': len(self.worker.deferred_lots),
+            'last_loop_activity': self.worker.heartbeat,
+            'last_api_success': max([0] + [
+                v for k, v in metrics.snapshot().items() if k.startswith('upstream.') and k.endswith('.last_success')
+            ]) or None,
+            'pipelines': {p.name: p.status() for p in set(self.worker.pipelines.values())},
+        }
+        try:
+            update_seq = self.worker.db.info()['update_seq']
+            backlog = self.backlog(processed_seq)
+        except Exception as e:
+            # status is reported whatever failed: connection, db or changes filter
+            logger.error('Failed to get db info: {!r}'.format(e))
+            result['ready'] = False
+            return result
+        result['update_seq'] = update_seq
+        result['seq_lag'] = seq_number(update_seq) - seq_number(processed_seq)
+        result['backlog'] = backlog
+        result['backlog_limited'] = backlog >= self.backlog_limit
+        # oldest unprocessed change can't be older than the moment, when feed was caught up last time
+        caught_up_at = state.get('caught_up_at')
+        if backlog and caught_up_at:
+            result['oldest_unprocessed_age'] = now - caught_up_at
+        else:
+            result['oldest_unprocessed_age'] = 0
+        result['metrics'] = metrics.snapshot()
+        return result
+
+
+class HealthRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        check = self.server.health_check
+        if self.path == '/health':
+            alive = check.alive()
+            self._respond(200 if alive else 503, {'alive': alive})
+        elif self.path == '/ready':
+            ready = check.ready()
+            self._respond(200 if ready else 503, {'ready': ready})
+        elif self.path == '/status':
+            status = check.status()
+            self._respond(200 if status['alive'] else 503, status)
+        else:
+            self._respond(404, {'error': 'Not found'})
+
+    def _respond(self, code, body):
+        body = json.dumps(body)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+def start_health_server(worker, host='127.0.0.1', port=8080, **settings):
+    """
+    Starts HTTP server with '/health' (liveness), '/ready' (readiness) and
+    '/status' (feed position, backlog and metrics) endpoints in a
+    background thread.
+
+    Returns:
+        HTTPServer: running server.
+    """
+    server = HTTPServer((host, port), HealthRequestHandler)
+    server.health_check = HealthCheck(worker, **settings)
+    thread = threading.Thread(target=server.serve_forever, name='health-server')
+    thread.daemon = True
+    thread.start()
+    logger.info('Health endpoint is listening on {}:{}'.format(host, port))
+    return server
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+import logging
+import time
+from socket import error
+from threading import RLock
+
+from couchdb.http import ResourceConflict
+
+logger = logging.getLogger(__name__)
+
+
+class LotJournal(object):
+    """
+    Journal of completed steps of multi-step lot transitions.
+
+    Journal is stored in a single db document (like broken lots), where
+    every lot in progress has an entry {'rev': <lot rev>, 'steps': {...}}.
+    If worker dies in the middle of transition, next run finds the entry
+    for the same lot revision and resumes from the last completed step.
+
+    Writes are batched: records are kept in memory and saved either
+    explicitly with 'flush' (at step boundaries) or when 'batch_size'
+    records have accumulated. Finished entries are removed lazily and
+    saved together with the next write. If db is None, journal is kept
+    in memory only.
+
+    Entries of lots, which were never finished (lot was deleted or left
+    the filter in the middle of transition), are removed 'retention'
+    seconds after their last change.
+
+    If the document was saved by another concierge node meanwhile, only
+    entries changed by this journal since the last write are written over
+    the stored document, so entries of other nodes are kept.
+    """
+
+    def __init__(self, db=None, doc_id='lots_journal', batch_size=10, retention=604800):
+        self.db = db
+        self.doc_id = doc_id
+        self.batch_size = batch_size
+        self.retention = retention
+        self._lock = RLock()
+        self._dirty = 0
+        self._changed = set()
+        self._doc = None
+        self._load((db.get(doc_id) if db is not None else None) or {'_id': doc_id})
+
+    def _load(self, doc):
+        for lot_id, entry in doc.items():
+            # entries written by previous versions are kept for 'retention' from now
+            if not lot_id.startswith('_'):
+                entry.setdefault('updated', time.time())
+        self._doc = doc
+
+    def _entry(self, lot):
+        entry = self._doc.get(lot['id'])
+        if entry and entry['rev'] == lot.get('rev'):
+            return entry
+
+    def started(self, lot):
+        """
+        Returns:
+            bool: True if there is unfinished transition for this lot revision.
+        """
+        with self._lock:
+            return self._entry(lot) is not None
+
+    def begin(self, lot):
+        with self._lock:
+            if self._entry(lot) is None:
+                self._doc[lot['id']] = {'rev': lot.get('rev'), 'steps': {}, 'updated': time.time()}
+                self._changed.add(lot['id'])
+                self._dirty += 1
+            self.sweep()
+            self.flush()
+
+    def completed(self, lot, step, item=None):
+        with self._lock:
+            entry = self._entry(lot)
+            if entry is None or step not in entry['steps']:
+                return False
+            return item is None or item in entry['steps'][step]
+
+    def record(self, lot, step, item=None):
+        with self._lock:
+            entry = self._entry(lot)
+            if entry is None:
+                return
+            items = entry['steps'].setdefault(step, [])
+            if item is not None and item not in items:
+                items.append(item)
+            entry['updated'] = time.time()
+            self._changed.add(lot['id'])
+            self._dirty += 1
+            if self._dirty >= self.batch_size:
+                self.flush()
+
+    def undo(self, lot, items):
+        """Removes items, which changes were rolled back, from all steps."""
+        with self._lock:
+            entry = self._entry(lot)
+            if entry is None or not items:
+                return
+            for step_items in entry['steps'].values():
+                step_items[:] = [item for item in step_items if item not in items]
+            entry['updated'] = time.time()
+            self._changed.add(lot['id'])
+            self._dirty += 1
+
+    def finish(self, lot):
+        with self._lock:
+            if self._doc.pop(lot['id'], None) is not None:
+                self._changed.add(lot['id'])
+                self._dirty += 1
+
+    def sweep(self):
+        """Removes entries, which were not changed for 'retention' seconds."""
+        with self._lock:
+            expired = [lot_id for lot_id, entry in self._doc.items() if not lot_id.startswith('_')
+                       and entry['updated'] < time.time() - self.retention]
+            for lot_id in expired:
+                logger.info('Removing stale journal entry of lot {}'.format(lot_id))
+                del self._doc[lot_id]
+            self._changed.update(expired)
+            self._dirty += len(expired)
+
+    def _merge(self):
+        stored = self.db.get(self.doc_id) or {'_id': self.doc_id}
+        for lot_id in self._changed:
+            if lot_id in self._doc:
+                stored[lot_id] = self._doc[lot_id]
+            else:
+                stored.pop(lot_id, None)
+        self._load(stored)
+
+    def flush(self):
+        with self._lock:
+            if not self._dirty or self.db is None:
+                self._dirty = 0
+                self._changed.clear()
+                return
+            try:
+                try:
+                    self.db.save(self._doc)
+                except ResourceConflict:
+                    self._merge()
+                    self.db.save(self._doc)
+            except error as e:
+                logger.error('Failed to save lots journal: [Errno {}] {}'.format(e.errno, e.strerror))
+            except ResourceConflict as e:
+                # changes are kept and written by the next flush
+                logger.error('Failed to save lots journal: {!r}'.format(e))
+            else:
+                self._dirty = 0
+                self._changed.clear()
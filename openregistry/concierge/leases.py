@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import socket
+import time
+from threading import Event, Lock, Thread
+
+from openregistry.concierge.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class LeaseManager(object):
+    """
+    Per-lot leases, kept in CouchDB documents 'lease_<lot id>' with owner
+    node and expiration time, so several concierge nodes could process
+    lots from the same db without processing the same lot at once.
+
+    Leases are acquired in batches: existing lease documents are read by
+    a single '_all_docs' request and new ones are written by a single
+    '_bulk_docs' request, which also deletes leases released since the
+    previous write. CouchDB revisions guarantee that only one of nodes,
+    writing the same lease, succeeds.
+
+    Held leases are renewed in background every 'ttl' / 3 seconds, so
+    lease of a stopped node expires in 'ttl' seconds and lot could be
+    taken over by another node.
+    """
+
+    def __init__(self, db, node_id=None, ttl=120, batch_size=20, prefix='lease_'):
+        self.db = db
+        self.node_id = node_id or '{}-{}'.format(socket.gethostname(), os.getpid())
+        self.ttl = ttl
+        self.batch_size = batch_size
+        self.prefix = prefix
+        self._held = {}
+        self._released = []
+        # lease documents are written by one request at a time, so revisions stay actual
+        self._write_lock = Lock()
+        self._lock = Lock()
+        self._stop = Event()
+        self._thread = None
+
+    def _doc_id(self, lot_id):
+        return '{}{}'.format(self.prefix, lot_id)
+
+    def held(self, lot_id):
+        with self._lock:
+            return lot_id in self._held
+
+    def acquire(self, lots):
+        """
+        Acquires leases of lots, which are not held by other nodes.
+
+        Returns:
+            list: lots, which leases are held by this node.
+        """
+        with self._lock:
+            wanted = [lot for lot in lots if lot['id'] not in self._held]
+        with self._write_lock:
+            docs = []
+            if wanted:
+                try:
+                    rows = self.db.view('_all_docs', keys=[self._doc_id(lot['id']) for lot in wanted],
+                                        include_docs=True)
+                    existing = dict((row['key'], row.get('doc')) for row in rows)
+                except Exception as e:
+                    # lots are not processed without lease, they are read again on the next pass
+                    logger.error('Failed to read leases: {!r}'.format(e))
+                    return [lot for lot in lots if self.held(lot['id'])]
+                now = time.time()
+                for lot in wanted:
+                    doc = existing.get(self._doc_id(lot['id']))
+                    if doc and doc['owner'] != self.node_id and doc['expires'] > now:
+                        metrics.incr('leases.busy')
+                        continue
+                    lease = {'_id': self._doc_id(lot['id']), 'lot_id': lot['id'],
+                             'owner': self.node_id, 'expires': now + self.ttl}
+                    if doc:
+                        lease['_rev'] = doc['_rev']
+                    docs.append(lease)
+            results = self._write(docs)
+            with self._lock:
+                for lease in docs:
+                    success, rev = results.get(lease['_id'], (False, None))
+                    if success:
+                        lease['_rev'] = rev
+                        self._held[lease['lot_id']] = lease
+                    else:
+                        metrics.incr('leases.busy')
+                metrics.set('leases.held', len(self._held))
+        return [lot for lot in lots if self.held(lot['id'])]
+
+    def _write(self, leases):
+        """
+        Writes leases along with deletion of released ones. Leases, which
+        were released meanwhile, are not written.
+
+        Returns:
+            dict: (success, new revision) of written leases by document id,
+                  empty if request failed.
+        """
+        with self._lock:
+            released, self._released = self._released, []
+        deleted = [{'_id': doc['_id'], '_rev': doc['_rev'], '_deleted': True} for doc in released]
+        deleted_ids = set(doc['_id'] for doc in deleted)
+        leases = [lease for lease in leases if lease['_id'] not in deleted_ids]
+        if not leases and not deleted:
+            return {}
+        try:
+            results = self.db.update(leases + deleted)
+        except Exception as e:
+            logger.error('Failed to write leases: {!r}'.format(e))
+            with self._lock:
+                self._released.extend(released)
+            return {}
+        # failed deletion of released lease isn't retried, lease expires
+        return dict((doc_id, (success, rev)) for success, doc_id, rev in results[:len(leases)])
+
+    def release(self, lot_id):
+        """Marks lease as released, it's deleted by the next write."""
+        with self._lock:
+            lease = self._held.pop(lot_id, None)
+            if lease is not None:
+                self._released.append(lease)
+            metrics.set('leases.held', len(self._held))
+
+    def flush(self):
+        """Deletes released leases."""
+        with self._write_lock:
+            self._write([])
+
+    def renew(self):
+        """
+        Extends held leases by 'ttl' seconds. Leases, which were taken
+        over by other nodes, are dropped.
+        """
+        with self._write_lock:
+            with self._lock:
+                held = self._held.values()
+            if not held:
+                self._write([])
+                return
+            renewed = [dict(lease, expires=time.time() + self.ttl) for lease in held]
+            results = self._write(renewed)
+            for lease, renewal in zip(held, renewed):
+                if lease['_id'] not in results:
+                    continue
+                success, rev = results[lease['_id']]
+                if success:
+                    # lease could have been released meanwhile, its deletion needs the new revision
+                    lease.update(_rev=rev, expires=renewal['expires'])
+                else:
+                    logger.warning('Lease of lot {} was lost'.format(lease['lot_id']))
+                    metrics.incr('leases.lost')
+                    with self._lock:
+                        if self._held.get(lease['lot_id']) is lease:
+                            del self._held[lease['lot_id']]
+
+    def _run(self):
+        while not self._stop.wait(self.ttl / 3.0):
+            self.renew()
+
+    def start(self):
+        self._thread = Thread(target=self._run, name='lease-renewal')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stops renewal and releases all held leases."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        with self._lock:
+            lot_ids = list(self._held)
+        for lot_id in lot_ids:
+            self.release(lot_id)
+        self.flush()
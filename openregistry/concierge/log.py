@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from Queue import Queue, Full
+
+from openregistry.concierge.metrics import metrics
+
+_context = threading.local()
+
+_STOP = object()
+
+_FORMATTER = logging.Formatter()
+
+
+@contextmanager
+def log_context(**fields):
+    """
+    Attaches fields (e.g. lot_id, lot_type, step) to every record logged
+    by current thread within the block. Field names are upper-cased,
+    like 'MESSAGE_ID', which is already passed with 'extra'.
+    """
+    previous = getattr(_context, 'fields', {})
+    _context.fields = dict(previous, **dict((k.upper(), v) for k, v in fields.items()))
+    try:
+        yield
+    finally:
+        _context.fields = previous
+
+
+class ContextFilter(logging.Filter):
+    """Adds fields of the current 'log_context' to the record."""
+
+    def filter(self, record):
+        for key, value in getattr(_context, 'fields', {}).items():
+            if not hasattr(record, key):
+                setattr(record, key, value)
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Samples and rate-limits records by their MESSAGE_ID.
+
+    Settings for every message id:
+        every: only every n-th record is passed
+        per_second: not more than n records per second are passed
+    Records without settings are always passed.
+    """
+
+    def __init__(self, settings):
+        logging.Filter.__init__(self)
+        self.settings = settings
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._windows = {}
+
+    def filter(self, record):
+        message_id = getattr(record, 'MESSAGE_ID', None)
+        settings = self.settings.get(message_id)
+        if not settings:
+            return True
+        with self._lock:
+            count = self._counters[message_id] = self._counters.get(message_id, 0) + 1
+            passed = count % settings.get('every', 1) == 0
+            if passed and settings.get('per_second'):
+                second = int(time.time())
+                window, used = self._windows.get(message_id, (second, 0))
+                if window != second:
+                    window, used = second, 0
+                passed = used < settings['per_second']
+                self._windows[message_id] = (window, used + passed)
+        if not passed:
+            metrics.incr('logging.suppressed.{}'.format(message_id))
+        return passed
+
+
+class QueueHandler(logging.Handler):
+    """
+    Puts records to the queue without formatting them by handlers, so
+    logging call costs only filtering, merging of message with args and
+    a non-blocking put. If queue is full, record is dropped and counted
+    instead of blocking the worker.
+    """
+
+    def __init__(self, queue, handlers):
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.handlers = tuple(handlers)
+
+    def prepare(self, record):
+        """
+        Merges message with args, like QueueHandler of Python 3, so args,
+        which could be changed by the caller later, are not kept.
+        Traceback is formatted to text for the same reason.
+        """
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = _FORMATTER.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait((self.prepare(record), self.handlers))
+        except Full:
+            metrics.incr('logging.dropped')
+
+
+class QueueListener(object):
+    """
+    Background thread, which takes records from the queue and passes them
+    to the target handlers, respecting their levels.
+    """
+
+    def __init__(self, queue):
+        self.queue = queue
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._monitor, name='log-listener')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _monitor(self):
+        while True:
+            item = self.queue.get()
+            if item is _STOP:
+                break
+            record, handlers = item
+            for handler in handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+    def stop(self):
+        """Processes all queued records and stops the thread."""
+        if self._thread is not None:
+            self.queue.put(_STOP)
+            self._thread.join()
+            self._thread = None
+
+
+def setup_logging_pipeline(config):
+    """
+    Replaces handlers of root logger and of every logger from configuration
+    with QueueHandler, so records are written by background listener.
+    Handlers are kept per logger, so records reach the same handlers
+    as before.
+
+    Settings are taken from 'logging_pipeline' section of configuration:
+        queue_size: maximum number of not written records
+        sampling: settings for SamplingFilter
+
+    Returns:
+        QueueListener: started listener, which should be stopped on exit.
+    """
+    settings = config.get('logging_pipeline', {})
+    queue = Queue(settings.get('queue_size', 10000))
+    sampling = SamplingFilter(settings.get('sampling', {}))
+    context = ContextFilter()
+
+    names = set(config.get('loggers', {}).keys()) | {''}
+    for name in names:
+        logger = logging.getLogger(name or None)
+        if not logger.handlers or isinstance(logger.handlers[0], QueueHandler):
+            continue
+        handler = QueueHandler(queue, logger.handlers)
+        handler.addFilter(sampling)
+        handler.addFilter(context)
+        logger.handlers = [handler]
+
+    listener = QueueListener(queue)
+    listener.start()
+    return listener
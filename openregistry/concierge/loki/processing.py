@@ -23,10 +23,19 @@ from openprocurement_client.exceptions import (
 )
 
 from openregistry.concierge.utils import (
+    ResourceChanged,
     log_broken_lot,
     get_next_status,
+    patch_if_match,
+    patch_outcome,
     retry_on_error,
 )
+from openregistry.concierge.constants import FAILED, PROCESSED, SKIPPED
+from openregistry.concierge.auction_index import PENDING, AuctionLookupIncomplete, find_auction
+from openregistry.concierge.deadline import compensation
+from openregistry.concierge.fingerprints import FingerprintIndex, fingerprint
+from openregistry.concierge.journal import LotJournal
+from openregistry.concierge.tracing import traced
 from openregistry.concierge.loki.constants import (
     KEYS_FOR_LOKI_PATCH,
     NEXT_STATUS_CHANGE,
@@ -47,21 +56,30 @@ IS_BOT_WORKING = True
 
 class ProcessingLoki(object):
 
-    def __init__(self, config, clients, errors_doc):
+    def __init__(self, config, clients, errors_doc, journal=None):
         """
         Args:
             config: dictionary with configuration data
+            journal: LotJournal for multi-step transitions,
+                     in-memory journal is used if not passed
         """
         self.config = config
+        self.conditional_patch = config.get('conditional_patch', False)
+        fingerprints = config.get('salable_fingerprints')
+        self.salable_fingerprints = FingerprintIndex('salable_fingerprints', **fingerprints) if fingerprints else None
         self.allowed_asset_types = []
         self.handled_lot_types = []
 
         self._register_allowed_assets()
         self._register_handled_lot_types()
 
+        self.assets_mirror = None
+        self.not_found_cache = None
+        self.auction_index = None
         for key, item in clients.items():
             setattr(self, key, item)
         self.errors_doc = errors_doc
+        self.journal = journal or LotJournal()
 
     def _register_allowed_assets(self):
         for _, asset_aliases in self.config.get('assets', {}).items():
@@ -98,38 +116,73 @@ class ProcessingLoki(object):
         will be considered as broken as well and added to db document, specified
         in configuration file.
 
+        If 'salable_fingerprints' is configured, 'active.salable' lot, which
+        assets were active but auction couldn't be created, is skipped until
+        its auction statuses or set of assets are changed (or 'ttl' expires).
+
         Args:
             lot: dictionary which contains some fields of lot
                  document from db: id, rev, status, assets, lotID.
         Returns:
-            None
+            str: PROCESSED if processing of the lot was completed, SKIPPED
+                 if lot wasn't processed in its current state, FAILED if
+                 processing failed on upstream errors (and lot could be
+                 marked as broken).
         """
-        lot_available = self.check_lot(lot)
-        if not lot_available:
+        # with conditional PATCH lot check is needed only before assets are patched,
+        # if lot PATCH is the first mutating request, it fails on changed lot anyway
+        check_deferred = self.conditional_patch and lot['status'] == 'verification' and not self.journal.started(lot)
+        salable_fingerprint = None
+        if lot['status'] == 'active.salable' and self.salable_fingerprints is not None:
+            salable_fingerprint = fingerprint(sorted(lot['assets']), [(a['id'], a['status']) for a in lot['auctions']])
+            if self.salable_fingerprints.unchanged(lot['id'], salable_fingerprint):
+                logger.info("Skipping lot {}, its auctions and assets were not changed".format(lot['id']))
+                return SKIPPED
+        if not check_deferred and not self.check_lot(lot):
             logger.info("Skipping lot {}".format(lot['id']))
-            return
-        logger.info("Processing lot {} in status {}".format(lot['id'], lot['status']))
-        if lot['status'] in ['verification']:
+            return SKIPPED
+        logger.info("Processing lot %s in status %s", lot['id'], lot['status'])
+        if lot['status'] in ['verification'] and self.journal.started(lot):
+            logger.info("Resuming processing of lot {} from journal".format(lot['id']))
+            return self._add_assets_to_lot(lot)
+        elif lot['status'] in ['verification']:
             try:
                 assets_available = self.check_assets(lot)
             except RequestFailed:
                 logger.info("Due to fail in getting assets, lot {} is skipped".format(lot['id']))
+                return FAILED
             else:
                 if assets_available:
-                    self._add_assets_to_lot(lot)
+                    if check_deferred and not self.check_lot(lot):
+                        logger.info("Skipping lot {}".format(lot['id']))
+                        return SKIPPED
+                    return self._add_assets_to_lot(lot)
                 else:
-                    self.patch_lot(lot, get_next_status(NEXT_STATUS_CHANGE, 'lot', lot['status'], 'fail'))
+                    return patch_outcome(
+                        self.patch_lot(lot, get_next_status(NEXT_STATUS_CHANGE, 'lot', lot['status'], 'fail'))
+                    )
         elif lot['status'] == 'active.salable':
-            if self.check_assets(lot, 'active'):
-                is_all_auction_valid = all([a['status'] in HANDLED_AUCTION_STATUSES for a in lot['auctions']])
-                if is_all_auction_valid and self.check_previous_auction(lot):
-                    result = self._create_auction(lot)
-                    if result:
-                        auction, lot_auction_id = result
-                        data = {'auctionID': auction['data']['id'], 'status': 'active'}
-                        self._patch_auction(data, lot['id'], lot_auction_id)
+            if self.check_assets_locally(lot, 'active') is False:
+                return SKIPPED
+            is_all_auction_valid = all([a['status'] in HANDLED_AUCTION_STATUSES for a in lot['auctions']])
+            if is_all_auction_valid and self.check_previous_auction(lot):
+                # assets are checked in registry only when auction is going to be created
+                if not self.check_assets(lot, 'active'):
+                    return SKIPPED
+                result = self._create_auction(lot)
+                if not result:
+                    return FAILED
+                auction, lot_auction_id = result
+                data = {'auctionID': auction['data']['id'], 'status': 'active'}
+                self._patch_auction(data, lot['id'], lot_auction_id)
+                if self.auction_index is not None:
+                    self.auction_index.done(lot['id'], lot_auction_id)
+            elif salable_fingerprint is not None:
+                # nothing to do until auctions or assets of the lot are changed
+                self.salable_fingerprints.remember(lot['id'], salable_fingerprint)
+            return PROCESSED
         else:
-            self._process_lot_and_assets(
+            return self._process_lot_and_assets(
                 lot,
                 get_next_status(NEXT_STATUS_CHANGE, 'lot', lot['status'], 'finish'),
                 get_next_status(NEXT_STATUS_CHANGE, 'asset', lot['status'], 'finish')
@@ -153,12 +206,14 @@ class ProcessingLoki(object):
             )
         return to_patch
 
+    @traced('_post_auction', retried=True)
     @retry(stop_max_attempt_number=5, retry_on_exception=retry_on_error, wait_fixed=2000)
     def _post_auction(self, data, lot_id):
         auction = self.auction_client.create_auction(data)
         logger.info("Successfully created auction {} from lot {})".format(auction['id'], lot_id))
         return auction
 
+    @traced('_patch_auction', retried=True)
     @retry(stop_max_attempt_number=5, retry_on_exception=retry_on_error, wait_fixed=2000)
     def _patch_auction(self, data, lot_id, auction_id):
         auction = self.lots_client.patch_resource_item_subitem(
@@ -181,6 +236,18 @@ class ProcessingLoki(object):
             return False
 
     def _create_auction(self, lot):
+        """
+        Creates auction from the next scheduled auction of the lot.
+
+        If auctions index is configured, auction is not created again for
+        the same lot auction: auction created before is returned instead,
+        and if previous POST result is unknown, auction is looked up in
+        auctions feed by 'merchandisingObject'.
+
+        Returns:
+            tuple: (auction, id of the lot auction) or None if auction
+                   was not created.
+        """
         auction_from_lot = self.get_next_auction(lot)
         if not auction_from_lot:
             return
@@ -193,42 +260,72 @@ class ProcessingLoki(object):
                 parse_duration(auction_from_lot['tenderingDuration'])
             )
 
+        index = self.auction_index
+        if index is not None:
+            entry = index.get(lot['id'], auction_from_lot['id'])
+            if entry and entry['state'] == PENDING:
+                # previous POST could have been accepted
+                try:
+                    created = find_auction(self.auction_client, lot['id'],
+                                           auction_from_lot['tenderAttempts'], entry['started'])
+                except (AuctionLookupIncomplete,) + EXCEPTIONS as e:
+                    logger.error("Failed to reconcile auction from lot {} ({!r})".format(lot['id'], e))
+                    return
+                if created:
+                    index.created(lot['id'], auction_from_lot['id'], created['id'])
+                    entry = index.get(lot['id'], auction_from_lot['id'])
+            if entry and entry['state'] != PENDING:
+                logger.info("Auction {} was already created from lot {}".format(entry['auction_id'], lot['id']))
+                return {'data': {'id': entry['auction_id']}}, auction_from_lot['id']
+            if not index.pending(lot['id'], auction_from_lot['id'], auction_from_lot['tenderAttempts']):
+                return
+
         try:
             auction = self._post_auction(auction, lot['id'])
-            return auction, auction_from_lot['id']
         except EXCEPTIONS as e:
             message = 'Server error: {}'.format(e.status_code) if e.status_code >= 500 else e.message
             logger.error("Failed to create auction from lot {} ({})".format(lot['id'], message))
             return
+        if index is not None:
+            index.created(lot['id'], auction_from_lot['id'], auction['data']['id'])
+        return auction, auction_from_lot['id']
 
     def _add_assets_to_lot(self, lot):
+        """
+        Patches assets to 'pre' and 'finish' statuses and lot to 'finish'
+        status. Completed steps are recorded to journal, so if processing
+        was interrupted, assets which were already patched are skipped.
+        If lot is marked as broken, its journal entry is kept, so re-drive
+        resumes the remaining steps instead of starting over.
+
+        Returns:
+            str: outcome of processing (see 'process_lots').
+        """
+        self.journal.begin(lot)
         result, patched_assets = self.patch_assets(
             lot,
             get_next_status(NEXT_STATUS_CHANGE, 'asset', lot['status'], 'pre'),
-            lot['id']
+            lot['id'],
+            step='asset.pre'
         )
+        self.journal.flush()
         if result is False:
-            if patched_assets:
-                logger.info("Assets {} will be repatched to 'pending'".format(patched_assets))
-                result, _ = self.patch_assets({'assets': patched_assets},
-                                              get_next_status(NEXT_STATUS_CHANGE, 'asset', lot['status'], 'fail'))
-                if result is False:
-                    log_broken_lot(
-                        self.db,
-                        logger,
-                        self.errors_doc, lot,
-                        'patching assets to {}'.format(get_next_status(NEXT_STATUS_CHANGE, 'asset', lot['status'], 'pre')))
+            self._rollback_assets(
+                lot, patched_assets,
+                'patching assets to {}'.format(get_next_status(NEXT_STATUS_CHANGE, 'asset', lot['status'], 'pre'))
+            )
+            return FAILED
         else:
             result, _ = self.patch_assets(
                 lot,
                 get_next_status(NEXT_STATUS_CHANGE, 'asset', lot['status'], 'finish'),
-                lot['id']
+                lot['id'],
+                step='asset.finish'
             )
+            self.journal.flush()
             if result is False:
-                logger.info("Assets {} will be repatched to 'pending'".format(lot['assets']))
-                result, _ = self.patch_assets(lot, get_next_status(NEXT_STATUS_CHANGE, 'asset', lot['status'], 'fail'))
-                if result is False:
-                    log_broken_lot(self.db, logger, self.errors_doc, lot, 'patching assets to active')
+                self._rollback_assets(lot, lot['assets'], 'patching assets to active')
+                return FAILED
             else:
                 asset = self.assets_client.get_asset(lot['assets'][0]).data
                 asset_decision = deepcopy(asset['decisions'][0])
@@ -243,8 +340,41 @@ class ProcessingLoki(object):
                     get_next_status(NEXT_STATUS_CHANGE, 'lot', lot['status'], 'finish'),
                     to_patch
                 )
+                if result is None:
+                    # lot was changed after its assets were patched, they are detached from it
+                    if self._rollback_assets(lot, lot['assets'], 'rolling back assets of changed lot'):
+                        return SKIPPED
+                    return FAILED
                 if result is False:
-                    log_broken_lot(self.db, logger, self.errors_doc, lot, 'patching lot to active.salable')
+                    log_broken_lot(self.db, logger, self.errors_doc, dict(lot, assets_patched=True),
+                                   'patching lot to active.salable')
+                    self.journal.flush()
+                else:
+                    self.journal.finish(lot)
+                return patch_outcome(result)
+
+    def _rollback_assets(self, lot, assets, message):
+        """
+        Patches assets back to 'fail' status. Rolled back assets are
+        removed from journal. If rollback failed, lot is marked as broken
+        with 'message' and journal entry is kept for re-drive.
+
+        Returns:
+            bool: True if all assets were rolled back.
+        """
+        if assets:
+            logger.info("Assets {} will be repatched to 'pending'".format(assets))
+            with compensation():
+                result, rolled_back = self.patch_assets(
+                    {'assets': assets}, get_next_status(NEXT_STATUS_CHANGE, 'asset', lot['status'], 'fail')
+                )
+            self.journal.undo(lot, rolled_back)
+            if result is False:
+                log_broken_lot(self.db, logger, self.errors_doc, dict(lot, assets_patched=True), message)
+                self.journal.flush()
+                return False
+        self.journal.finish(lot)
+        return True
 
     def _process_lot_and_assets(self, lot, lot_status, asset_status):
         result, _ = self.patch_assets(lot, asset_status)
@@ -252,8 +382,9 @@ class ProcessingLoki(object):
             logger.info("Assets {} from lot {} will be patched to '{}'".format(lot['assets'], lot['id'], asset_status))
         else:
             logger.warning("Not valid assets {} in lot {}".format(lot['assets'], lot['id']))
-        self.patch_lot(lot, lot_status)
+        return patch_outcome(self.patch_lot(lot, lot_status))
 
+    @traced('check_lot')
     def check_lot(self, lot):
         """
         Makes GET request to openregistry by client, specified in configuration
@@ -264,13 +395,19 @@ class ProcessingLoki(object):
                  document from db: id, rev, status, assets, lotID.
         Returns:
             bool: True if request was successful and conditions were
-                  satisfied, False otherwise.
+                  satisfied, False otherwise. Lot, which wasn't found
+                  for the same revision before, isn't requested again.
         """
+        if self.not_found_cache is not None and self.not_found_cache.known('lots', lot['id'], lot):
+            logger.info('Lot {0} is not found, skipping'.format(lot['id']))
+            return False
         try:
             actual_status = self.lots_client.get_lot(lot['id']).data.status
-            logger.info('Successfully got lot {0}'.format(lot['id']))
+            logger.info('Successfully got lot %s', lot['id'], extra={'MESSAGE_ID': 'get_lot'})
         except ResourceNotFound as e:
             logger.error('Failed to get lot {0}: {1}'.format(lot['id'], e.message))
+            if self.not_found_cache is not None:
+                self.not_found_cache.add('lots', lot['id'], lot)
             return False
         except RequestFailed as e:
             logger.error('Failed to get lot {0}. Status code: {1}'.format(lot['id'], e.status_code))
@@ -284,6 +421,7 @@ class ProcessingLoki(object):
             return False
         return True
 
+    @traced('check_assets')
     def check_assets(self, lot, status='pending'):
         """
         Makes GET request to openregistry for every asset id in assets list
@@ -304,12 +442,17 @@ class ProcessingLoki(object):
             RequestFailed: if RequestFailed was raised during request.
         """
         for asset_id in lot['assets']:
+            if self.not_found_cache is not None and self.not_found_cache.known('assets', asset_id, lot):
+                logger.info('Asset {0} of lot {1} is not found, skipping'.format(asset_id, lot['id']))
+                return False
             try:
                 asset = self.assets_client.get_asset(asset_id).data
-                logger.info('Successfully got asset {}'.format(asset_id))
+                logger.info('Successfully got asset %s', asset_id, extra={'MESSAGE_ID': 'get_asset'})
             except ResourceNotFound as e:
                 logger.error('Failed to get asset {0}: {1}'.format(asset_id,
                                                                    e.message))
+                if self.not_found_cache is not None:
+                    self.not_found_cache.add('assets', asset_id, lot)
                 return False
             except RequestFailed as e:
                 logger.error('Failed to get asset {0}. Status code: {1}'.format(asset_id, e.status_code))
@@ -321,7 +464,26 @@ class ProcessingLoki(object):
                 return False
         return True
 
-    def patch_assets(self, lot, status, related_lot=None):
+    def check_assets_locally(self, lot, status='pending'):
+        """
+        Validates assets of the lot with assets mirror, without requests
+        to openregistry. As mirror could be slightly behind the registry,
+        it's used only to skip lots, decisions that lead to PATCH or POST
+        requests are confirmed by 'check_assets'.
+
+        Returns:
+            bool: validation result or None if mirror is not configured
+                  or doesn't know some of the assets.
+        """
+        if self.assets_mirror is None:
+            return
+        result = self.assets_mirror.check_assets(lot, status, self.allowed_asset_types)
+        if result is False:
+            logger.info("Assets of lot %s are not available according to assets mirror", lot['id'])
+        return result
+
+    @traced('patch_assets')
+    def patch_assets(self, lot, status, related_lot=None, step=None):
         """
         Makes PATCH request to openregistry for every asset id in assets list
         from lot object, passed as parameter, with client specified in
@@ -335,6 +497,9 @@ class ProcessingLoki(object):
             status (str): status, assets will be patching to.
             related_lot: id of the lot, which unites assets, that
                          will be patched.
+            step (str): name of journal step. If passed, assets already
+                        patched within this step are skipped and newly
+                        patched assets are recorded to journal.
 
         Returns:
             tuple: (
@@ -347,6 +512,9 @@ class ProcessingLoki(object):
         is_all_patched = True
         patch_data = {"status": status, "relatedLot": related_lot}
         for asset_id in lot['assets']:
+            if step and self.journal.completed(lot, step, asset_id):
+                patched_assets.append(asset_id)
+                continue
             try:
                 self._patch_single_asset(asset_id, patch_data)
             except EXCEPTIONS as e:
@@ -355,17 +523,21 @@ class ProcessingLoki(object):
                 logger.error("Failed to patch asset {} to {} ({})".format(asset_id, status, message))
             else:
                 patched_assets.append(asset_id)
+                if step:
+                    self.journal.record(lot, step, asset_id)
         return is_all_patched, patched_assets
 
+    @traced('_patch_single_asset', retried=True)
     @retry(stop_max_attempt_number=5, retry_on_exception=retry_on_error, wait_fixed=2000)
     def _patch_single_asset(self, asset_id, patch_data):
         self.assets_client.patch_asset(
             asset_id,
             {"data": patch_data}
         )
-        logger.info("Successfully patched asset {} to {}".format(asset_id, patch_data['status']),
+        logger.info("Successfully patched asset %s to %s", asset_id, patch_data['status'],
                     extra={'MESSAGE_ID': 'patch_asset'})
 
+    @traced('patch_lot')
     def patch_lot(self, lot, status, extras={}):
         """
         Makes PATCH request to openregistry for lot id from lot object,
@@ -376,15 +548,24 @@ class ProcessingLoki(object):
                  document from db: id, rev, status, assets, lotID.
             status (str): status, lot will be patching to.
 
+        If 'conditional_patch' is set in configuration, request is made
+        only if lot wasn't changed since revision 'rev' of the lot object.
+
         Returns:
             bool: True if request was successful and conditions were
-                  satisfied, False otherwise.
+                  satisfied, False otherwise, None if lot was changed.
         """
         try:
             patch_data = {"status": status}
             if extras:
                 patch_data.update(extras)
-            self.lots_client.patch_lot(lot['id'], {"data": patch_data})
+            if self.conditional_patch:
+                patch_if_match(self.lots_client, lot['id'], {"data": patch_data}, lot['rev'])
+            else:
+                self.lots_client.patch_lot(lot['id'], {"data": patch_data})
+        except ResourceChanged as e:
+            logger.info("Skipping patch of lot {} to {} ({})".format(lot['id'], status, e.message))
+            return
         except EXCEPTIONS as e:
             message = e.message
             if e.status_code >= 500:
@@ -392,6 +573,6 @@ class ProcessingLoki(object):
             logger.error("Failed to patch lot {} to {} ({})".format(lot['id'], status, message))
             return False
         else:
-            logger.info("Successfully patched lot {} to {}".format(lot['id'], status),
+            logger.info("Successfully patched lot %s to %s", lot['id'], status,
                         extra={'MESSAGE_ID': 'patch_lot'})
             return True
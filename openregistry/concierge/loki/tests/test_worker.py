@@ -688,6 +688,76 @@ def test_process_lots(bot, logger, mocker):
     mock_check_previous_auction.assert_called_with(active_salable_lot)
 
 
+def test_process_lots_resumes_from_journal(bot, logger, mocker):
+    mock_check_lot = mocker.patch.object(bot, 'check_lot', autospec=True)
+    mock_check_lot.return_value = True
+    mock_check_assets = mocker.patch.object(bot, 'check_assets', autospec=True)
+    mock_patch_single_asset = mocker.patch.object(bot, '_patch_single_asset', autospec=True)
+    mock_patch_lot = mocker.patch.object(bot, 'patch_lot', autospec=True)
+    mock_patch_lot.return_value = True
+
+    with open(ROOT + 'lots.json') as lots:
+        lots = load(lots)
+
+    with open(ROOT + 'assets.json') as assets:
+        assets = load(assets)
+
+    bot.assets_client.get_asset = mocker.MagicMock(return_value=munchify(assets[9]))
+
+    lot = deepcopy(lots[0]['data'])
+    lot['rev'] = '1-a'
+    asset_id = lot['assets'][0]
+
+    # worker died after patching assets to 'verification'
+    bot.journal.begin(lot)
+    bot.journal.record(lot, 'asset.pre', asset_id)
+
+    bot.process_lots(lot)
+
+    log_strings = logger.log_capture_string.getvalue().split('\n')
+    assert log_strings[0] == 'Processing lot {} in status verification'.format(lot['id'])
+    assert log_strings[1] == 'Resuming processing of lot {} from journal'.format(lot['id'])
+
+    assert mock_check_assets.call_count == 0
+    assert mock_patch_single_asset.call_count == 1
+    assert mock_patch_single_asset.call_args[0] == (asset_id, {'status': 'active', 'relatedLot': lot['id']})
+    assert mock_patch_lot.call_count == 1
+    assert mock_patch_lot.call_args[0][1] == 'pending'
+    assert bot.journal.started(lot) is False
+
+
+def test_process_lots_active_salable_with_assets_mirror(bot, logger, mocker):
+    mock_check_lot = mocker.patch.object(bot, 'check_lot', autospec=True)
+    mock_check_lot.return_value = True
+    mock_check_assets = mocker.patch.object(bot, 'check_assets', autospec=True)
+    mock_check_assets.return_value = True
+    mock_create_auction = mocker.patch.object(bot, '_create_auction', autospec=True)
+    mock_create_auction.return_value = None
+    bot.assets_mirror = mocker.MagicMock()
+
+    with open(ROOT + 'lots.json') as lots:
+        lots = load(lots)
+    lot = lots[7]['data']
+
+    bot.assets_mirror.check_assets.return_value = False
+    bot.process_lots(lot)
+    assert mock_check_assets.call_count == 0
+    assert bot.assets_mirror.check_assets.call_args[0] == (lot, 'active', bot.allowed_asset_types)
+
+    log_strings = logger.log_capture_string.getvalue().split('\n')
+    assert log_strings[1] == 'Assets of lot {} are not available according to assets mirror'.format(lot['id'])
+
+    # positive answer of mirror is confirmed by registry
+    bot.assets_mirror.check_assets.return_value = True
+    bot.process_lots(lot)
+    assert mock_check_assets.call_count == 1
+
+    # assets unknown to mirror are checked in registry
+    bot.assets_mirror.check_assets.return_value = None
+    bot.process_lots(lot)
+    assert mock_check_assets.call_count == 2
+
+
 def test_process_lots_broken(bot, logger, mocker):
 
     mock_log_broken_lot = mocker.patch('openregistry.concierge.loki.processing.log_broken_lot', autospec=True)
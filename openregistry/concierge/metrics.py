@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from threading import Lock
+
+
+class Metrics(object):
+    """
+    Thread-safe registry of counters and gauges, which describe the
+    current state of the concierge (circuit breakers, queues, caches).
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._values = {}
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self._values[name] = self._values.get(name, 0) + value
+            return self._values[name]
+
+    def set(self, name, value):
+        with self._lock:
+            self._values[name] = value
+
+    def get(self, name, default=None):
+        with self._lock:
+            return self._values.get(name, default)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+
+metrics = Metrics()
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+import logging
+import sqlite3
+import threading
+import time
+
+from openregistry.concierge.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+MIRRORED_FIELDS = ('status', 'assetType', 'relatedLot')
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS assets '
+    '(id TEXT PRIMARY KEY, status TEXT, assetType TEXT, relatedLot TEXT, dateModified TEXT)',
+    'CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)',
+)
+
+
+class AssetMirror(object):
+    """
+    Local copy of 'status', 'assetType' and 'relatedLot' of assets, which
+    follows assets changes feed of the registry and is persisted to SQLite
+    database, so after restart only new changes are fetched.
+
+    Feed is read with a separate assets client, because client keeps
+    position of the feed ('offset') in its params.
+    """
+
+    def __init__(self, client, path='assets_mirror.sqlite', interval=10, page_size=1000):
+        self.client = client
+        self.interval = interval
+        self.page_size = page_size
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        for statement in SCHEMA:
+            self.connection.execute(statement)
+        self.connection.commit()
+
+    @property
+    def offset(self):
+        with self._lock:
+            row = self.connection.execute("SELECT value FROM state WHERE key = 'offset'").fetchone()
+        return row[0] if row else ''
+
+    def get(self, asset_id):
+        """
+        Returns:
+            dict: mirrored fields of asset or None if asset is unknown.
+        """
+        with self._lock:
+            row = self.connection.execute(
+                'SELECT status, assetType, relatedLot FROM assets WHERE id = ?', (asset_id,)
+            ).fetchone()
+        if row is not None:
+            return dict(zip(MIRRORED_FIELDS, row))
+
+    def update(self, assets, offset):
+        with self._lock:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO assets (id, status, assetType, relatedLot, dateModified) VALUES (?, ?, ?, ?, ?)',
+                [(a['id'], a.get('status'), a.get('assetType'), a.get('relatedLot'), a.get('dateModified'))
+                 for a in assets]
+            )
+            self.connection.execute("INSERT OR REPLACE INTO state (key, value) VALUES ('offset', ?)", (offset,))
+            self.connection.commit()
+        metrics.incr('assets_mirror.updates', len(assets))
+
+    def sync(self):
+        """
+        Fetches pages of assets changes feed since saved offset,
+        until feed returns an empty page.
+
+        Returns:
+            int: number of received assets.
+        """
+        received = 0
+        while not self._stop.is_set():
+            offset = self.offset
+            if offset:
+                self.client.params['offset'] = offset
+            else:
+                self.client.params.pop('offset', None)
+            assets = self.client.get_assets(
+                params={'opt_fields': ','.join(MIRRORED_FIELDS), 'limit': self.page_size},
+                feed='changes'
+            )
+            if not assets:
+                break
+            self.update(assets, self.client.params.get('offset', ''))
+            received += len(assets)
+        metrics.set('assets_mirror.synced_at', time.time())
+        return received
+
+    def check_assets(self, lot, status, allowed_asset_types):
+        """
+        Validates assets of the lot the same way as 'check_assets' of lot
+        processors, but without requests to the registry.
+
+        Returns:
+            bool: validation result or None if some assets are not mirrored.
+        """
+        for asset_id in lot['assets']:
+            asset = self.get(asset_id)
+            if asset is None:
+                metrics.incr('assets_mirror.misses')
+                return None
+            if asset['assetType'] not in allowed_asset_types:
+                return False
+            related_lot_check = asset['relatedLot'] is not None and asset['relatedLot'] != lot['id']
+            if related_lot_check or asset['status'] != status:
+                return False
+        metrics.incr('assets_mirror.hits')
+        return True
+
+    def _follow(self):
+        while not self._stop.is_set():
+            try:
+                self.sync()
+            except Exception as e:
+                logger.error('Failed to sync assets mirror: {!r}'.format(e))
+            self._stop.wait(self.interval)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._follow, name='assets-mirror')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
@@ -0,0 +1,356 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import os
+import signal
+import threading
+import time
+from multiprocessing import Event, Process, Queue
+from Queue import Empty, Full
+from socket import error
+from zlib import crc32
+
+from couchdb.http import ResourceConflict
+
+from openregistry.concierge.log import setup_logging_pipeline
+from openregistry.concierge.storage import init_storage
+from openregistry.concierge.utils import couchdb_url, open_couchdb, prepare_couchdb
+
+logger = logging.getLogger(__name__)
+
+STOP = None
+
+
+def partition(lot_id, partitions):
+    """
+    Returns:
+        int: index of processor, which lot is always passed to, so the same
+             lot is never processed by two processes at the same time.
+    """
+    return (crc32(lot_id) & 0xffffffff) % partitions
+
+
+def _snapshot(doc):
+    return dict((k, json.dumps(v, sort_keys=True)) for k, v in doc.items() if not k.startswith('_'))
+
+
+class WriterStorage(object):
+    """
+    Storage of processor process, which sends changes of documents to
+    the writer process and waits for them to be saved.
+
+    Only changed and deleted keys of the document are sent, so entries,
+    written by other processors to the same document (broken lots,
+    journal, auctions index), are merged by the writer instead of
+    conflicting.
+    """
+
+    def __init__(self, index, requests, replies, timeout=30):
+        self.index = index
+        self.requests = requests
+        self.replies = replies
+        self.timeout = timeout
+        self._snapshots = {}
+        self._lock = threading.Lock()
+
+    def _call(self, *message):
+        with self._lock:
+            self.requests.put(message)
+            try:
+                status, result = self.replies.get(timeout=self.timeout)
+            except Empty:
+                raise error('Writer process did not reply in {}s'.format(self.timeout))
+        if status != 'ok':
+            raise error(result)
+        return result
+
+    def get(self, doc_id, default=None):
+        doc = self._call('get', self.index, doc_id)
+        if doc is None:
+            return default
+        self._snapshots[doc_id] = _snapshot(doc)
+        return doc
+
+    def save(self, doc):
+        snapshot = self._snapshots.get(doc['_id'], {})
+        current = _snapshot(doc)
+        changed = dict((k, doc[k]) for k, v in current.items() if snapshot.get(k) != v)
+        deleted = [k for k in snapshot if k not in current]
+        doc['_rev'] = self._call('save', self.index, doc['_id'], changed, deleted)
+        self._snapshots[doc['_id']] = current
+        return doc['_id'], doc['_rev']
+
+
+class StorageWriter(object):
+    """
+    Owner of the storage in the writer process: applies changes of
+    documents, sent by processors.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.docs = {}
+
+    def _load(self, doc_id):
+        if doc_id not in self.docs:
+            self.docs[doc_id] = self.storage.get(doc_id)
+        return self.docs[doc_id]
+
+    def get(self, doc_id):
+        return self._load(doc_id)
+
+    def save(self, doc_id, changed, deleted):
+        for attempt in range(2):
+            doc = dict(self._load(doc_id) or {'_id': doc_id})
+            doc.update(changed)
+            for key in deleted:
+                doc.pop(key, None)
+            try:
+                self.storage.save(doc)
+            except ResourceConflict:
+                if attempt:
+                    raise
+                # document was saved by another concierge, its entries are kept
+                self.docs.pop(doc_id, None)
+            else:
+                self.docs[doc_id] = doc
+                return doc['_rev']
+
+    def serve(self, requests, replies):
+        """
+        Handles requests until STOP is received.
+
+        Returns:
+            None
+        """
+        while True:
+            message = requests.get()
+            if message is STOP:
+                break
+            kind, index, args = message[0], message[1], message[2:]
+            try:
+                result = getattr(self, kind)(*args)
+            except Exception as e:
+                logger.error('Failed to {} document {}: {!r}'.format(kind, args[0], e))
+                replies[index].put(('error', repr(e)))
+            else:
+                replies[index].put(('ok', result))
+
+
+class FeedReader(object):
+    """
+    Reads lots from the feed and passes them to bounded queues of
+    processors, partitioned by lot id. Like the feed of the single
+    process worker, every pass starts from the beginning of the feed.
+    """
+
+    def __init__(self, config, db, queues, stop_event):
+        self.config = config
+        self.db = db
+        self.queues = queues
+        self.stop_event = stop_event
+        self.state = {}
+        self.lot_types = set()
+        for name in ('loki', 'basic'):
+            if config['lots'].get(name):
+                self.lot_types.update(config['lots'][name].get('aliases', []))
+
+    def put(self, lot):
+        queue = self.queues[partition(lot['id'], len(self.queues))]
+        while not self.stop_event.is_set():
+            try:
+                queue.put(lot, timeout=1)
+                return True
+            except Full:
+                continue
+        return False
+
+    def read(self):
+        """
+        Makes a single pass over the feed.
+
+        Returns:
+            int: number of lots passed to processors.
+        """
+        from openregistry.concierge.worker import lots_feed
+        dispatched = 0
+        for lot in lots_feed(self.db, self.config, self.state):
+            if self.stop_event.is_set():
+                break
+            if lot['lotType'] not in self.lot_types:
+                logger.warning('Such lotType %s is not supported by this concierge configuration' % lot['lotType'])
+                continue
+            if self.put(lot.to_dict()):
+                dispatched += 1
+        return dispatched
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                self.read()
+            except Exception as e:
+                logger.error('Failed to read lots feed: {!r}'.format(e))
+            self.stop_event.wait(self.config['time_to_sleep'])
+        for queue in self.queues:
+            try:
+                queue.put_nowait(STOP)
+            except Full:
+                pass
+
+
+def processor_config(config):
+    """
+    Returns:
+        dict: configuration of processor process. Assets mirror and
+              re-drive of broken lots are left out, as they would be run
+              by every processor for lots of all partitions.
+    """
+    return dict(config, assets_mirror=None, redrive=None)
+
+
+def _child_signals():
+    # shutdown is coordinated by the main process through the stop event
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, signal.SIG_IGN)
+
+
+def run_writer(config, requests, replies):
+    _child_signals()
+    listener = setup_logging_pipeline(config)
+    try:
+        StorageWriter(init_storage(config, open_couchdb(config))).serve(requests, replies)
+    finally:
+        listener.stop()
+
+
+def run_feed_reader(config, queues, stop_event):
+    _child_signals()
+    listener = setup_logging_pipeline(config)
+    try:
+        FeedReader(config, open_couchdb(config), queues, stop_event).run()
+    finally:
+        listener.stop()
+
+
+def run_processor(config, index, queue, requests, replies, stop_event):
+    from openregistry.concierge.worker import BotWorker
+    _child_signals()
+    listener = setup_logging_pipeline(config)
+    try:
+        worker = BotWorker(processor_config(config), storage=WriterStorage(index, requests, replies),
+                           prepare_db=False)
+        # lots are already partitioned between processes
+        worker.pipelines = {}
+        if worker.leases is not None:
+            worker.leases.start()
+        while not stop_event.is_set():
+            try:
+                lot = queue.get(timeout=1)
+            except Empty:
+                worker.process_deferred_lots()
+                worker.journal.flush()
+                continue
+            if lot is STOP:
+                break
+            worker.heartbeat = time.time()
+            worker.deferred_lots.pop(lot['id'], None)
+            worker.process_lot(lot)
+        worker.flush()
+        if worker.leases is not None:
+            worker.leases.stop()
+        if worker.tracer is not None:
+            worker.tracer.close()
+    finally:
+        listener.stop()
+
+
+class ProcessPool(object):
+    """
+    Runs concierge as separate processes: feed reader, 'workers'
+    processors and writer, connected by multiprocessing queues.
+
+    Reader passes lots to bounded queues of processors ('queue_size'
+    lots each), so it waits when processors are behind. Processors keep
+    broken lots, journal and auctions index through the writer, which is
+    the only process using the storage.
+
+    Assets mirror and background re-drive are not used in this mode,
+    broken lots could be re-driven by 'concierge_redrive --broken'.
+
+    On SIGTERM or SIGINT reader stops, processors finish lots in
+    processing within 'shutdown_timeout' seconds and are killed after
+    that, writer is stopped last, when all changes are saved.
+    """
+
+    def __init__(self, config):
+        settings = config['processes']
+        self.config = config
+        self.stop_event = Event()
+        self.stopping = False
+        self.writer_queue = Queue()
+        self.reply_queues = [Queue() for _ in range(settings['workers'])]
+        self.lot_queues = [Queue(settings.get('queue_size', 100)) for _ in range(settings['workers'])]
+        self.writer = Process(target=run_writer, name='concierge-writer',
+                              args=(config, self.writer_queue, self.reply_queues))
+        self.processors = [
+            Process(target=run_processor, name='concierge-processor-{}'.format(i),
+                    args=(config, i, self.lot_queues[i], self.writer_queue, self.reply_queues[i], self.stop_event))
+            for i in range(settings['workers'])
+        ]
+        self.reader = Process(target=run_feed_reader, name='concierge-reader',
+                              args=(config, self.lot_queues, self.stop_event))
+
+    def start(self):
+        # db is prepared once, processes only open it
+        prepare_couchdb(couchdb_url(self.config), self.config['db']['name'], logger, self.config['errors_doc'])
+        logger.info('Starting {} processor processes'.format(len(self.processors)))
+        self.writer.start()
+        for process in self.processors:
+            process.start()
+        self.reader.start()
+
+    def shutdown(self, signum=None, frame=None):
+        # stop event is not set here: handler could interrupt waiting on its lock
+        self.stopping = True
+
+    def run(self):
+        """
+        Starts processes and waits until they are stopped by signal.
+        If any process exits unexpectedly, all of them are stopped.
+
+        Returns:
+            int: exit code.
+        """
+        self.start()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self.shutdown)
+        code = 0
+        while not self.stopping:
+            time.sleep(1)
+            dead = [p for p in [self.writer, self.reader] + self.processors if not p.is_alive()]
+            if dead and not self.stopping:
+                logger.error('Process {} exited with code {}'.format(dead[0].name, dead[0].exitcode))
+                code = 1
+                self.stopping = True
+        logger.info('Stopping processes')
+        self.stop_event.set()
+        return self.join() or code
+
+    def join(self):
+        """
+        Returns:
+            int: 1 if any process was killed, 0 otherwise.
+        """
+        killed = 0
+        deadline = time.time() + self.config.get('shutdown_timeout', 30)
+        for process in [self.reader] + self.processors:
+            process.join(max(0, deadline - time.time()))
+        self.writer_queue.put(STOP)
+        self.writer.join(max(0, deadline - time.time()))
+        for process in [self.reader] + self.processors + [self.writer]:
+            if process.is_alive():
+                logger.error('Process {} was not stopped in time, killing it'.format(process.name))
+                os.kill(process.pid, signal.SIGKILL)
+                killed = 1
+        logger.info('Processes stopped')
+        return killed
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from openregistry.concierge.metrics import metrics
+
+
+class NotFoundCache(object):
+    """
+    Bounded cache of 404 responses for lots and assets, so lots, which
+    refer to deleted resources, don't repeat the same GET requests on
+    every pass of the feed.
+
+    Entry is kept for 'ttl' seconds and is bound to the revision of the
+    lot, which received 404: once the lot is changed, resources are
+    requested again. When 'max_size' entries are stored, the oldest
+    ones are evicted.
+    """
+
+    def __init__(self, max_size=10000, ttl=3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def known(self, resource, resource_id, lot):
+        """
+        Returns:
+            bool: True if the resource wasn't found for this revision of the lot.
+        """
+        key = (resource, resource_id, lot['id'])
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry[0] != lot.get('rev') or entry[1] <= time.time()):
+                del self._entries[key]
+                entry = None
+            metrics.set('not_found_cache.size', len(self._entries))
+        metrics.incr('not_found_cache.hits' if entry else 'not_found_cache.misses')
+        return entry is not None
+
+    def add(self, resource, resource_id, lot):
+        key = (resource, resource_id, lot['id'])
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (lot.get('rev'), time.time() + self.ttl)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                metrics.incr('not_found_cache.evictions')
+            metrics.set('not_found_cache.size', len(self._entries))
+
+
+def init_not_found_cache(config):
+    """
+    Returns:
+        NotFoundCache or None if 'not_found_cache' section is absent in configuration.
+    """
+    if not config.get('not_found_cache'):
+        return
+    return NotFoundCache(**config['not_found_cache'])
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from openregistry.concierge.constants import PROCESSED, SKIPPED
+from openregistry.concierge.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter(object):
+    """Spaces calls of 'wait' by 1 / 'rate' seconds between all threads."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self._lock = threading.Lock()
+        self._next = time.time()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.time()
+            at = max(now, self._next)
+            self._next = at + self.interval
+        if at > now:
+            time.sleep(at - now)
+
+
+class LotPipeline(object):
+    """
+    Queue and threads, which process lots of one lot type configuration
+    (e.g. all aliases of 'loki'), so slow processing of one lot type
+    doesn't hold lots of other types, which are next in the feed.
+
+    Feed loop only routes lots to pipelines with 'offer', which never
+    blocks: if 'queue_size' lots are already waiting, the lot is dropped
+    and is received again on the next pass of the feed. Every pipeline is
+    served by its own 'concurrency' threads, which start not more than
+    'rate' lots per second (0 - no limit), so lot types share the upstream
+    APIs in proportion to their settings.
+
+    Queued lot is replaced by its newer revision. Lot is never processed
+    by two threads at once, and revision, which was processed or skipped
+    already, isn't queued again. Revision, which processing failed or was
+    deferred, is queued again when offered.
+
+    If AdaptiveLimit is passed as 'limit', threads of all pipelines take
+    its slot for every lot, so 'concurrency' is the maximum number of
+    lots of the pipeline processed at once, and the actual number follows
+    the limit.
+    """
+
+    def __init__(self, name, worker, concurrency=1, queue_size=100, rate=0, limit=None):
+        self.name = name
+        self.worker = worker
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.rate_limiter = RateLimiter(rate)
+        self.limit = limit
+        self.pending = OrderedDict()
+        self.state = {'processed': 0, 'last_lot': None, 'processed_at': None}
+        self._active = {}
+        self._done = OrderedDict()
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._threads = []
+
+    def offer(self, lot):
+        """
+        Returns:
+            bool: False if the lot was dropped because the queue is full.
+        """
+        with self._cond:
+            lot_id = lot['id']
+            if lot['rev'] in (self._active.get(lot_id), self._done.get(lot_id)):
+                return True
+            if lot_id not in self.pending and len(self.pending) >= self.queue_size:
+                metrics.incr('pipeline.{}.dropped'.format(self.name))
+                return False
+            self.pending[lot_id] = lot
+            metrics.set('pipeline.{}.queue'.format(self.name), len(self.pending))
+            self._cond.notify()
+        return True
+
+    def _take(self):
+        with self._cond:
+            while not self._stop.is_set():
+                for lot_id in self.pending:
+                    if lot_id not in self._active:
+                        lot = self.pending.pop(lot_id)
+                        self._active[lot_id] = lot['rev']
+                        metrics.set('pipeline.{}.queue'.format(self.name), len(self.pending))
+                        return lot
+                self._cond.wait(0.5)
+
+    def _finish(self, lot, outcome):
+        with self._cond:
+            del self._active[lot['id']]
+            if outcome in (PROCESSED, SKIPPED):
+                self._done[lot['id']] = lot['rev']
+                if len(self._done) > self.queue_size * 10:
+                    self._done.popitem(last=False)
+            self.state['processed'] += 1
+            self.state['last_lot'] = lot['id']
+            self.state['processed_at'] = time.time()
+            self._cond.notify_all()
+
+    def _return(self, lot):
+        with self._cond:
+            del self._active[lot['id']]
+            # newer revision could have been queued meanwhile
+            self.pending.setdefault(lot['id'], lot)
+            self._cond.notify_all()
+
+    def _acquire_slot(self):
+        while not self._stop.is_set():
+            if self.limit.acquire(0.5):
+                return True
+        return False
+
+    def _work(self):
+        while True:
+            lot = self._take()
+            if lot is None:
+                break
+            if self.limit is not None and not self._acquire_slot():
+                self._return(lot)
+                break
+            self.rate_limiter.wait()
+            outcome = None
+            try:
+                outcome = self.worker.process_lot(lot)
+            except Exception as e:
+                logger.error('Failed to process lot {} in {} pipeline: {!r}'.format(lot['id'], self.name, e))
+            finally:
+                if self.limit is not None:
+                    self.limit.release()
+                self._finish(lot, outcome)
+
+    def status(self):
+        with self._cond:
+            return dict(self.state, queue=len(self.pending), active=len(self._active))
+
+    def start(self):
+        self._threads = [threading.Thread(target=self._work, name='{}-pipeline-{}'.format(self.name, i))
+                         for i in range(self.concurrency)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Stops taking lots from the queue, lots in processing are allowed
+        to finish. Queued lots are left for the next run.
+        """
+        self._stop.set()
+        with self._cond:
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
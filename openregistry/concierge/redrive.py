@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+import time
+from Queue import Queue, Empty
+
+from openregistry.concierge.changes import lot_from_row
+from openregistry.concierge.circuit_breaker import CircuitOpen
+from openregistry.concierge.constants import BROKEN, DEFERRED, FAILED, MANUAL, PROCESSED
+from openregistry.concierge.log import log_context
+from openregistry.concierge.metrics import metrics
+from openregistry.concierge.utils import BROKEN_LOTS_LOCK, update_broken_lot
+
+logger = logging.getLogger(__name__)
+
+
+def process_broken_lot(worker, processing, lot):
+    """
+    Processes the lot, which could be marked as broken before. If 'leases'
+    are configured, lot is processed only if its lease was acquired, lease
+    is released afterwards.
+
+    Lot, which was marked as broken after its assets were patched, is
+    processed only if its transition could be resumed from journal:
+    starting over would patch the lot to its fail status and leave the
+    assets attached to it.
+
+    Returns:
+        str: outcome of processing, returned by processor (PROCESSED,
+             SKIPPED or FAILED), BROKEN if lot was marked as broken
+             by processing, DEFERRED if lot is processed by another
+             thread or node or processing was interrupted by open
+             circuit breaker, MANUAL if lot is left for a human.
+    """
+    record = worker.errors_doc.get(lot['id'])
+    if record and not record.get('resolved', True) and record.get('assets_patched') \
+            and not processing.journal.started(lot):
+        logger.warning("Transition of lot {} can't be resumed, it's left for manual handling".format(lot['id']))
+        return MANUAL
+    leases = worker.leases
+    # lease held by this node belongs to lot, processed by the main loop
+    if leases is not None and (leases.held(lot['id']) or not leases.acquire([lot])):
+        logger.info('Lot {} is being processed, deferring it'.format(lot['id']))
+        return DEFERRED
+    record = worker.errors_doc.get(lot['id'])
+    try:
+        outcome = processing.process_lots(lot)
+    except CircuitOpen as e:
+        logger.warning('Processing of lot {} interrupted, {}'.format(lot['id'], e.message))
+        return DEFERRED
+    finally:
+        if leases is not None:
+            leases.release(lot['id'])
+    # failed processing replaces the record by a new one
+    if worker.errors_doc.get(lot['id']) is not record:
+        return BROKEN
+    return outcome
+
+
+class RedriveScheduler(object):
+    """
+    Retries lots marked as broken in background, so transient failures
+    don't need the lot to be touched by a human.
+
+    Every 'interval' seconds unresolved broken lots are scanned, and lots,
+    which time has come, are passed to 'concurrency' re-drive threads.
+    Attempt n is made 'base_delay' * 2 ** n seconds (up to 'max_delay')
+    after the previous one. Number of attempts is saved to the broken lot
+    record as 'redrive_attempts', after 'max_attempts' lot is left for
+    a human.
+
+    Only lots, which have not been changed since they were marked as broken,
+    are re-driven, changed lots are handled by the main loop. Record is
+    resolved only if processing was completed, skipped lots and lots
+    interrupted by open circuit breaker are rescheduled. Lots, which
+    can't be resumed (see 'process_broken_lot'), are left for a human.
+    """
+
+    def __init__(self, worker, interval=30, base_delay=60, max_delay=3600, max_attempts=5, concurrency=2):
+        self.worker = worker
+        self.interval = interval
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.concurrency = concurrency
+        self.queue = Queue()
+        self.schedule = {}
+        self._queued = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads = []
+
+    def delay(self, attempts):
+        return min(self.max_delay, self.base_delay * 2 ** attempts)
+
+    def due_lots(self, now=None):
+        """
+        Returns:
+            list: ids of unresolved broken lots, which should be re-driven now.
+        """
+        now = now or time.time()
+        due = []
+        with BROKEN_LOTS_LOCK:
+            records = [(k, v) for k, v in self.worker.errors_doc.items()
+                       if not k.startswith('_') and isinstance(v, dict)]
+        for lot_id, record in records:
+            if record.get('resolved', True) or record.get('redrive_attempts', 0) >= self.max_attempts:
+                self.schedule.pop(lot_id, None)
+                continue
+            if lot_id not in self.schedule:
+                self.schedule[lot_id] = now + self.delay(record.get('redrive_attempts', 0))
+            if self.schedule[lot_id] <= now:
+                due.append(lot_id)
+        metrics.set('redrive.scheduled', len(self.schedule))
+        return due
+
+    def enqueue_due(self):
+        for lot_id in self.due_lots():
+            with self._lock:
+                if lot_id in self._queued:
+                    continue
+                self._queued.add(lot_id)
+            self.queue.put(lot_id)
+        metrics.set('redrive.queue', self.queue.qsize())
+
+    def redrive(self, lot_id):
+        """
+        Processes current version of the broken lot from db.
+
+        Returns:
+            bool: True if processing of lot was completed, False if it
+                  failed, None if lot wasn't re-driven or was skipped.
+        """
+        record = self.worker.errors_doc.get(lot_id)
+        doc = self.worker.db.get(lot_id)
+        if not record or record.get('resolved', True) or doc is None:
+            self.schedule.pop(lot_id, None)
+            return
+        if doc['_rev'] != record.get('rev'):
+            # lot was changed, it's up to the main loop
+            self.schedule.pop(lot_id, None)
+            return
+        lot = lot_from_row({'doc': doc})
+        processing = self.worker.lot_type_processing_configurator.get(lot['lotType'])
+        if processing is None or not self.worker.upstreams_available(lot):
+            self.schedule[lot_id] = time.time() + self.base_delay
+            return
+        attempts = record.get('redrive_attempts', 0) + 1
+        logger.info('Re-driving broken lot {} (attempt {} of {})'.format(lot_id, attempts, self.max_attempts))
+        self.worker._track_in_flight(1)
+        try:
+            with log_context(lot_id=lot_id, lot_type=lot['lotType'], step=lot['status'], redrive=attempts):
+                outcome = process_broken_lot(self.worker, processing, lot)
+        finally:
+            self.worker._track_in_flight(-1)
+        if outcome == PROCESSED:
+            update_broken_lot(self.worker.storage, logger, self.worker.errors_doc, lot_id,
+                              resolved=True, redrive_attempts=attempts)
+            self.schedule.pop(lot_id, None)
+            metrics.incr('redrive.succeeded')
+            logger.info('Broken lot {} re-driven successfully'.format(lot_id))
+            return True
+        if outcome == MANUAL:
+            # no more attempts are scheduled
+            update_broken_lot(self.worker.storage, logger, self.worker.errors_doc, lot_id,
+                              redrive_attempts=self.max_attempts)
+            self.schedule.pop(lot_id, None)
+            metrics.incr('redrive.manual')
+            return False
+        if outcome in (FAILED, BROKEN):
+            update_broken_lot(self.worker.storage, logger, self.worker.errors_doc, lot_id, redrive_attempts=attempts)
+            self.schedule[lot_id] = time.time() + self.delay(attempts)
+            metrics.incr('redrive.failed')
+            if attempts >= self.max_attempts:
+                logger.warning('Broken lot {} is left after {} re-drive attempts'.format(lot_id, attempts))
+            return False
+        # skipped or deferred lot isn't resolved, attempt isn't counted
+        logger.info('Re-drive of lot {} was {}, rescheduling'.format(lot_id, outcome))
+        self.schedule[lot_id] = time.time() + self.delay(attempts - 1)
+        metrics.incr('redrive.rescheduled')
+
+    def _work(self):
+        while not self._stop.is_set():
+            try:
+                lot_id = self.queue.get(timeout=0.5)
+            except Empty:
+                continue
+            try:
+                self.redrive(lot_id)
+            except Exception as e:
+                logger.error('Failed to re-drive lot {}: {!r}'.format(lot_id, e))
+                self.schedule[lot_id] = time.time() + self.base_delay
+            finally:
+                with self._lock:
+                    self._queued.discard(lot_id)
+                metrics.set('redrive.queue', self.queue.qsize())
+
+    def _scan(self):
+        while not self._stop.is_set():
+            try:
+                self.enqueue_due()
+            except Exception as e:
+                logger.error('Failed to schedule broken lots: {!r}'.format(e))
+            self._stop.wait(self.interval)
+
+    def start(self):
+        self._threads = [threading.Thread(target=self._scan, name='redrive-scheduler')]
+        self._threads += [threading.Thread(target=self._work, name='redrive-{}'.format(i))
+                          for i in range(self.concurrency)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def stop(self, timeout=None):
+        """Stops scheduling, re-drives in progress are allowed to finish."""
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout)
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import time
+from uuid import uuid4
+
+from munch import munchify
+from openprocurement_client.exceptions import ResourceNotFound
+
+from openregistry.concierge.journal import LotJournal
+from openregistry.concierge.not_found import init_not_found_cache
+from openregistry.concierge.loki.processing import ProcessingLoki
+from openregistry.concierge.basic.processing import ProcessingBasic
+
+logger = logging.getLogger(__name__)
+
+STAND_IN_ASSET_STATUSES = {
+    'verification': 'pending',
+    'active.salable': 'active',
+}
+
+
+def read_changes(path):
+    """
+    Streams lot changes from JSON-lines dump. Every line is an object in
+    the same shape as items of 'continuous_changes_feed'. File is read line
+    by line, so memory usage does not depend on the size of the dump.
+
+    Returns:
+        generator: Generator object with lots.
+    """
+    with open(path) as changes:
+        for line in changes:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def read_responses(path):
+    """
+    Reads recorded API responses from JSON-lines file, where every line is
+    {"resource": "lots"|"assets"|"auctions", "id": ..., "data": {...}}.
+
+    Returns:
+        dict: (resource, id) -> response data
+    """
+    responses = {}
+    for response in read_changes(path):
+        responses[(response['resource'], response['id'])] = response['data']
+    return responses
+
+
+class ReplayClient(object):
+    """
+    Stand-in API client. GET requests are answered by the replayer with
+    recorded or stand-in responses, all other calls (PATCH, POST) are not
+    sent anywhere but recorded as decisions of the concierge.
+    """
+
+    def __init__(self, replayer, resource):
+        self._replayer = replayer
+        self._resource = resource
+
+    def __getattr__(self, name):
+        def call(*args, **kwargs):
+            if name.startswith('get_'):
+                return self._replayer.get(self._resource, args[0])
+            return self._replayer.record(self._resource, name, args, kwargs)
+        return call
+
+
+class ReplayDB(object):
+    """
+    Stand-in for concierge db, which records writes (e.g. broken lots)
+    as decisions.
+    """
+
+    def __init__(self, replayer):
+        self._replayer = replayer
+
+    def get(self, doc_id, default=None):
+        return default
+
+    def save(self, doc):
+        self._replayer.record('db', 'save', (doc.get('_id'),), {})
+
+
+class Replayer(object):
+
+    def __init__(self, config, responses=None):
+        """
+        Args:
+            config: dictionary with configuration data
+            responses: recorded API responses, see 'read_responses'
+        """
+        self.config = config
+        self.responses = responses or {}
+        self.lot_type_processing_configurator = {}
+        self.current_lot = None
+        self.decisions = []
+
+        clients = {
+            'lots_client': ReplayClient(self, 'lots'),
+            'assets_client': ReplayClient(self, 'assets'),
+            'auction_client': ReplayClient(self, 'auctions'),
+            'db': ReplayDB(self),
+            'not_found_cache': init_not_found_cache(config),
+        }
+        if config['lots'].get('loki'):
+            self._register_aliases(ProcessingLoki(config['lots']['loki'], clients, {}, LotJournal()))
+        if config['lots'].get('basic'):
+            self._register_aliases(ProcessingBasic(config['lots']['basic'], clients, {}, LotJournal()))
+
+    def _register_aliases(self, processing):
+        for lt in processing.handled_lot_types:
+            self.lot_type_processing_configurator[lt] = processing
+
+    def get(self, resource, resource_id):
+        data = self.responses.get((resource, resource_id))
+        if data is None:
+            data = self._stand_in(resource, resource_id)
+        return munchify({'data': data})
+
+    def _stand_in(self, resource, resource_id):
+        lot = self.current_lot
+        if resource == 'lots' and resource_id == lot['id']:
+            return lot
+        if resource == 'assets' and resource_id in lot['assets']:
+            processing = self.lot_type_processing_configurator[lot['lotType']]
+            return {
+                'id': resource_id,
+                'status': STAND_IN_ASSET_STATUSES.get(lot['status'], lot['status']),
+                'assetType': processing.allowed_asset_types[0],
+                'relatedLot': lot['id'],
+                'decisions': [{}],
+            }
+        raise ResourceNotFound(munchify({'text': 'No recorded response for {} {}'.format(resource, resource_id),
+                                         'status_code': 404}))
+
+    def record(self, resource, action, args, kwargs):
+        self.decisions.append({'resource': resource, 'action': action, 'args': list(args), 'kwargs': kwargs})
+        if action == 'create_auction':
+            auction_id = uuid4().hex
+            return munchify({'id': auction_id, 'data': {'id': auction_id}})
+        return munchify({'data': {}})
+
+    def replay(self, changes, report=None):
+        """
+        Passes every lot from 'changes' through the processor of its lotType
+        and writes decisions and timing of every lot to 'report' as JSON lines.
+
+        Returns:
+            dict: summary with number of lots, decisions and timings.
+        """
+        summary = {
+            'lots': 0, 'skipped': 0, 'errors': 0, 'decisions': 0,
+            'duration': 0.0, 'max_duration': 0.0, 'by_status': {}
+        }
+        started = time.time()
+        for lot in changes:
+            processing = self.lot_type_processing_configurator.get(lot['lotType'])
+            if processing is None:
+                summary['skipped'] += 1
+                continue
+            self.current_lot = lot
+            self.decisions = []
+            error = None
+            lot_started = time.time()
+            try:
+                processing.process_lots(lot)
+            except Exception as e:
+                logger.error('Failed to replay lot {}: {!r}'.format(lot['id'], e))
+                summary['errors'] += 1
+                error = repr(e)
+            duration = time.time() - lot_started
+
+            summary['lots'] += 1
+            summary['decisions'] += len(self.decisions)
+            summary['max_duration'] = max(summary['max_duration'], duration)
+            by_status = summary['by_status'].setdefault(lot['status'], {'lots': 0, 'duration': 0.0})
+            by_status['lots'] += 1
+            by_status['duration'] += duration
+            if report is not None:
+                report.write(json.dumps({
+                    'id': lot['id'],
+                    'status': lot['status'],
+                    'lotType': lot['lotType'],
+                    'decisions': self.decisions,
+                    'error': error,
+                    'duration': duration,
+                }, default=str) + '\n')
+        summary['duration'] = time.time() - started
+        logger.info('Replayed {lots} lots ({skipped} skipped, {errors} failed) in {duration:.3f}s, '
+                    'decisions: {decisions}, slowest lot: {max_duration:.6f}s'.format(**summary))
+        return summary
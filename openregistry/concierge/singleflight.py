@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+from copy import deepcopy
+from threading import Event, Lock
+
+from openregistry.concierge.metrics import metrics
+
+
+class _Call(object):
+    __slots__ = ('done', 'result', 'error', 'waiters')
+
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight(object):
+    """
+    Merges identical calls, made while the first of them is in flight,
+    into that call: followers wait for its result instead of calling
+    upstream themselves. Every caller receives own copy of the result or
+    the exception the call raised.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}
+        self._lock = Lock()
+
+    def do(self, key, func, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                call.waiters += 1
+        if not leader:
+            call.done.wait()
+            metrics.incr('singleflight.{}.coalesced'.format(self.name))
+            if call.error is not None:
+                raise call.error
+            return deepcopy(call.result)
+        try:
+            call.result = func(*args, **kwargs)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+                shared = call.waiters
+            call.done.set()
+        # followers copy the result, so it must stay untouched by the leader's caller
+        return deepcopy(call.result) if shared else call.result
+
+
+class SingleFlightClient(object):
+    """
+    Proxy around API client, which passes calls of 'get_*' methods
+    with the same arguments through SingleFlight. Other calls go
+    directly to the client.
+    """
+
+    def __init__(self, client, name):
+        self._client = client
+        self._flight = SingleFlight(name)
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not name.startswith('get_') or not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            key = (name, args, tuple(sorted(kwargs.items())))
+            try:
+                hash(key)
+            except TypeError:
+                return attr(*args, **kwargs)
+            return self._flight.do(key, attr, *args, **kwargs)
+        return call
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+import json
+import sqlite3
+import threading
+import uuid
+
+from couchdb.http import ResourceConflict
+
+from openregistry.concierge.utils import ConfigError
+
+SCHEMA = 'CREATE TABLE IF NOT EXISTS docs (id TEXT PRIMARY KEY, rev TEXT, body TEXT)'
+
+
+def next_rev(rev):
+    number = int(rev.split('-')[0]) if rev else 0
+    return '{}-{}'.format(number + 1, uuid.uuid4().hex)
+
+
+class MemoryStorage(object):
+    """
+    Storage of concierge's own documents (broken lots, journal) in memory.
+
+    Storage backends implement the part of couchdb.Database interface,
+    used for these documents: 'get' and 'save' with revision check.
+    """
+
+    def __init__(self):
+        # docs are kept serialized, like in other backends
+        self._docs = {}
+        self._lock = threading.Lock()
+
+    def get(self, doc_id, default=None):
+        with self._lock:
+            doc = self._docs.get(doc_id)
+        return json.loads(doc) if doc is not None else default
+
+    def save(self, doc):
+        with self._lock:
+            stored = self._docs.get(doc['_id'])
+            if stored is not None and json.loads(stored)['_rev'] != doc.get('_rev'):
+                raise ResourceConflict(('conflict', 'Document update conflict.'))
+            rev = next_rev(doc.get('_rev'))
+            self._docs[doc['_id']] = json.dumps(dict(doc, _rev=rev))
+            doc['_rev'] = rev
+        return doc['_id'], doc['_rev']
+
+
+class SQLiteStorage(object):
+    """
+    Storage of concierge's own documents in SQLite database in WAL mode,
+    so bookkeeping writes don't go to the shared CouchDB.
+    """
+
+    def __init__(self, path='concierge_state.sqlite'):
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(SCHEMA)
+        self.connection.commit()
+
+    def get(self, doc_id, default=None):
+        with self._lock:
+            row = self.connection.execute('SELECT body FROM docs WHERE id = ?', (doc_id,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def save(self, doc):
+        with self._lock:
+            row = self.connection.execute('SELECT rev FROM docs WHERE id = ?', (doc['_id'],)).fetchone()
+            if row is not None and row[0] != doc.get('_rev'):
+                raise ResourceConflict(('conflict', 'Document update conflict.'))
+            rev = next_rev(doc.get('_rev'))
+            body = json.dumps(dict(doc, _rev=rev))
+            self.connection.execute('INSERT OR REPLACE INTO docs (id, rev, body) VALUES (?, ?, ?)',
+                                    (doc['_id'], rev, body))
+            self.connection.commit()
+        doc['_rev'] = rev
+        return doc['_id'], rev
+
+
+def init_storage(config, db):
+    """
+    Creates storage of concierge's own documents, specified in 'storage'
+    section of configuration:
+        backend: 'couchdb' (default, lots db is used), 'sqlite' or 'memory'
+        path: path to SQLite database
+
+    Returns:
+        storage object with 'get' and 'save' methods.
+    """
+    settings = config.get('storage') or {}
+    backend = settings.get('backend', 'couchdb')
+    if backend == 'couchdb':
+        return db
+    if backend == 'sqlite':
+        return SQLiteStorage(settings.get('path', 'concierge_state.sqlite'))
+    if backend == 'memory':
+        return MemoryStorage()
+    raise ConfigError('Unknown storage backend: {}'.format(backend))
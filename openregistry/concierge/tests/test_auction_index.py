@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+import os
+from json import load
+from socket import error
+
+import pytest
+from munch import munchify
+from requests.exceptions import Timeout
+
+from openregistry.concierge.auction_index import (
+    CREATED,
+    DONE,
+    PENDING,
+    AuctionIndex,
+    AuctionLookupIncomplete,
+    find_auction
+)
+from openregistry.concierge.loki.processing import ProcessingLoki
+from openregistry.concierge.storage import MemoryStorage
+from openregistry.concierge.tests.conftest import TEST_CONFIG
+
+ROOT = os.path.dirname(os.path.dirname(__file__)) + '/loki/tests/data/'
+
+
+def feed_page(auctions, next_uri='next'):
+    return munchify({'data': auctions, 'next_page': {'uri': next_uri}})
+
+
+def test_index(mocker):
+    storage = MemoryStorage()
+    index = AuctionIndex(storage, retention=10)
+
+    assert index.pending('lot_1', 'a1', 1) is True
+    entry = index.get('lot_1', 'a1')
+    assert (entry['state'], entry['auction_id'], entry['tender_attempts']) == (PENDING, None, 1)
+    assert index.created('lot_1', 'a1', 'auction_1') is True
+    assert index.get('lot_1', 'a1')['state'] == CREATED
+
+    # index survives restart
+    index = AuctionIndex(storage, retention=10)
+    assert index.get('lot_1', 'a1')['auction_id'] == 'auction_1'
+    index.done('lot_1', 'a1')
+    assert index.get('lot_1', 'a1')['state'] == DONE
+
+    time = mocker.patch('openregistry.concierge.auction_index.time')
+    time.time.return_value = storage.get('auctions_index')['lot_1/a1']['updated'] + 11
+    index.pending('lot_2', 'a1', 1)
+    assert index.get('lot_1', 'a1') is None
+    assert sorted(k for k in storage.get('auctions_index') if not k.startswith('_')) == ['lot_2/a1']
+
+
+def test_index_save(mocker):
+    storage = MemoryStorage()
+    index = AuctionIndex(storage)
+    other = AuctionIndex(storage)
+    index.pending('lot_1', 'a1', 1)
+
+    # conflicting save keeps entries of both instances
+    assert other.pending('lot_2', 'a1', 1) is True
+    assert sorted(k for k in storage.get('auctions_index') if not k.startswith('_')) == ['lot_1/a1', 'lot_2/a1']
+
+    # entries changed or purged by another instance are not overwritten
+    index.created('lot_1', 'a1', 'auction_1')
+    time = mocker.patch('openregistry.concierge.auction_index.time')
+    time.time.return_value = 1000
+    other.pending('lot_4', 'a1', 1)
+    other.done('lot_4', 'a1')
+    time.time.return_value = 1011
+    index = AuctionIndex(storage, retention=10)
+    index.pending('lot_5', 'a1', 1)
+    assert 'lot_4/a1' not in storage.get('auctions_index')
+    assert other.pending('lot_6', 'a1', 1) is True
+    stored = storage.get('auctions_index')
+    assert stored['lot_1/a1']['state'] == CREATED
+    assert 'lot_4/a1' not in stored
+    assert sorted(k for k in stored if not k.startswith('_')) == ['lot_1/a1', 'lot_2/a1', 'lot_5/a1', 'lot_6/a1']
+
+    storage.save = mocker.MagicMock(side_effect=error)
+    assert index.pending('lot_3', 'a1', 1) is False
+    assert index.get('lot_3', 'a1') is None
+    assert index.created('lot_1', 'a1', 'auction_4') is False
+    assert index.get('lot_1', 'a1')['auction_id'] == 'auction_1'
+
+
+def test_find_auction(mocker):
+    client = mocker.MagicMock()
+    client.prefix_path = 'http://api/api/2.5/auctions'
+    client._get_resource_item.side_effect = [
+        feed_page([{'id': 'x', 'merchandisingObject': 'lot_2', 'tenderAttempts': 1,
+                    'dateModified': '2018-01-01T12:05:00+02:00'}]),
+        feed_page([{'id': 'y', 'merchandisingObject': 'lot_1', 'tenderAttempts': 2,
+                    'dateModified': '2018-01-01T12:04:00+02:00'},
+                   {'id': 'z', 'merchandisingObject': 'lot_1', 'tenderAttempts': 1,
+                    'dateModified': '2018-01-01T12:03:00+02:00'}]),
+    ]
+    assert find_auction(client, 'lot_1', 1, '2018-01-01T10:00:00+00:00')['id'] == 'z'
+    url = client._get_resource_item.call_args_list[0][0][0]
+    assert url.startswith('http://api/api/2.5/auctions?descending=1')
+    assert client._get_resource_item.call_args_list[1][0][0] == 'next'
+
+    client._get_resource_item.side_effect = [feed_page([
+        {'id': 'x', 'merchandisingObject': 'lot_2', 'tenderAttempts': 1, 'dateModified': '2018-01-01T12:05:00+02:00'},
+        {'id': 'z', 'merchandisingObject': 'lot_1', 'tenderAttempts': 1, 'dateModified': '2018-01-01T11:59:00+02:00'},
+    ])]
+    assert find_auction(client, 'lot_1', 1, '2018-01-01T10:00:00+00:00') is None
+
+    client._get_resource_item.side_effect = [feed_page([])]
+    assert find_auction(client, 'lot_1', 1, '2018-01-01T10:00:00+00:00') is None
+
+    client._get_resource_item.side_effect = [feed_page([
+        {'id': 'x', 'merchandisingObject': 'lot_2', 'tenderAttempts': 1, 'dateModified': '2018-01-01T12:05:00+02:00'}
+    ])] * 2
+    with pytest.raises(AuctionLookupIncomplete):
+        find_auction(client, 'lot_1', 1, '2018-01-01T10:00:00+00:00', max_pages=2)
+
+
+def test_create_auction_is_idempotent(mocker):
+    with open(ROOT + 'lots.json') as lots:
+        lot = load(lots)[7]['data']
+    lot_auction = [a for a in lot['auctions'] if a['status'] == 'scheduled'][0]
+    auction_client = mocker.MagicMock()
+    clients = {'lots_client': mocker.MagicMock(), 'assets_client': mocker.MagicMock(), 'db': mocker.MagicMock(),
+               'auction_client': auction_client, 'auction_index': AuctionIndex(MemoryStorage())}
+    processing = ProcessingLoki(TEST_CONFIG['lots']['loki'], clients, {})
+
+    # POST timed out, but auction could have been created
+    auction_client.create_auction.side_effect = Timeout()
+    with pytest.raises(Timeout):
+        processing._create_auction(lot)
+    assert auction_client.create_auction.call_count == 1
+
+    # lookup fails, POST is not retried blindly
+    auction_client._get_resource_item.side_effect = AuctionLookupIncomplete()
+    assert processing._create_auction(lot) is None
+    assert auction_client.create_auction.call_count == 1
+
+    # auction is found by merchandisingObject
+    auction_client._get_resource_item.side_effect = None
+    auction_client._get_resource_item.return_value = feed_page([
+        {'id': 'auction_1', 'merchandisingObject': lot['id'], 'tenderAttempts': lot_auction['tenderAttempts'],
+         'dateModified': '2100-01-01T00:00:00+02:00'}
+    ])
+    assert processing._create_auction(lot) == ({'data': {'id': 'auction_1'}}, lot_auction['id'])
+    assert processing._create_auction(lot) == ({'data': {'id': 'auction_1'}}, lot_auction['id'])
+    assert auction_client.create_auction.call_count == 1
+    assert auction_client._get_resource_item.call_count == 2
+
+
+def test_create_auction_after_failed_post(mocker):
+    with open(ROOT + 'lots.json') as lots:
+        lot = load(lots)[7]['data']
+    lot_auction = [a for a in lot['auctions'] if a['status'] == 'scheduled'][0]
+    auction_client = mocker.MagicMock()
+    index = AuctionIndex(MemoryStorage())
+    clients = {'lots_client': mocker.MagicMock(), 'assets_client': mocker.MagicMock(), 'db': mocker.MagicMock(),
+               'auction_client': auction_client, 'auction_index': index}
+    processing = ProcessingLoki(TEST_CONFIG['lots']['loki'], clients, {})
+    mocker.patch.object(processing, '_post_auction', side_effect=[Timeout(), {'data': {'id': 'auction_2'}}])
+
+    with pytest.raises(Timeout):
+        processing._create_auction(lot)
+    # auction wasn't created, so it's POSTed again
+    auction_client._get_resource_item.return_value = feed_page([
+        {'id': 'x', 'merchandisingObject': 'other', 'tenderAttempts': 1, 'dateModified': '2000-01-01T00:00:00+02:00'}
+    ])
+    assert processing._create_auction(lot) == ({'data': {'id': 'auction_2'}}, lot_auction['id'])
+    assert index.get(lot['id'], lot_auction['id'])['state'] == CREATED
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+import time
+from StringIO import StringIO
+
+from openregistry.concierge.bulk import (
+    ERROR,
+    MISSING,
+    UNSUPPORTED,
+    BulkRedrive,
+    RateLimiter,
+    ids_from_broken_lots,
+    ids_from_file,
+    ids_from_statuses
+)
+from openregistry.concierge.circuit_breaker import CircuitOpen
+from openregistry.concierge.constants import BROKEN, DEFERRED, FAILED, MANUAL, PROCESSED, SKIPPED
+from openregistry.concierge.utils import log_broken_lot
+
+
+def lot_doc(lot_id, status='verification', lot_type='basic'):
+    return {'_id': lot_id, '_rev': '2-a', 'status': status, 'assets': ['asset_1'],
+            'lotID': 'UA-1', 'lotType': lot_type}
+
+
+def make_worker(mocker, docs, records=None):
+    worker = mocker.MagicMock()
+    worker.errors_doc = dict(records or {}, _id='broken_lots', _rev='1-a')
+    worker.db.get.side_effect = lambda lot_id: docs.get(lot_id)
+    worker.upstreams_available.return_value = True
+    worker.leases = None
+    processing = mocker.MagicMock()
+    worker.lot_type_processing_configurator = {'basic': processing}
+    return worker, processing
+
+
+def test_ids_sources(mocker, tmpdir):
+    path = tmpdir.join('ids.txt')
+    path.write('lot_1\n\n# comment\n lot_2 \n')
+    assert list(ids_from_file(str(path))) == ['lot_1', 'lot_2']
+
+    assert sorted(ids_from_broken_lots({
+        '_id': 'broken_lots', 'lot_1': {'resolved': False}, 'lot_2': {'resolved': True}, 'lot_3': {'resolved': False}
+    })) == ['lot_1', 'lot_3']
+
+    db = mocker.MagicMock()
+    db.changes.side_effect = [iter([
+        {'seq': 1, 'doc': lot_doc('lot_1')},
+        {'seq': 2, 'doc': {'_id': '_design/lots'}},
+        {'seq': 3, 'doc': lot_doc('lot_3', 'active.salable')},
+        {'seq': 4, 'deleted': True, 'doc': {'_id': 'lot_4', '_deleted': True}},
+        {'last_seq': 4}
+    ]), iter([{'last_seq': 4}])]
+    assert list(ids_from_statuses(db, ['verification', 'pending.sold'], page_size=4)) == ['lot_1']
+    assert 'filter' not in db.changes.call_args_list[0][1]
+    assert db.changes.call_args_list[1][1]['since'] == 4
+
+
+def test_redrive_outcomes(mocker):
+    docs = {lot_id: lot_doc(lot_id) for lot_id in ('ok', 'broken', 'resolved', 'open', 'unavailable',
+                                                     'skipped', 'failed')}
+    docs['loki'] = lot_doc('loki', lot_type='loki')
+    worker, processing = make_worker(mocker, docs, {
+        'resolved': {'rev': '1-a', 'resolved': False},
+        'skipped': {'rev': '1-a', 'resolved': False},
+        'failed': {'rev': '1-a', 'resolved': False},
+    })
+
+    def process_lots(lot):
+        if lot['id'] == 'broken':
+            log_broken_lot(worker.storage, mocker.MagicMock(), worker.errors_doc, lot, 'patching assets to active')
+            return FAILED
+        elif lot['id'] == 'open':
+            raise CircuitOpen('assets')
+        elif lot['id'] in ('skipped', 'failed'):
+            return {'skipped': SKIPPED, 'failed': FAILED}[lot['id']]
+        return PROCESSED
+    processing.process_lots.side_effect = process_lots
+    bulk = BulkRedrive(worker)
+
+    assert bulk.redrive('ok') == PROCESSED
+    assert bulk.redrive('broken') == BROKEN
+    assert bulk.redrive('resolved') == PROCESSED
+    assert worker.errors_doc['resolved']['resolved'] is True
+    assert bulk.redrive('skipped') == SKIPPED
+    assert bulk.redrive('failed') == FAILED
+    assert worker.errors_doc['skipped']['resolved'] is False
+    assert worker.errors_doc['failed']['resolved'] is False
+    assert bulk.redrive('open') == DEFERRED
+    assert bulk.redrive('missing') == MISSING
+    assert bulk.redrive('loki') == UNSUPPORTED
+    worker.upstreams_available.return_value = False
+    assert bulk.redrive('unavailable') == DEFERRED
+
+
+def test_redrive_leaves_unresumable_lot(mocker):
+    worker, processing = make_worker(mocker, {'half_done': lot_doc('half_done')}, {
+        'half_done': {'rev': '2-a', 'resolved': False, 'assets_patched': True}
+    })
+    processing.journal.started.return_value = False
+    bulk = BulkRedrive(worker)
+
+    assert bulk.redrive('half_done') == MANUAL
+    assert processing.process_lots.call_count == 0
+    assert worker.errors_doc['half_done']['resolved'] is False
+
+    # transition is resumed from journal
+    processing.journal.started.return_value = True
+    processing.process_lots.return_value = PROCESSED
+    assert bulk.redrive('half_done') == PROCESSED
+    assert worker.errors_doc['half_done']['resolved'] is True
+
+
+def test_run(mocker):
+    docs = {'lot_{}'.format(i): lot_doc('lot_{}'.format(i)) for i in range(50)}
+    worker, processing = make_worker(mocker, docs)
+    processing.process_lots.side_effect = lambda lot: 1 / 0 if lot['id'] == 'lot_7' else PROCESSED
+    out = StringIO()
+    bulk = BulkRedrive(worker, concurrency=4, out=out)
+
+    summary = bulk.run(['lot_{}'.format(i) for i in range(50)] + ['lot_1', 'unknown'])
+
+    assert summary['total'] == 51
+    assert summary['outcomes'] == {PROCESSED: 49, ERROR: 1, MISSING: 1}
+    assert summary['throughput'] > 0
+    assert sorted(r['id'] for r in bulk.results if r['outcome'] == ERROR) == ['lot_7']
+    assert out.getvalue().startswith('51 lots in ')
+
+
+def test_rate_limiter():
+    limiter = RateLimiter(100)
+    started = time.time()
+    for _ in range(11):
+        limiter.wait()
+    assert time.time() - started >= 0.09
+
+    limiter = RateLimiter(0)
+    started = time.time()
+    for _ in range(100):
+        limiter.wait()
+    assert time.time() - started < 0.05
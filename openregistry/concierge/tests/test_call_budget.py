@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+"""
+HTTP call budget of every workflow path.
+
+Counts and times calls to lots, assets and auctions APIs and to CouchDB,
+made by lot processors for every workflow path with different number of
+assets, and fails if any path makes more calls than recorded in
+'data/call_budget.json'.
+
+Current numbers could be printed as a table and saved as a new budget:
+
+    python -m openregistry.concierge.tests.test_call_budget [--update]
+"""
+import argparse
+import json
+import os
+import time
+from collections import defaultdict
+from copy import deepcopy
+
+import pytest
+from munch import munchify
+from openprocurement_client.exceptions import PreconditionFailed, UnprocessableEntity
+
+from openregistry.concierge.basic.processing import ProcessingBasic
+from openregistry.concierge.constants import SKIPPED
+from openregistry.concierge.journal import LotJournal
+from openregistry.concierge.loki.processing import ProcessingLoki
+
+ROOT = os.path.dirname(__file__) + '/data/'
+BUDGET_PATH = ROOT + 'call_budget.json'
+
+ASSET_COUNTS = (1, 5, 20)
+UPSTREAMS = ('lots', 'assets', 'auctions', 'couchdb')
+
+PROCESSORS = {
+    'loki': (ProcessingLoki, {'aliases': ['loki'], 'assets': {'bounce': ['bounce', 'domain']}}, 'bounce'),
+    'basic': (ProcessingBasic, {'aliases': ['basic'], 'assets': {'basic': ['basic']}}, 'basic'),
+}
+
+
+class CallLog(object):
+
+    def __init__(self):
+        self.counts = defaultdict(int)
+        self.durations = defaultdict(float)
+
+    def add(self, upstream, method, duration):
+        self.counts['{}.{}'.format(upstream, method)] += 1
+        self.durations[upstream] += duration
+
+    def total(self, upstream):
+        return sum(v for k, v in self.counts.items() if k.startswith(upstream + '.'))
+
+
+class Counting(object):
+    """Proxy, which counts and times calls of the target methods."""
+
+    def __init__(self, target, upstream, log):
+        self._target = target
+        self._upstream = upstream
+        self._log = log
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            started = time.time()
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                self._log.add(self._upstream, name, time.time() - started)
+        return call
+
+
+class FakeRegistry(object):
+    """Lots, assets and auctions APIs over in-memory resources."""
+
+    prefix_path = '/api/0/lots'
+
+    def __init__(self, lot, assets, failing_patches=(), conditional=False, revision=None):
+        self.lot = deepcopy(lot)
+        self.assets = dict((a['id'], deepcopy(a)) for a in assets)
+        self.failing_patches = set(failing_patches)
+        self.conditional = conditional
+        self.revision = revision or lot['rev']
+
+    def get_lot(self, lot_id):
+        return munchify({'data': self.lot})
+
+    def patch_lot(self, lot_id, data):
+        self.lot.update(data['data'])
+        return munchify(data)
+
+    def _patch_resource_item(self, url, payload, headers=None):
+        if headers.get('If-Match') != '"{}"'.format(self.revision):
+            raise PreconditionFailed(response=munchify({'text': 'Precondition Failed', 'status_code': 412}))
+        return self.patch_lot(url.split('/')[-1], payload)
+
+    def patch_resource_item_subitem(self, resource_item_id, patch_data, subitem_name, subitem_id):
+        return munchify(patch_data)
+
+    def get_asset(self, asset_id):
+        return munchify({'data': self.assets[asset_id]})
+
+    def patch_asset(self, asset_id, data):
+        if (asset_id, data['data']['status']) in self.failing_patches:
+            raise UnprocessableEntity(response=munchify({'text': 'Unprocessable Entity', 'status_code': 422}))
+        self.assets[asset_id].update(data['data'])
+        return munchify(data)
+
+    def create_auction(self, data):
+        return munchify({'id': 'auction_1', 'data': dict(data, id='auction_1')})
+
+
+class FakeDB(object):
+
+    def get(self, doc_id, default=None):
+        return default
+
+    def save(self, doc):
+        doc['_rev'] = '1-a'
+        return doc['_id'], doc['_rev']
+
+
+def make_case(lot_type, status, asset_count, asset_status='pending', related=False, failing=(),
+              conditional=False, revision=None, auction_status='scheduled'):
+    asset_type = PROCESSORS[lot_type][2]
+    lot = {
+        'id': 'lot_1', 'rev': '1-a', 'status': status, 'lotID': 'UA-1', 'lotType': lot_type,
+        'assets': ['asset_{}'.format(i) for i in range(asset_count)],
+        'decisions': [{'decisionID': 'decision_1', 'decisionOf': 'lot'}],
+        'auctions': [
+            {'id': 'lot_auction_1', 'status': auction_status, 'tenderAttempts': 1, 'auctionPeriod': {}},
+            {'id': 'lot_auction_2', 'status': 'scheduled', 'tenderAttempts': 2, 'tenderingDuration': 'P7D'},
+        ]
+    }
+    assets = [{
+        'id': asset_id, 'status': asset_status, 'assetType': asset_type, 'title': 'Asset',
+        'decisions': [{'decisionID': 'decision_2', 'decisionOf': 'asset'}],
+    } for asset_id in lot['assets']]
+    if related:
+        for asset in assets:
+            asset['relatedLot'] = lot['id']
+    return lot, FakeRegistry(lot, assets, failing, conditional, revision)
+
+
+CASES = {
+    'loki verification success': lambda n: make_case('loki', 'verification', n),
+    'loki verification fail': lambda n: make_case('loki', 'verification', n, asset_status='active'),
+    'loki verification rollback': lambda n: make_case(
+        'loki', 'verification', n, failing=[('asset_{}'.format(n - 1), 'verification')]),
+    'loki verification rollback broken': lambda n: make_case(
+        'loki', 'verification', n, failing=[('asset_{}'.format(n - 1), 'verification'), ('asset_0', 'pending')]),
+    'loki active.salable auction creation': lambda n: make_case(
+        'loki', 'active.salable', n, asset_status='active', related=True),
+    'loki active.salable auction in progress': lambda n: make_case(
+        'loki', 'active.salable', n, asset_status='active', related=True, auction_status='active'),
+    'loki pending.dissolution': lambda n: make_case('loki', 'pending.dissolution', n, related=True),
+    'loki pending.sold': lambda n: make_case('loki', 'pending.sold', n, related=True),
+    'loki verification success conditional': lambda n: make_case('loki', 'verification', n, conditional=True),
+    'loki verification fail conditional': lambda n: make_case(
+        'loki', 'verification', n, asset_status='active', conditional=True),
+    'loki verification fail conditional changed lot': lambda n: make_case(
+        'loki', 'verification', n, asset_status='active', conditional=True, revision='2-b'),
+    'loki verification success conditional changed lot': lambda n: make_case(
+        'loki', 'verification', n, conditional=True, revision='2-b'),
+    'basic verification success': lambda n: make_case('basic', 'verification', n),
+    'basic verification fail': lambda n: make_case('basic', 'verification', n, asset_status='active'),
+    'basic verification fail conditional': lambda n: make_case(
+        'basic', 'verification', n, asset_status='active', conditional=True),
+    'basic verification success conditional changed lot': lambda n: make_case(
+        'basic', 'verification', n, conditional=True, revision='2-b'),
+    'basic pending.dissolution': lambda n: make_case('basic', 'pending.dissolution', n, related=True),
+    'basic recomposed': lambda n: make_case('basic', 'recomposed', n, related=True),
+}
+
+
+def make_processing(path, asset_count):
+    """
+    Returns:
+        tuple: lot and registry of the workflow path, processor with
+               counting clients and CallLog of its calls.
+    """
+    lot, registry = CASES[path](asset_count)
+    log = CallLog()
+    db = Counting(FakeDB(), 'couchdb', log)
+    clients = {
+        'lots_client': Counting(registry, 'lots', log),
+        'assets_client': Counting(registry, 'assets', log),
+        'auction_client': Counting(registry, 'auctions', log),
+        'db': db,
+    }
+    processor, config, _ = PROCESSORS[lot['lotType']]
+    config = dict(config, conditional_patch=registry.conditional)
+    processing = processor(config, clients, {'_id': 'broken_lots'}, LotJournal(db))
+    return lot, registry, processing, log
+
+
+def measure(path, asset_count):
+    """
+    Processes lot of the workflow path with counting clients.
+
+    Returns:
+        CallLog: calls made during processing.
+    """
+    lot, _, processing, log = make_processing(path, asset_count)
+    processing.process_lots(lot)
+    return log
+
+
+def measure_all():
+    return dict(((path, n), measure(path, n)) for path in sorted(CASES) for n in ASSET_COUNTS)
+
+
+def load_budget():
+    with open(BUDGET_PATH) as budget:
+        return json.load(budget)
+
+
+def report(results):
+    """
+    Returns:
+        str: table with number of calls to every upstream and time spent
+             in calls for every path and number of assets.
+    """
+    header = '{:<48} {:>6} ' + ' {:>8}' * len(UPSTREAMS) + ' {:>6} {:>9}'
+    lines = [header.format('path', 'assets', *(UPSTREAMS + ('total', 'time, ms')))]
+    for (path, n), log in sorted(results.items()):
+        totals = [log.total(upstream) for upstream in UPSTREAMS]
+        lines.append(header.format(path, n, *(totals + [sum(totals), '{:.2f}'.format(
+            sum(log.durations.values()) * 1000)])))
+    return '\n'.join(lines)
+
+
+@pytest.mark.parametrize('asset_count', ASSET_COUNTS)
+@pytest.mark.parametrize('path', sorted(CASES))
+def test_call_budget(path, asset_count):
+    budget = load_budget()[path][str(asset_count)]
+    counts = measure(path, asset_count).counts
+
+    exceeded = dict((call, (count, budget.get(call, 0))) for call, count in counts.items()
+                    if count > budget.get(call, 0))
+    assert not exceeded, 'Calls over budget (made, budget): {}'.format(exceeded)
+
+
+@pytest.mark.parametrize('path', ['loki verification success conditional changed lot',
+                                  'basic verification success conditional changed lot'])
+def test_changed_lot_rolls_back_assets(path):
+    lot, registry, processing, _ = make_processing(path, 5)
+
+    assert processing.process_lots(lot) == SKIPPED
+
+    assert registry.lot['status'] == 'verification'
+    assert all(a['status'] == 'pending' and a['relatedLot'] is None for a in registry.assets.values())
+    assert processing.errors_doc == {'_id': 'broken_lots'}
+    assert processing.journal.started(lot) is False
+
+
+def test_call_budget_covers_all_paths():
+    budget = load_budget()
+    assert sorted(budget) == sorted(CASES)
+    for path in CASES:
+        assert sorted(budget[path]) == sorted(str(n) for n in ASSET_COUNTS)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='---- Concierge HTTP call budget ----')
+    parser.add_argument('--update', action='store_true', default=False,
+                        help='Save current numbers as the new budget')
+    params = parser.parse_args()
+    results = measure_all()
+    print(report(results))
+    if params.update:
+        budget = defaultdict(dict)
+        for (path, n), log in results.items():
+            budget[path][str(n)] = dict(log.counts)
+        with open(BUDGET_PATH, 'w') as budget_file:
+            json.dump(budget, budget_file, indent=2, sort_keys=True, separators=(',', ': '))
+            budget_file.write('\n')
+
+
+if __name__ == '__main__':
+    main()
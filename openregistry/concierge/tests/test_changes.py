@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+import pickle
+import sys
+from socket import error
+
+import pytest
+
+from openregistry.concierge.changes import ChangesPage, LotChange, lot_from_row
+from openregistry.concierge.utils import continuous_changes_feed
+
+
+def make_row(seq):
+    return {'seq': seq, 'doc': {
+        '_id': 'lot_{}'.format(seq), '_rev': '1-a', 'status': 'verification',
+        'assets': ['asset_{}'.format(seq)], 'lotID': 'UA-{}'.format(seq), 'lotType': 'basic'
+    }}
+
+
+def make_stream(start, size):
+    for seq in range(start + 1, start + size + 1):
+        yield make_row(seq)
+    yield {'last_seq': start + size}
+
+
+def test_lot_change():
+    lot = lot_from_row(make_row(1))
+
+    assert isinstance(lot, LotChange)
+    assert lot['id'] == 'lot_1'
+    assert lot['rev'] == '1-a'
+    assert lot['assets'] == ['asset_1']
+    assert lot.get('decisions') is None
+    assert lot.get('resolved', False) is False
+    assert 'lotType' in lot
+    assert 'resolved' not in lot
+    with pytest.raises(KeyError):
+        lot['__class__']
+
+    as_dict = {
+        'id': 'lot_1', 'rev': '1-a', 'status': 'verification', 'assets': ['asset_1'],
+        'lotID': 'UA-1', 'lotType': 'basic', 'decisions': None, 'auctions': None
+    }
+    assert lot == as_dict
+    assert dict(lot) == as_dict
+    assert lot != dict(as_dict, status='pending')
+
+    lot['status'] = 'pending'
+    assert lot['status'] == 'pending'
+    with pytest.raises(KeyError):
+        lot['resolved'] = True
+
+    assert pickle.loads(pickle.dumps(lot)) == lot
+    assert pickle.loads(pickle.dumps(lot, 2)) == lot
+
+    assert not hasattr(lot, '__dict__')
+    assert sys.getsizeof(lot) < sys.getsizeof(as_dict)
+
+
+def test_changes_page(mocker):
+    db = mocker.MagicMock()
+    db.changes.return_value = {'results': [make_row(1), make_row(2)], 'last_seq': 2}
+
+    page = ChangesPage(db, 0, 2, 'lots/status')
+
+    assert [row['seq'] for row in page] == [1, 2]
+    assert page.last_seq == 2
+    assert page.count == 2
+    db.changes.assert_called_once_with(include_docs=True, since=0, limit=2, filter='lots/status')
+
+
+def test_changes_page_stream(mocker):
+    db = mocker.MagicMock()
+    db.changes.return_value = make_stream(2, 3)
+
+    page = ChangesPage(db, 2, 3, 'lots/status', stream=True)
+    assert db.changes.call_count == 0
+    rows = iter(page)
+
+    assert rows.next()['seq'] == 3
+    assert page.last_seq == 2
+    assert [row['seq'] for row in rows] == [4, 5]
+    assert page.last_seq == 5
+    assert page.count == 3
+    db.changes.assert_called_once_with(feed='continuous', timeout=0, include_docs=True,
+                                       since=2, limit=3, filter='lots/status')
+
+
+def test_continuous_changes_feed_stream(mocker):
+    db = mocker.MagicMock()
+    db.changes.side_effect = [make_stream(0, 2), make_stream(2, 1), make_stream(3, 0)]
+    state = {}
+
+    lots = continuous_changes_feed(db, mocker.MagicMock(), limit=2, state=state, stream=True)
+
+    assert lots.next()['id'] == 'lot_1'
+    assert 'processed_seq' not in state
+    assert [lot['id'] for lot in lots] == ['lot_2', 'lot_3']
+    assert [c[1]['since'] for c in db.changes.call_args_list] == [0, 2, 3]
+    assert state['processed_seq'] == 3
+    assert state['caught_up_seq'] == 3
+
+
+def test_continuous_changes_feed_stream_error(mocker):
+    def broken_stream():
+        yield make_row(1)
+        raise error(104, 'Connection reset by peer')
+
+    db = mocker.MagicMock()
+    db.changes.return_value = broken_stream()
+    logger = mocker.MagicMock()
+    state = {}
+
+    lots = list(continuous_changes_feed(db, logger, state=state, stream=True))
+
+    assert [lot['id'] for lot in lots] == ['lot_1']
+    assert state['processed_seq'] == 1
+    assert 'caught_up_seq' not in state
+    logger.error.assert_called_once_with('Failed to get lots from DB: [Errno 104] Connection reset by peer')
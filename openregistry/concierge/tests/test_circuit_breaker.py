@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+import pytest
+from munch import munchify
+
+from openprocurement_client.exceptions import RequestFailed, ResourceNotFound
+
+from openregistry.concierge.basic.processing import ProcessingBasic
+from openregistry.concierge.circuit_breaker import (
+    CircuitBreaker,
+    CircuitBreakerClient,
+    CircuitOpen,
+    CLOSED,
+    OPEN,
+    HALF_OPEN,
+)
+from openregistry.concierge.metrics import metrics
+from openregistry.concierge.tests.conftest import TEST_CONFIG
+from openregistry.concierge.utils import retry_on_error
+
+
+def server_error():
+    return RequestFailed(response=munchify({"text": "Bad Gateway", "status_code": 502}))
+
+
+def test_breaker_opens_after_threshold(mocker):
+    func = mocker.MagicMock(side_effect=server_error())
+    breaker = CircuitBreaker('auctions', failure_threshold=3, reset_timeout=30)
+
+    for _ in range(3):
+        with pytest.raises(RequestFailed):
+            breaker.call(func)
+    assert breaker.state == OPEN
+    assert breaker.available is False
+    assert metrics.get('circuit_breaker.auctions.state') == OPEN
+
+    with pytest.raises(CircuitOpen):
+        breaker.call(func)
+    assert func.call_count == 3
+
+
+def test_breaker_half_open_and_close(mocker):
+    mock_time = mocker.patch('openregistry.concierge.circuit_breaker.time.time')
+    mock_time.return_value = 100
+    func = mocker.MagicMock(side_effect=[server_error(), 'auction'])
+    breaker = CircuitBreaker('auctions', failure_threshold=1, reset_timeout=30)
+
+    with pytest.raises(RequestFailed):
+        breaker.call(func)
+    assert breaker.state == OPEN
+
+    mock_time.return_value = 131
+    assert breaker.state == HALF_OPEN
+    assert breaker.available is True
+    assert breaker.call(func) == 'auction'
+    assert breaker.state == CLOSED
+
+
+def test_breaker_half_open_failure_reopens(mocker):
+    mock_time = mocker.patch('openregistry.concierge.circuit_breaker.time.time')
+    mock_time.return_value = 100
+    func = mocker.MagicMock(side_effect=server_error())
+    breaker = CircuitBreaker('lots', failure_threshold=1, reset_timeout=30)
+
+    with pytest.raises(RequestFailed):
+        breaker.call(func)
+    mock_time.return_value = 131
+    with pytest.raises(RequestFailed):
+        breaker.call(func)
+    assert breaker.state == OPEN
+
+
+def test_breaker_ignores_client_errors(mocker):
+    func = mocker.MagicMock(side_effect=ResourceNotFound(response=munchify({"text": "Not found"})))
+    breaker = CircuitBreaker('assets', failure_threshold=1)
+
+    with pytest.raises(ResourceNotFound):
+        breaker.call(func)
+    assert breaker.state == CLOSED
+
+
+def test_breaker_client_proxy(mocker):
+    client = mocker.MagicMock()
+    client.host_url = 'http://127.0.0.1'
+    client.get_asset.side_effect = server_error()
+    proxy = CircuitBreakerClient(client, CircuitBreaker('assets', failure_threshold=1))
+
+    assert proxy.host_url == 'http://127.0.0.1'
+    with pytest.raises(RequestFailed):
+        proxy.get_asset('1')
+    with pytest.raises(CircuitOpen):
+        proxy.get_asset('1')
+    assert client.get_asset.call_count == 1
+
+
+def test_circuit_open_is_not_retried():
+    exception = CircuitOpen('auctions')
+    assert not isinstance(exception, RequestFailed)
+    assert retry_on_error(exception) is False
+    assert retry_on_error(server_error()) is True
+
+
+def test_breaker_opens_between_asset_patches(mocker):
+    breaker = CircuitBreaker('assets', failure_threshold=1, reset_timeout=30)
+    assets_client = mocker.MagicMock()
+    assets_client.get_asset.return_value = munchify({'data': {'status': 'pending', 'assetType': 'basic'}})
+    patches = []
+    assets_client.patch_asset.side_effect = lambda asset_id, data: patches.append((asset_id, data['data']['status']))
+    lots_client = mocker.MagicMock()
+    lots_client.get_lot.return_value = munchify({'data': {'status': 'verification'}})
+    clients = {'lots_client': lots_client, 'assets_client': CircuitBreakerClient(assets_client, breaker),
+               'db': mocker.MagicMock()}
+    errors_doc = {}
+    processing = ProcessingBasic(TEST_CONFIG['lots']['basic'], clients, errors_doc)
+    lot = {'id': 'lot_1', 'rev': '1-a', 'status': 'verification', 'assets': ['a1', 'a2'], 'lotID': 'UA-1'}
+    record = processing.journal.record
+
+    def record_step(lot, step, item=None):
+        record(lot, step, item)
+        if len(patches) == 1:
+            # breaker is opened by failures of other lots after the first PATCH
+            breaker.record_failure()
+    processing.journal.record = record_step
+
+    with pytest.raises(CircuitOpen):
+        processing.process_lots(lot)
+
+    # patched asset is not rolled back and lot is not marked as broken
+    assert patches == [('a1', 'verification')]
+    assert errors_doc == {}
+    assert lots_client.patch_lot.call_count == 0
+
+    # deferred lot is resumed from journal
+    breaker.record_success()
+    processing.process_lots(lot)
+    assert patches == [('a1', 'verification'), ('a2', 'verification'), ('a1', 'active'), ('a2', 'active')]
+    assert lots_client.patch_lot.call_args[0] == ('lot_1', {'data': {'status': 'active.salable'}})
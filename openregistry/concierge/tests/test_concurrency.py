@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+from socket import error
+
+import pytest
+from openprocurement_client.exceptions import ResourceNotFound
+
+from openregistry.concierge.concurrency import AdaptiveLimit, AdaptiveLimitClient
+from openregistry.concierge.metrics import metrics
+from openregistry.concierge.pipelines import LotPipeline
+
+
+def record_window(limit, latency, failed=0):
+    for i in range(limit.window):
+        limit.record(latency, i < failed)
+
+
+def hold(limit, slots):
+    for _ in range(slots):
+        assert limit.acquire(0)
+
+
+def test_limit_follows_latency():
+    limit = AdaptiveLimit(min_limit=2, max_limit=8, window=10)
+    # limit doesn't grow while less than half of it is used
+    for _ in range(20):
+        record_window(limit, 0.1)
+    assert limit.limit == 2
+
+    hold(limit, 2)
+    for _ in range(50):
+        record_window(limit, 0.1)
+        while limit.acquire(0):
+            pass
+    assert limit.limit == 8
+    assert metrics.get('adaptive_concurrency.limit') == 8
+
+    # upstreams became slower
+    for _ in range(10):
+        record_window(limit, 0.5)
+    assert limit.limit < 8
+    assert limit.limit >= 2
+
+
+def test_limit_backs_off_on_errors():
+    limit = AdaptiveLimit(min_limit=1, max_limit=10, initial_limit=10, window=10, backoff=0.5)
+    record_window(limit, 0.1, failed=1)
+    assert limit.limit == 10
+    record_window(limit, 0.1, failed=2)
+    assert limit.limit == 5
+    for _ in range(5):
+        record_window(limit, 0.1, failed=5)
+    assert limit.limit == 1
+    assert metrics.get('adaptive_concurrency.error_rate') == 0.5
+
+
+def test_acquire():
+    limit = AdaptiveLimit(min_limit=2, max_limit=2)
+    hold(limit, 2)
+    started = time.time()
+    assert limit.acquire(0.1) is False
+    assert time.time() - started >= 0.1
+
+    timer = threading.Timer(0.1, limit.release)
+    timer.start()
+    assert limit.acquire(5) is True
+    timer.join()
+
+
+def test_client_records_calls(mocker):
+    limit = mocker.MagicMock()
+    client = mocker.MagicMock()
+    client.get_lot.return_value = 'lot'
+    proxy = AdaptiveLimitClient(client, limit)
+
+    assert proxy.get_lot('lot_1') == 'lot'
+    client.get_asset.side_effect = ResourceNotFound()
+    with pytest.raises(ResourceNotFound):
+        proxy.get_asset('asset_1')
+    client.patch_asset.side_effect = error()
+    with pytest.raises(error):
+        proxy.patch_asset('asset_1', {})
+    assert [c[0][1:] for c in limit.record.call_args_list] == [(), (False,), (True,)]
+
+
+def test_pipeline_follows_limit(mocker):
+    limit = AdaptiveLimit(min_limit=2, max_limit=2)
+    worker = mocker.MagicMock()
+    worker.deferred_lots = {}
+    lock = threading.Lock()
+    active = []
+    peak = []
+
+    def process(lot):
+        with lock:
+            active.append(lot['id'])
+            peak.append(len(active))
+        time.sleep(0.02)
+        with lock:
+            active.remove(lot['id'])
+    worker.process_lot.side_effect = process
+
+    pipeline = LotPipeline('loki', worker, concurrency=4, limit=limit)
+    for i in range(8):
+        pipeline.offer({'id': 'lot_{}'.format(i), 'rev': '1-a'})
+    pipeline.start()
+    deadline = time.time() + 5
+    while pipeline.status()['processed'] < 8 and time.time() < deadline:
+        time.sleep(0.01)
+    pipeline.stop(1)
+    assert pipeline.status()['processed'] == 8
+    assert max(peak) == 2
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+import time
+
+import pytest
+
+from openregistry.concierge.basic.processing import ProcessingBasic
+from openregistry.concierge.deadline import (
+    DeadlineClient,
+    DeadlineExceeded,
+    LotDeadline,
+    Watchdog,
+    compensation,
+    current_deadline
+)
+from openregistry.concierge.metrics import metrics
+from openregistry.concierge.tests.conftest import TEST_CONFIG
+from openregistry.concierge.utils import retry_on_error
+
+
+def lot(status='verification'):
+    return {'id': 'lot_1', 'rev': '1-a', 'status': status, 'assets': ['asset_1', 'asset_2', 'asset_3'],
+            'lotType': 'basic'}
+
+
+def test_lot_deadline(mocker):
+    time_mock = mocker.patch('openregistry.concierge.deadline.time')
+    time_mock.time.return_value = 1000
+    deadline = LotDeadline('lot_1', 10, compensation_timeout=5)
+    deadline.record('assets.patch_asset', 2)
+    deadline.record('assets.patch_asset', 3)
+    deadline.record('lots.get_lot', 4)
+
+    time_mock.time.return_value = 1009
+    deadline.check()
+    assert deadline.exceeded is False
+
+    time_mock.time.return_value = 1010
+    with pytest.raises(DeadlineExceeded):
+        deadline.check()
+    assert deadline.exceeded is True
+
+    deadline.compensating = True
+    deadline.check()
+    time_mock.time.return_value = 1015
+    with pytest.raises(DeadlineExceeded):
+        deadline.check()
+
+    assert deadline.timing() == {
+        'timeout': 10,
+        'elapsed': 15,
+        'slowest': 'assets.patch_asset',
+        'calls': {'assets.patch_asset': {'count': 2, 'duration': 5}, 'lots.get_lot': {'count': 1, 'duration': 4}},
+    }
+    assert not retry_on_error(DeadlineExceeded('lot_1', 10))
+
+
+def test_watchdog(mocker):
+    metrics.reset()
+    client = mocker.MagicMock()
+    client.get_lot.return_value = 'lot'
+    client = DeadlineClient(client, 'lots')
+    watchdog = Watchdog(timeout=10, steps={'active.salable': 0})
+
+    # calls out of lot processing are not checked
+    assert client.get_lot('lot_1') == 'lot'
+
+    deadline = watchdog.start(lot())
+    assert current_deadline() is deadline
+    assert client.get_lot('lot_1') == 'lot'
+    assert deadline.calls['lots.get_lot'][0] == 1
+    assert watchdog.stop() is deadline
+    assert current_deadline() is None
+    assert metrics.get('watchdog.timeouts') is None
+
+    deadline = watchdog.start(lot('active.salable'))
+    with pytest.raises(DeadlineExceeded):
+        client.get_lot('lot_1')
+    with compensation():
+        assert deadline.compensating is True
+        assert client.get_lot('lot_1') == 'lot'
+    assert deadline.compensating is False
+    watchdog.stop()
+    assert metrics.get('watchdog.timeouts') == 1
+
+
+def test_processing_rolls_back_after_deadline(mocker):
+    assets_client = mocker.MagicMock()
+    calls = []
+
+    def patch_asset(asset_id, data):
+        calls.append((asset_id, data['data']['status']))
+        if len(calls) == 1:
+            time.sleep(0.06)
+    assets_client.patch_asset.side_effect = patch_asset
+    clients = {'lots_client': mocker.MagicMock(), 'assets_client': DeadlineClient(assets_client, 'assets'),
+               'db': mocker.MagicMock(), 'auction_client': mocker.MagicMock()}
+    processing = ProcessingBasic(TEST_CONFIG['lots']['basic'], clients, {})
+    watchdog = Watchdog(timeout=0.05)
+
+    deadline = watchdog.start(lot())
+    try:
+        processing._add_assets_to_lot(lot())
+    finally:
+        watchdog.stop()
+
+    # remaining assets are not patched, patched one is rolled back
+    assert calls == [('asset_1', 'verification'), ('asset_1', 'pending')]
+    assert deadline.exceeded is True
+    assert deadline.timing()['calls']['assets.patch_asset']['count'] == 2
+    assert processing.lots_client.patch_lot.call_count == 0
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+import logging
+
+from openregistry.concierge.design import (
+    HASH_FIELD,
+    content_hash,
+    design_content,
+    concierge_view,
+    sync_design
+)
+from openregistry.concierge.utils import prepare_couchdb_filter
+
+
+class FakeDB(dict):
+
+    def __init__(self, *args, **kwargs):
+        super(FakeDB, self).__init__(*args, **kwargs)
+        self.saved = []
+        self.queried = []
+
+    def save(self, doc):
+        doc['_rev'] = '{}-a'.format(int(doc.get('_rev', '0-a').split('-')[0]) + 1)
+        self[doc['_id']] = dict(doc)
+        self.saved.append(doc['_id'])
+
+    def view(self, name, **options):
+        self.queried.append(name)
+        return []
+
+    def delete(self, doc):
+        del self[doc['_id']]
+
+
+def test_sync_design():
+    db = FakeDB()
+    content = design_content([concierge_view])
+
+    assert sync_design(db) is None
+    assert db.saved == ['_design/concierge']
+    doc = db['_design/concierge']
+    assert doc['views']['check_lot']['map'] == concierge_view.map_fun
+    assert doc['options'] == {'local_seq': True}
+    assert doc[HASH_FIELD] == content_hash(content)
+
+    # restart with the same definition doesn't create new revision
+    assert sync_design(db) is None
+    assert db.saved == ['_design/concierge']
+
+
+def test_sync_design_warm_up():
+    db = FakeDB()
+    db['_design/concierge'] = {
+        '_id': '_design/concierge', '_rev': '1-a', 'views': {'check_lot': {'map': 'function(doc) {}'}},
+        HASH_FIELD: 'outdated'
+    }
+    digest = content_hash(design_content([concierge_view]))
+    staging_id = '_design/concierge_{}'.format(digest[:8])
+
+    thread = sync_design(db)
+    thread.join()
+
+    assert db.saved == [staging_id, '_design/concierge']
+    assert db.queried == ['concierge_{}/check_lot'.format(digest[:8])]
+    assert staging_id not in db
+    assert db['_design/concierge'][HASH_FIELD] == digest
+    assert db['_design/concierge']['_rev'] == '2-a'
+    assert db['_design/concierge']['views']['check_lot']['map'] == concierge_view.map_fun
+
+
+def test_legacy_view_removed():
+    db = FakeDB()
+    db['_design/lots'] = {
+        '_id': '_design/lots', '_rev': '1-a', 'filters': {'status': 'function(doc) {}'},
+        'views': {'check_lot': {'map': 'function(doc) {}'}}, 'options': {'local_seq': True}
+    }
+
+    sync_design(db)
+    assert 'views' not in db['_design/lots']
+    assert db['_design/lots']['filters'] == {'status': 'function(doc) {}'}
+    assert db.saved == ['_design/lots', '_design/concierge']
+
+    sync_design(db)
+    assert db.saved == ['_design/lots', '_design/concierge']
+
+
+def test_prepare_couchdb_filter():
+    logger = logging.getLogger('test_design')
+    db = FakeDB()
+
+    prepare_couchdb_filter(db, 'lots', 'status', 'function(doc) {}', logger)
+    assert db['_design/lots']['filters'] == {'status': 'function(doc) {}'}
+
+    prepare_couchdb_filter(db, 'lots', 'status', 'function(doc) {}', logger)
+    assert db.saved == ['_design/lots']
+
+    prepare_couchdb_filter(db, 'lots', 'status', 'function(doc) { return true; }', logger)
+    assert db.saved == ['_design/lots', '_design/lots']
+    assert db['_design/lots']['_rev'] == '2-a'
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+import time
+from socket import error
+
+from openregistry.concierge.feed import PrefetchingFeed
+
+
+def make_row(seq):
+    return {'seq': seq, 'doc': {
+        '_id': 'lot_{}'.format(seq), '_rev': '1-a', 'status': 'verification',
+        'assets': [], 'lotID': 'UA-{}'.format(seq), 'lotType': 'basic'
+    }}
+
+
+def make_pages(sizes):
+    pages, seq = [], 0
+    for size in sizes:
+        rows = [make_row(seq + i + 1) for i in range(size)]
+        seq += size
+        pages.append({'results': rows, 'last_seq': seq})
+    return pages
+
+
+def test_prefetching_feed(mocker):
+    db = mocker.MagicMock()
+    db.changes.side_effect = make_pages([3, 2, 0])
+    state = {}
+
+    lots = list(PrefetchingFeed(db, mocker.MagicMock(), state=state, limit=3))
+
+    assert [lot['id'] for lot in lots] == ['lot_1', 'lot_2', 'lot_3', 'lot_4', 'lot_5']
+    assert db.changes.call_args_list[0][1] == {
+        'include_docs': True, 'since': 0, 'limit': 3, 'filter': 'lots/status'
+    }
+    assert db.changes.call_args_list[1][1]['since'] == 3
+    assert state['processed_seq'] == 5
+    assert state['caught_up_seq'] == 5
+
+
+def test_prefetching_feed_stream(mocker):
+    db = mocker.MagicMock()
+    db.changes.side_effect = [
+        iter(page['results'] + [{'last_seq': page['last_seq']}]) for page in make_pages([3, 0])
+    ]
+    state = {}
+
+    lots = list(PrefetchingFeed(db, mocker.MagicMock(), state=state, limit=3, stream=True))
+
+    assert [lot['id'] for lot in lots] == ['lot_1', 'lot_2', 'lot_3']
+    assert db.changes.call_args_list[0][1] == {
+        'feed': 'continuous', 'timeout': 0, 'include_docs': True, 'since': 0, 'limit': 3, 'filter': 'lots/status'
+    }
+    assert db.changes.call_args_list[1][1]['since'] == 3
+    assert state['caught_up_seq'] == 3
+
+
+def test_prefetching_feed_reads_ahead(mocker):
+    db = mocker.MagicMock()
+    db.changes.side_effect = make_pages([2, 2, 0])
+    feed = iter(PrefetchingFeed(db, mocker.MagicMock(), state={}, limit=2))
+
+    assert feed.next()['id'] == 'lot_1'
+    for _ in range(50):
+        if db.changes.call_count == 3:
+            break
+        time.sleep(0.01)
+    # all pages were fetched while the first lot was processed
+    assert db.changes.call_count == 3
+    assert [lot['id'] for lot in feed] == ['lot_2', 'lot_3', 'lot_4']
+
+
+def test_prefetching_feed_adapts_page_size(mocker):
+    db = mocker.MagicMock()
+    db.changes.side_effect = make_pages([4, 4, 0])
+    feed = PrefetchingFeed(db, mocker.MagicMock(), state={}, queue_size=2, min_limit=1, max_limit=8, limit=4)
+    lots = iter(feed)
+
+    assert lots.next()['id'] == 'lot_1'
+    time.sleep(0.3)  # queue is full, reader waits for consumer
+    assert [lot['id'] for lot in lots] == ['lot_2', 'lot_3', 'lot_4', 'lot_5', 'lot_6', 'lot_7', 'lot_8']
+    assert db.changes.call_args_list[1][1]['limit'] == 2
+
+    feed.limit = 2
+    feed._adapt_limit(starved=True, waited=False)
+    assert feed.limit == 4
+    feed._adapt_limit(starved=False, waited=True)
+    feed._adapt_limit(starved=False, waited=True)
+    feed._adapt_limit(starved=False, waited=True)
+    assert feed.limit == 1
+
+
+def test_prefetching_feed_db_error(mocker):
+    db = mocker.MagicMock()
+    db.changes.side_effect = error(111, 'Connection refused')
+    logger = mocker.MagicMock()
+    state = {}
+
+    assert list(PrefetchingFeed(db, logger, state=state)) == []
+    assert logger.error.call_args[0][0] == 'Failed to get lots from DB: [Errno 111] Connection refused'
+    assert state == {}
+
+
+def test_prefetching_feed_consumer_stops(mocker):
+    db = mocker.MagicMock()
+    db.changes.side_effect = make_pages([5, 0])
+    feed = PrefetchingFeed(db, mocker.MagicMock(), state={}, queue_size=1, limit=5)
+
+    for lot in feed:
+        break
+    assert feed._stop.is_set()
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+import os
+from copy import deepcopy
+from json import load
+
+from munch import munchify
+
+from openregistry.concierge.fingerprints import FingerprintIndex, fingerprint
+from openregistry.concierge.loki.processing import ProcessingLoki
+from openregistry.concierge.metrics import metrics
+from openregistry.concierge.tests.conftest import TEST_CONFIG
+
+ROOT = os.path.dirname(os.path.dirname(__file__)) + '/loki/tests/data/'
+
+
+def test_index(mocker):
+    time = mocker.patch('openregistry.concierge.fingerprints.time')
+    time.time.return_value = 1000
+    index = FingerprintIndex('test_fingerprints', max_size=2, ttl=60)
+
+    assert fingerprint(['a', 'b'], [('x', 'scheduled')]) == fingerprint(['a', 'b'], [('x', 'scheduled')])
+    assert fingerprint(['a', 'b'], [('x', 'scheduled')]) != fingerprint(['a', 'b'], [('x', 'active')])
+
+    assert index.unchanged('lot_1', 'f1') is False
+    index.remember('lot_1', 'f1')
+    assert index.unchanged('lot_1', 'f1') is True
+    assert index.unchanged('lot_1', 'f2') is False
+    assert index.unchanged('lot_1', 'f1') is False
+
+    index.remember('lot_1', 'f1')
+    time.time.return_value = 1060
+    assert index.unchanged('lot_1', 'f1') is False
+
+    for lot_id in ('lot_1', 'lot_2', 'lot_3'):
+        index.remember(lot_id, 'f1')
+    assert index.unchanged('lot_1', 'f1') is False
+    assert index.unchanged('lot_3', 'f1') is True
+    index.forget('lot_3')
+    assert index.unchanged('lot_3', 'f1') is False
+
+
+def test_active_salable_lot_is_skipped_until_auctions_change(mocker):
+    metrics.reset()
+    with open(ROOT + 'lots.json') as lots:
+        lot = load(lots)[7]['data']
+    # auction is in progress, nothing to create
+    lot['auctions'][0]['status'] = 'active'
+    lots_client = mocker.MagicMock()
+    lots_client.get_lot.return_value = munchify({'data': {'status': 'active.salable'}})
+    assets_client = mocker.MagicMock()
+    assets_client.get_asset.return_value = munchify({'data': {
+        'id': lot['assets'][0], 'assetType': 'bounce', 'status': 'active', 'relatedLot': lot['id']
+    }})
+    clients = {'lots_client': lots_client, 'assets_client': assets_client, 'db': mocker.MagicMock(),
+               'auction_client': mocker.MagicMock()}
+    config = dict(TEST_CONFIG['lots']['loki'], salable_fingerprints={'max_size': 10, 'ttl': 60})
+    processing = ProcessingLoki(config, clients, {})
+    create_auction = mocker.patch.object(processing, '_create_auction')
+
+    processing.process_lots(lot)
+    # assets are checked only before auction creation
+    assert assets_client.get_asset.call_count == 0
+
+    # document edit
+    lot['title'] = 'New title'
+    processing.process_lots(lot)
+    assert assets_client.get_asset.call_count == 0
+    assert lots_client.get_lot.call_count == 1
+    assert metrics.get('salable_fingerprints.skipped') == 1
+
+    changed = deepcopy(lot)
+    changed['auctions'][0]['status'] = 'unsuccessful'
+    create_auction.return_value = None
+    processing.process_lots(changed)
+    assert assets_client.get_asset.call_count == 1
+    assert create_auction.call_count == 1
+
+    # failed auction creation is retried
+    processing.process_lots(changed)
+    assert create_auction.call_count == 2
+
+
+def test_lot_with_unavailable_assets_is_not_skipped(mocker):
+    with open(ROOT + 'lots.json') as lots:
+        lot = load(lots)[7]['data']
+    lots_client = mocker.MagicMock()
+    lots_client.get_lot.return_value = munchify({'data': {'status': 'active.salable'}})
+    assets_client = mocker.MagicMock()
+    assets_client.get_asset.return_value = munchify({'data': {
+        'id': lot['assets'][0], 'assetType': 'bounce', 'status': 'pending'
+    }})
+    clients = {'lots_client': lots_client, 'assets_client': assets_client, 'db': mocker.MagicMock(),
+               'auction_client': mocker.MagicMock()}
+    config = dict(TEST_CONFIG['lots']['loki'], salable_fingerprints={'max_size': 10, 'ttl': 60})
+    processing = ProcessingLoki(config, clients, {})
+    create_auction = mocker.patch.object(processing, '_create_auction')
+
+    processing.process_lots(lot)
+    processing.process_lots(lot)
+    assert assets_client.get_asset.call_count == 2
+    assert create_auction.call_count == 0
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+import json
+import time
+import urllib2
+
+import pytest
+
+from openregistry.concierge.circuit_breaker import CircuitBreaker
+from openregistry.concierge.health import HealthCheck, start_health_server
+from openregistry.concierge.utils import continuous_changes_feed, seq_number
+
+
+def make_row(seq, lot_id):
+    return {'seq': seq, 'doc': {
+        '_id': lot_id, '_rev': '1-a', 'status': 'verification', 'assets': [], 'lotID': lot_id, 'lotType': 'basic'
+    }}
+
+
+@pytest.fixture(scope='function')
+def worker(mocker):
+    worker = mocker.MagicMock()
+    worker.config = {'db': {'filter': 'lots/status'}}
+    worker.heartbeat = time.time()
+    worker.in_flight = 1
+    worker.deferred_lots = {}
+    worker.breakers = {'lots': CircuitBreaker('lots')}
+    worker.feed_state = {'processed_seq': 40, 'caught_up_at': time.time() - 60}
+    worker.db.info.return_value = {'update_seq': 45}
+    worker.db.changes.return_value = {'results': [{}, {}], 'last_seq': 45}
+    return worker
+
+
+def test_feed_state(mocker):
+    db = mocker.MagicMock()
+    db.changes.side_effect = [
+        {'results': [make_row(1, 'a'), make_row(2, 'b')], 'last_seq': 2},
+        {'results': [], 'last_seq': 2},
+    ]
+    state = {}
+    feed = continuous_changes_feed(db, mocker.MagicMock(), state=state)
+
+    assert feed.next()['id'] == 'a'
+    assert 'processed_seq' not in state
+    assert feed.next()['id'] == 'b'
+    assert state['processed_seq'] == 1
+    with pytest.raises(StopIteration):
+        feed.next()
+    assert state['processed_seq'] == 2
+    assert state['caught_up_seq'] == 2
+    assert 'caught_up_at' in state
+
+
+def test_seq_number():
+    assert seq_number(12) == 12
+    assert seq_number('12-g1AAAAE') == 12
+
+
+def test_health_status(worker):
+    check = HealthCheck(worker, stall_timeout=300, backlog_limit=2)
+
+    status = check.status()
+
+    assert status['alive'] is True
+    assert status['ready'] is True
+    assert status['processed_seq'] == 40
+    assert status['update_seq'] == 45
+    assert status['seq_lag'] == 5
+    assert status['backlog'] == 2
+    assert status['backlog_limited'] is True
+    assert status['in_flight'] == 1
+    assert 55 < status['oldest_unprocessed_age'] < 65
+    worker.db.changes.assert_called_with(since=40, limit=2, filter='lots/status')
+
+
+def test_health_status_db_failure(worker):
+    worker.db.changes.side_effect = ValueError('unknown filter')
+    status = HealthCheck(worker).status()
+
+    assert status['alive'] is True
+    assert status['ready'] is False
+    assert 'backlog' not in status
+
+
+def test_health_stalled_loop(worker):
+    worker.heartbeat = time.time() - 301
+    check = HealthCheck(worker, stall_timeout=300)
+
+    assert check.alive() is False
+    assert check.ready() is False
+
+
+def test_health_server(worker):
+    server = start_health_server(worker, port=0, stall_timeout=300)
+    url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    try:
+        assert json.loads(urllib2.urlopen(url + '/health').read()) == {'alive': True}
+        assert json.loads(urllib2.urlopen(url + '/status').read())['seq_lag'] == 5
+        assert json.loads(urllib2.urlopen(url + '/ready').read()) == {'ready': True}
+
+        worker.heartbeat = time.time() - 301
+        with pytest.raises(urllib2.HTTPError) as e:
+            urllib2.urlopen(url + '/health')
+        assert e.value.code == 503
+    finally:
+        server.shutdown()
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+from openregistry.concierge.journal import LotJournal
+from openregistry.concierge.storage import MemoryStorage
+
+LOT = {'id': '9ee8f769438e403ebfb17b2240aedcf1', 'rev': '1-a', 'assets': ['a1', 'a2']}
+
+
+def test_journal_steps():
+    journal = LotJournal()
+    assert journal.started(LOT) is False
+
+    journal.begin(LOT)
+    assert journal.started(LOT) is True
+    assert journal.completed(LOT, 'asset.pre', 'a1') is False
+
+    journal.record(LOT, 'asset.pre', 'a1')
+    assert journal.completed(LOT, 'asset.pre', 'a1') is True
+    assert journal.completed(LOT, 'asset.pre', 'a2') is False
+    assert journal.completed(LOT, 'asset.pre') is True
+
+    changed_lot = dict(LOT, rev='2-b')
+    assert journal.started(changed_lot) is False
+    assert journal.completed(changed_lot, 'asset.pre', 'a1') is False
+
+    journal.finish(LOT)
+    assert journal.started(LOT) is False
+
+
+def test_journal_batches_writes(mocker):
+    db = mocker.MagicMock()
+    db.get.return_value = None
+    journal = LotJournal(db, 'lots_journal', batch_size=3)
+
+    journal.begin(LOT)
+    assert db.save.call_count == 1
+
+    journal.record(LOT, 'asset.pre', 'a1')
+    journal.record(LOT, 'asset.pre', 'a2')
+    assert db.save.call_count == 1
+    journal.record(LOT, 'asset.finish', 'a1')
+    assert db.save.call_count == 2
+
+    journal.finish(LOT)
+    assert db.save.call_count == 2
+    journal.flush()
+    assert db.save.call_count == 3
+    assert LOT['id'] not in db.save.call_args[0][0]
+
+    journal.flush()
+    assert db.save.call_count == 3
+
+
+def test_journal_resumes_from_db(mocker):
+    db = mocker.MagicMock()
+    db.get.return_value = {
+        '_id': 'lots_journal',
+        LOT['id']: {'rev': LOT['rev'], 'steps': {'asset.pre': ['a1', 'a2']}}
+    }
+    journal = LotJournal(db, 'lots_journal')
+
+    assert journal.started(LOT) is True
+    assert journal.completed(LOT, 'asset.pre', 'a2') is True
+
+
+def test_journal_merges_on_conflict():
+    storage = MemoryStorage()
+    other_lot = dict(LOT, id='other')
+    finished_lot = dict(LOT, id='finished')
+    journal = LotJournal(storage, 'lots_journal', batch_size=1)
+    other = LotJournal(storage, 'lots_journal', batch_size=1)
+
+    journal.begin(finished_lot)
+    other.begin(other_lot)
+    journal.begin(LOT)
+    journal.record(LOT, 'asset.pre', 'a1')
+    journal.finish(finished_lot)
+    journal.flush()
+
+    stored = storage.get('lots_journal')
+    assert stored[LOT['id']]['steps'] == {'asset.pre': ['a1']}
+    assert stored['other']['steps'] == {}
+    assert 'finished' not in stored
+
+    # revision is actual after merge, so the next write doesn't conflict
+    journal.record(LOT, 'asset.pre', 'a2')
+    assert storage.get('lots_journal')[LOT['id']]['steps'] == {'asset.pre': ['a1', 'a2']}
+
+
+def test_journal_removes_stale_entries(mocker):
+    storage = MemoryStorage()
+    storage.save({'_id': 'lots_journal', 'legacy': {'rev': '1-a', 'steps': {}}})
+    time = mocker.patch('openregistry.concierge.journal.time')
+    time.time.return_value = 1000
+    journal = LotJournal(storage, 'lots_journal', retention=100)
+    deleted_lot = dict(LOT, id='deleted')
+
+    journal.begin(deleted_lot)
+    time.time.return_value = 1050
+    journal.begin(LOT)
+    time.time.return_value = 1120
+    journal.record(LOT, 'asset.pre', 'a1')
+
+    time.time.return_value = 1151
+    journal.begin(dict(LOT, id='new'))
+    stored = storage.get('lots_journal')
+    assert sorted(k for k in stored if not k.startswith('_')) == [LOT['id'], 'new']
+    assert journal.started(deleted_lot) is False
+    assert journal.completed(LOT, 'asset.pre', 'a1') is True
+
+
+def test_journal_undo():
+    journal = LotJournal()
+    journal.begin(LOT)
+    journal.record(LOT, 'asset.pre', 'a1')
+    journal.record(LOT, 'asset.pre', 'a2')
+    journal.record(LOT, 'asset.finish', 'a1')
+
+    journal.undo(LOT, ['a1'])
+    assert journal.completed(LOT, 'asset.pre', 'a1') is False
+    assert journal.completed(LOT, 'asset.pre', 'a2') is True
+    assert journal.completed(LOT, 'asset.finish', 'a1') is False
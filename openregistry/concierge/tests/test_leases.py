@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+from socket import error
+
+from couchdb.http import ResourceConflict
+
+from openregistry.concierge.leases import LeaseManager
+from openregistry.concierge.storage import MemoryStorage, next_rev
+from openregistry.concierge.utils import save_broken_lots
+
+
+class LeasesDB(object):
+    """'_all_docs' and '_bulk_docs' of CouchDB with revision check."""
+
+    def __init__(self):
+        self.docs = {}
+        self.requests = 0
+
+    def view(self, name, keys, include_docs):
+        self.requests += 1
+        return [{'key': key, 'doc': dict(self.docs[key]) if key in self.docs else None} for key in keys]
+
+    def update(self, docs):
+        self.requests += 1
+        results = []
+        for doc in docs:
+            stored = self.docs.get(doc['_id'])
+            if (stored['_rev'] if stored else None) != doc.get('_rev'):
+                results.append((False, doc['_id'], ResourceConflict()))
+                continue
+            if doc.get('_deleted'):
+                del self.docs[doc['_id']]
+                results.append((True, doc['_id'], None))
+                continue
+            rev = next_rev(doc.get('_rev'))
+            self.docs[doc['_id']] = dict(doc, _rev=rev)
+            results.append((True, doc['_id'], rev))
+        return results
+
+
+def lots(*lot_ids):
+    return [{'id': lot_id} for lot_id in lot_ids]
+
+
+def test_acquire_and_release(mocker):
+    db = LeasesDB()
+    first = LeaseManager(db, node_id='first', ttl=60)
+    second = LeaseManager(db, node_id='second', ttl=60)
+
+    assert first.acquire(lots('lot_1', 'lot_2')) == lots('lot_1', 'lot_2')
+    assert db.requests == 2
+    assert db.docs['lease_lot_1']['owner'] == 'first'
+    assert second.acquire(lots('lot_1', 'lot_2', 'lot_3')) == lots('lot_3')
+
+    # held leases are not requested again
+    db.requests = 0
+    assert first.acquire(lots('lot_1')) == lots('lot_1')
+    assert db.requests == 0
+
+    # release is written by the next request of the node
+    first.release('lot_1')
+    assert 'lease_lot_1' in db.docs
+    assert second.acquire(lots('lot_1')) == []
+    assert first.acquire(lots('lot_3')) == []
+    assert 'lease_lot_1' not in db.docs
+    assert second.acquire(lots('lot_1')) == lots('lot_1')
+
+    # expired lease is taken over
+    time = mocker.patch('openregistry.concierge.leases.time')
+    time.time.return_value = db.docs['lease_lot_2']['expires'] + 1
+    assert second.acquire(lots('lot_2')) == lots('lot_2')
+    first.renew()
+    assert not first.held('lot_2')
+
+
+def test_renew(mocker):
+    db = LeasesDB()
+    manager = LeaseManager(db, node_id='first', ttl=60)
+    time = mocker.patch('openregistry.concierge.leases.time')
+    time.time.return_value = 1000
+    manager.acquire(lots('lot_1', 'lot_2'))
+    manager.release('lot_2')
+
+    time.time.return_value = 1030
+    manager.renew()
+    assert db.docs['lease_lot_1']['expires'] == 1090
+    assert 'lease_lot_2' not in db.docs
+
+    # revision of renewed lease is used to delete it
+    manager.release('lot_1')
+    manager.flush()
+    assert db.docs == {}
+
+
+def test_db_errors(mocker):
+    db = LeasesDB()
+    manager = LeaseManager(db, node_id='first', ttl=60)
+    manager.acquire(lots('lot_1'))
+    manager.release('lot_1')
+
+    update = db.update
+    db.update = mocker.MagicMock(side_effect=error('down'))
+    assert manager.acquire(lots('lot_2')) == []
+    db.view = mocker.MagicMock(side_effect=error('down'))
+    assert manager.acquire(lots('lot_2')) == []
+
+    # released lease is deleted when db is available again
+    db.update = update
+    manager.stop()
+    assert db.docs == {}
+
+
+def test_save_broken_lots_conflict():
+    storage = MemoryStorage()
+    storage.save({'_id': 'broken_lots'})
+    doc = storage.get('broken_lots')
+    other = storage.get('broken_lots')
+    other['lot_2'] = {'rev': '1-b'}
+    storage.save(other)
+
+    doc['lot_1'] = {'rev': '1-a'}
+    save_broken_lots(storage, doc, 'lot_1')
+    stored = storage.get('broken_lots')
+    assert stored['lot_1'] == {'rev': '1-a'}
+    assert stored['lot_2'] == {'rev': '1-b'}
+    assert doc['_rev'] == stored['_rev']
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+import logging
+import sys
+from Queue import Queue
+from StringIO import StringIO
+
+from openregistry.concierge.log import (
+    ContextFilter,
+    QueueHandler,
+    QueueListener,
+    SamplingFilter,
+    log_context,
+    setup_logging_pipeline,
+)
+from openregistry.concierge.metrics import metrics
+
+
+def make_record(message_id=None, msg='Successfully patched asset %s to %s', args=('1', 'pending')):
+    record = logging.LogRecord('test', logging.INFO, __file__, 1, msg, args, None)
+    if message_id:
+        record.MESSAGE_ID = message_id
+    return record
+
+
+def test_sampling_filter_every(mocker):
+    sampling = SamplingFilter({'patch_asset': {'every': 3}})
+
+    results = [sampling.filter(make_record('patch_asset')) for _ in range(6)]
+
+    assert results == [False, False, True, False, False, True]
+    assert all(sampling.filter(make_record('patch_lot')) for _ in range(3))
+    assert all(sampling.filter(make_record()) for _ in range(3))
+
+
+def test_sampling_filter_per_second(mocker):
+    mock_time = mocker.patch('openregistry.concierge.log.time.time')
+    mock_time.return_value = 100.1
+    sampling = SamplingFilter({'patch_asset': {'per_second': 2}})
+    suppressed = metrics.get('logging.suppressed.patch_asset', 0)
+
+    assert [sampling.filter(make_record('patch_asset')) for _ in range(3)] == [True, True, False]
+    assert metrics.get('logging.suppressed.patch_asset') == suppressed + 1
+
+    mock_time.return_value = 101.2
+    assert sampling.filter(make_record('patch_asset')) is True
+
+
+def test_log_context():
+    context = ContextFilter()
+    with log_context(lot_id='lot_1', lot_type='loki'):
+        with log_context(step='verification'):
+            record = make_record()
+            context.filter(record)
+        outer_record = make_record()
+        context.filter(outer_record)
+    record_outside = make_record()
+    context.filter(record_outside)
+
+    assert (record.LOT_ID, record.LOT_TYPE, record.STEP) == ('lot_1', 'loki', 'verification')
+    assert not hasattr(outer_record, 'STEP')
+    assert not hasattr(record_outside, 'LOT_ID')
+
+
+def test_queue_handler_and_listener():
+    stream = StringIO()
+    target = logging.StreamHandler(stream)
+    target.setLevel(logging.INFO)
+    queue = Queue(10)
+    handler = QueueHandler(queue, [target])
+    listener = QueueListener(queue)
+    listener.start()
+
+    handler.handle(make_record())
+    debug_record = make_record()
+    debug_record.levelno = logging.DEBUG
+    handler.handle(debug_record)
+    listener.stop()
+
+    assert stream.getvalue() == 'Successfully patched asset 1 to pending\n'
+
+
+def test_queue_handler_prepares_records():
+    queue = Queue(10)
+    handler = QueueHandler(queue, [])
+    data = {'status': 'pending'}
+    record = logging.LogRecord('test', logging.INFO, __file__, 1, 'Patch %s', (data,), None)
+    handler.handle(record)
+    data['status'] = 'active'
+    try:
+        1 / 0
+    except ZeroDivisionError:
+        handler.handle(logging.LogRecord('test', logging.ERROR, __file__, 1, 'Failed', (), sys.exc_info()))
+
+    queued, _ = queue.get()
+    assert (queued.msg, queued.args) == ("Patch {'status': 'pending'}", None)
+    queued, _ = queue.get()
+    assert queued.exc_info is None
+    assert 'ZeroDivisionError' in queued.exc_text
+    assert 'ZeroDivisionError' in logging.Formatter().format(queued)
+
+
+def test_queue_handler_drops_records_when_full():
+    handler = QueueHandler(Queue(1), [])
+    dropped = metrics.get('logging.dropped', 0)
+
+    handler.handle(make_record())
+    handler.handle(make_record())
+
+    assert metrics.get('logging.dropped') == dropped + 1
+
+
+def test_setup_logging_pipeline():
+    stream = StringIO()
+    logger = logging.getLogger('openregistry.concierge.tests.pipeline')
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    target = logging.StreamHandler(stream)
+    logger.handlers = [target]
+    root_handlers = logging.getLogger().handlers
+
+    listener = setup_logging_pipeline({
+        'loggers': {'openregistry.concierge.tests.pipeline': {}},
+        'logging_pipeline': {'sampling': {'patch_asset': {'every': 2}}}
+    })
+    try:
+        assert isinstance(logger.handlers[0], QueueHandler)
+        assert logger.handlers[0].handlers == (target,)
+        for asset_id in ('1', '2'):
+            logger.info('Successfully patched asset %s', asset_id, extra={'MESSAGE_ID': 'patch_asset'})
+    finally:
+        listener.stop()
+        logging.getLogger().handlers = root_handlers
+
+    assert stream.getvalue() == 'Successfully patched asset 2\n'
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from openregistry.concierge.mirror import AssetMirror
+
+LOT = {'id': 'lot_1', 'assets': ['asset_1', 'asset_2']}
+
+
+@pytest.fixture(scope='function')
+def client(mocker):
+    client = mocker.MagicMock()
+    client.params = {}
+    pages = [
+        ([{'id': 'asset_1', 'status': 'pending', 'assetType': 'basic'},
+          {'id': 'asset_2', 'status': 'pending', 'assetType': 'basic'}], 'offset_1'),
+        ([{'id': 'asset_2', 'status': 'active', 'assetType': 'basic', 'relatedLot': 'lot_1'}], 'offset_2'),
+        ([], 'offset_2'),
+    ]
+
+    def get_assets(params, feed):
+        assets, offset = pages.pop(0)
+        client.params['offset'] = offset
+        return assets
+    client.get_assets.side_effect = get_assets
+    return client
+
+
+def test_mirror_sync(tmpdir, client):
+    path = str(tmpdir.join('mirror.sqlite'))
+    mirror = AssetMirror(client, path=path)
+
+    assert mirror.sync() == 3
+    assert mirror.offset == 'offset_2'
+    assert mirror.get('asset_1') == {'status': 'pending', 'assetType': 'basic', 'relatedLot': None}
+    assert mirror.get('asset_2') == {'status': 'active', 'assetType': 'basic', 'relatedLot': 'lot_1'}
+    assert mirror.get('asset_3') is None
+    assert client.get_assets.call_count == 3
+    assert client.get_assets.call_args[1] == {
+        'params': {'opt_fields': 'status,assetType,relatedLot', 'limit': 1000}, 'feed': 'changes'
+    }
+
+    restarted = AssetMirror(client, path=path)
+    assert restarted.offset == 'offset_2'
+    assert restarted.get('asset_2')['status'] == 'active'
+
+
+def test_mirror_check_assets(tmpdir, client):
+    mirror = AssetMirror(client, path=str(tmpdir.join('mirror.sqlite')))
+    mirror.update([
+        {'id': 'asset_1', 'status': 'active', 'assetType': 'basic', 'relatedLot': 'lot_1'},
+        {'id': 'asset_2', 'status': 'active', 'assetType': 'basic', 'relatedLot': 'lot_1'},
+    ], 'offset_1')
+
+    assert mirror.check_assets(LOT, 'active', ['basic']) is True
+    assert mirror.check_assets(LOT, 'pending', ['basic']) is False
+    assert mirror.check_assets(LOT, 'active', ['compound']) is False
+    assert mirror.check_assets(dict(LOT, id='lot_2'), 'active', ['basic']) is False
+    assert mirror.check_assets(dict(LOT, assets=['asset_3']), 'active', ['basic']) is None
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+import threading
+from Queue import Queue
+from socket import error
+
+import pytest
+
+from openregistry.concierge.changes import LotChange
+from openregistry.concierge.multiprocess import (
+    STOP,
+    FeedReader,
+    ProcessPool,
+    StorageWriter,
+    WriterStorage,
+    partition,
+    processor_config
+)
+from openregistry.concierge.storage import MemoryStorage
+from openregistry.concierge.tests.conftest import TEST_CONFIG
+
+
+def start_writer(storage, processors=2):
+    requests = Queue()
+    replies = [Queue() for _ in range(processors)]
+    writer = StorageWriter(storage)
+    thread = threading.Thread(target=writer.serve, args=(requests, replies))
+    thread.daemon = True
+    thread.start()
+    return writer, requests, replies, thread
+
+
+def test_partition():
+    lot_ids = ['lot_{}'.format(i) for i in range(100)]
+    assert [partition(lot_id, 4) for lot_id in lot_ids] == [partition(lot_id, 4) for lot_id in lot_ids]
+    assert set(partition(lot_id, 4) for lot_id in lot_ids) == {0, 1, 2, 3}
+
+
+def test_changes_of_processors_are_merged():
+    storage = MemoryStorage()
+    storage.save({'_id': 'broken_lots', 'lot_0': {'rev': '1-a'}})
+    _, requests, replies, thread = start_writer(storage)
+    first = WriterStorage(0, requests, replies[0])
+    second = WriterStorage(1, requests, replies[1])
+
+    first_doc = first.get('broken_lots')
+    second_doc = second.get('broken_lots')
+    first_doc['lot_1'] = {'rev': '1-b'}
+    first.save(first_doc)
+    second_doc['lot_2'] = {'rev': '1-c'}
+    del second_doc['lot_0']
+    second.save(second_doc)
+    assert second_doc['_rev'] == storage.get('broken_lots')['_rev']
+
+    stored = storage.get('broken_lots')
+    assert sorted(k for k in stored if not k.startswith('_')) == ['lot_1', 'lot_2']
+    assert first.get('missing', {}) == {}
+
+    # unchanged keys are not sent again
+    first_doc['lot_1']['resolved'] = True
+    first.save(first_doc)
+    assert storage.get('broken_lots')['lot_1'] == {'rev': '1-b', 'resolved': True}
+    assert 'lot_2' in storage.get('broken_lots')
+
+    requests.put(STOP)
+    thread.join(1)
+    assert not thread.is_alive()
+
+
+def test_storage_conflict_and_errors(mocker):
+    storage = MemoryStorage()
+    writer, requests, replies, _ = start_writer(storage, processors=1)
+    proxy = WriterStorage(0, requests, replies[0])
+    doc = {'_id': 'lots_journal', 'a': 1}
+    proxy.save(doc)
+
+    # document saved by another concierge
+    stored = storage.get('lots_journal')
+    storage.save(dict(stored, b=2))
+    doc['c'] = 3
+    proxy.save(doc)
+    assert storage.get('lots_journal')['a'] == 1
+    assert storage.get('lots_journal')['b'] == 2
+    assert storage.get('lots_journal')['c'] == 3
+
+    storage.save = mocker.MagicMock(side_effect=error('down'))
+    doc['d'] = 4
+    with pytest.raises(error):
+        proxy.save(doc)
+    requests.put(STOP)
+
+
+def test_feed_reader(mocker):
+    lots = [
+        LotChange(id='lot_{}'.format(i), rev='1-a', status='verification', assets=[], lotType=lot_type)
+        for i, lot_type in enumerate(['loki', 'unknown', 'basic', 'loki'])
+    ]
+    mocker.patch('openregistry.concierge.worker.lots_feed', return_value=iter(lots))
+    stop_event = threading.Event()
+    queues = [Queue(10), Queue(10)]
+    reader = FeedReader(TEST_CONFIG, mocker.MagicMock(), queues, stop_event)
+
+    assert reader.read() == 3
+    received = []
+    for i, queue in enumerate(queues):
+        while not queue.empty():
+            lot = queue.get()
+            assert isinstance(lot, dict)
+            assert partition(lot['id'], 2) == i
+            received.append(lot['id'])
+    assert sorted(received) == ['lot_0', 'lot_2', 'lot_3']
+
+    # full queue doesn't block stop
+    full = Queue(1)
+    full.put('lot')
+    reader.queues = [full]
+    stop_event.set()
+    assert reader.put({'id': 'lot_0'}) is False
+
+
+def test_processor_config():
+    config = dict(TEST_CONFIG, assets_mirror={'db_path': 'assets.sqlite'}, redrive={'interval': 30})
+    assert processor_config(config) == dict(TEST_CONFIG, assets_mirror=None, redrive=None)
+    assert config['redrive'] == {'interval': 30}
+
+
+def test_db_prepared_once(mocker):
+    prepare = mocker.patch('openregistry.concierge.multiprocess.prepare_couchdb')
+    process = mocker.patch('openregistry.concierge.multiprocess.Process')
+    config = dict(TEST_CONFIG, processes={'workers': 2})
+    pool = ProcessPool(config)
+
+    pool.start()
+    assert prepare.call_count == 1
+    assert prepare.call_args[0][1:] == ('lots_db', mocker.ANY, 'broken_lots')
+    assert process.return_value.start.call_count == 4
+    assert all(c[1]['args'][0] is config for c in process.call_args_list)
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+from munch import munchify
+from openprocurement_client.exceptions import ResourceNotFound
+
+from openregistry.concierge.basic.processing import ProcessingBasic
+from openregistry.concierge.metrics import metrics
+from openregistry.concierge.not_found import NotFoundCache, init_not_found_cache
+from openregistry.concierge.tests.conftest import TEST_CONFIG
+
+
+def lot(rev='1-a'):
+    return {'id': 'lot_1', 'rev': rev, 'status': 'verification', 'assets': ['asset_1'], 'lotType': 'basic'}
+
+
+def test_cache(mocker):
+    metrics.reset()
+    cache = NotFoundCache(max_size=2, ttl=60)
+    time = mocker.patch('openregistry.concierge.not_found.time')
+    time.time.return_value = 1000
+
+    assert cache.known('assets', 'asset_1', lot()) is False
+    cache.add('assets', 'asset_1', lot())
+    assert cache.known('assets', 'asset_1', lot()) is True
+    assert cache.known('lots', 'asset_1', lot()) is False
+    assert cache.known('assets', 'asset_1', dict(lot(), id='lot_2')) is False
+
+    time.time.return_value = 1060
+    assert cache.known('assets', 'asset_1', lot()) is False
+
+    cache.add('assets', 'asset_1', lot())
+    # new revision of the lot invalidates the entry
+    assert cache.known('assets', 'asset_1', lot('2-a')) is False
+    assert cache.known('assets', 'asset_1', lot()) is False
+
+    for asset_id in ('asset_1', 'asset_2', 'asset_3'):
+        cache.add('assets', asset_id, lot())
+    assert cache.known('assets', 'asset_1', lot()) is False
+    assert cache.known('assets', 'asset_3', lot()) is True
+
+    assert metrics.get('not_found_cache.hits') == 2
+    assert metrics.get('not_found_cache.misses') == 7
+    assert metrics.get('not_found_cache.evictions') == 1
+    assert metrics.get('not_found_cache.size') == 2
+
+
+def test_init_not_found_cache():
+    assert init_not_found_cache({}) is None
+    cache = init_not_found_cache({'not_found_cache': {'max_size': 5, 'ttl': 10}})
+    assert (cache.max_size, cache.ttl) == (5, 10)
+
+
+def test_processing_skips_known_not_found(mocker):
+    lots_client = mocker.MagicMock()
+    assets_client = mocker.MagicMock()
+    clients = {'lots_client': lots_client, 'assets_client': assets_client, 'db': mocker.MagicMock(),
+               'auction_client': mocker.MagicMock(), 'not_found_cache': NotFoundCache()}
+    processing = ProcessingBasic(TEST_CONFIG['lots']['basic'], clients, {})
+    lots_client.get_lot.side_effect = ResourceNotFound()
+    assets_client.get_asset.side_effect = ResourceNotFound()
+
+    for _ in range(3):
+        assert processing.check_lot(lot()) is False
+        assert processing.check_assets(lot()) is False
+    assert lots_client.get_lot.call_count == 1
+    assert assets_client.get_asset.call_count == 1
+
+    lots_client.get_lot.side_effect = None
+    lots_client.get_lot.return_value = munchify({'data': {'status': 'verification'}})
+    assert processing.check_lot(lot('2-a')) is True
+    assert processing.check_assets(lot('2-a')) is False
+    assert assets_client.get_asset.call_count == 2
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+from openregistry.concierge.constants import DEFERRED, FAILED, PROCESSED
+from openregistry.concierge.metrics import metrics
+from openregistry.concierge.pipelines import LotPipeline
+
+
+def lot(lot_id, rev='1-a'):
+    return {'id': lot_id, 'rev': rev, 'status': 'verification', 'lotType': 'loki'}
+
+
+def make_worker(mocker, process_lot=None, outcome=PROCESSED):
+    worker = mocker.MagicMock()
+    worker.deferred_lots = {}
+    processed = []
+
+    def process(lot):
+        if process_lot:
+            process_lot(lot)
+        processed.append((lot['id'], lot['rev']))
+        return outcome
+    worker.process_lot.side_effect = process
+    return worker, processed
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_offer(mocker):
+    metrics.reset()
+    worker, _ = make_worker(mocker)
+    pipeline = LotPipeline('loki', worker, queue_size=2)
+
+    assert pipeline.offer(lot('lot_1')) is True
+    assert pipeline.offer(lot('lot_2')) is True
+    assert pipeline.offer(lot('lot_3')) is False
+    # newer revision replaces queued one even if the queue is full
+    assert pipeline.offer(lot('lot_1', '2-a')) is True
+
+    assert [(l['id'], l['rev']) for l in pipeline.pending.values()] == [('lot_1', '2-a'), ('lot_2', '1-a')]
+    assert metrics.get('pipeline.loki.dropped') == 1
+    assert metrics.get('pipeline.loki.queue') == 2
+
+
+def test_processing(mocker):
+    worker, processed = make_worker(mocker)
+    pipeline = LotPipeline('loki', worker, concurrency=2)
+    pipeline.start()
+    try:
+        for lot_id in ('lot_1', 'lot_2', 'lot_3'):
+            pipeline.offer(lot(lot_id))
+        assert wait_for(lambda: len(processed) == 3)
+        # processed revision isn't queued again
+        pipeline.offer(lot('lot_1'))
+        assert len(pipeline.pending) == 0
+        pipeline.offer(lot('lot_1', '2-a'))
+        assert wait_for(lambda: len(processed) == 4)
+    finally:
+        pipeline.stop(1)
+
+    assert sorted(processed) == [('lot_1', '1-a'), ('lot_1', '2-a'), ('lot_2', '1-a'), ('lot_3', '1-a')]
+    status = pipeline.status()
+    assert status['processed'] == 4
+    assert status['queue'] == 0
+    assert status['active'] == 0
+
+
+def test_lot_is_not_processed_concurrently(mocker):
+    release = threading.Event()
+    worker, processed = make_worker(mocker, lambda l: release.wait(5))
+    pipeline = LotPipeline('loki', worker, concurrency=2)
+    pipeline.start()
+    try:
+        pipeline.offer(lot('lot_1'))
+        assert wait_for(lambda: pipeline.status()['active'] == 1)
+        pipeline.offer(lot('lot_1', '2-a'))
+        time.sleep(0.1)
+        assert pipeline.status()['active'] == 1
+        release.set()
+        assert wait_for(lambda: len(processed) == 2)
+    finally:
+        pipeline.stop(1)
+
+    assert processed == [('lot_1', '1-a'), ('lot_1', '2-a')]
+
+
+def test_deferred_lot_is_offered_again(mocker):
+    worker, processed = make_worker(mocker, outcome=DEFERRED)
+    pipeline = LotPipeline('loki', worker)
+    pipeline.start()
+    try:
+        pipeline.offer(lot('lot_1'))
+        assert wait_for(lambda: pipeline.status()['processed'] == 1)
+        pipeline.offer(lot('lot_1'))
+        assert wait_for(lambda: pipeline.status()['processed'] == 2)
+    finally:
+        pipeline.stop(1)
+
+
+def test_failed_lot_is_offered_again(mocker):
+    worker, processed = make_worker(mocker, outcome=FAILED)
+    pipeline = LotPipeline('loki', worker)
+    pipeline.start()
+    try:
+        pipeline.offer(lot('lot_1'))
+        assert wait_for(lambda: len(processed) == 1)
+        pipeline.offer(lot('lot_1'))
+        assert wait_for(lambda: len(processed) == 2)
+    finally:
+        pipeline.stop(1)
+
+    assert processed == [('lot_1', '1-a'), ('lot_1', '1-a')]
+
+
+def test_slow_lot_type_does_not_block_others(mocker):
+    release = threading.Event()
+    worker, processed = make_worker(mocker, lambda l: l['lotType'] == 'loki' and release.wait(5))
+    loki = LotPipeline('loki', worker)
+    basic = LotPipeline('basic', worker)
+    loki.start()
+    basic.start()
+    try:
+        loki.offer(lot('loki_1'))
+        loki.offer(lot('loki_2'))
+        for lot_id in ('basic_1', 'basic_2'):
+            basic.offer(dict(lot(lot_id), lotType='basic'))
+        assert wait_for(lambda: len(processed) == 2)
+        assert sorted(processed) == [('basic_1', '1-a'), ('basic_2', '1-a')]
+        release.set()
+        assert wait_for(lambda: len(processed) == 4)
+    finally:
+        release.set()
+        loki.stop(1)
+        basic.stop(1)
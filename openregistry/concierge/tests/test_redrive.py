@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+import time
+
+from munch import munchify
+from openprocurement_client.exceptions import RequestFailed
+
+from openregistry.concierge.basic.processing import ProcessingBasic
+from openregistry.concierge.changes import lot_from_row
+from openregistry.concierge.circuit_breaker import CircuitOpen
+from openregistry.concierge.constants import PROCESSED
+from openregistry.concierge.leases import LeaseManager
+from openregistry.concierge.redrive import RedriveScheduler
+from openregistry.concierge.tests.conftest import TEST_CONFIG
+from openregistry.concierge.tests.test_leases import LeasesDB
+from openregistry.concierge.utils import log_broken_lot
+
+
+def lot_doc(lot_id, rev='2-a'):
+    return {'_id': lot_id, '_rev': rev, 'status': 'verification', 'assets': ['asset_1'],
+            'lotID': 'UA-1', 'lotType': 'basic'}
+
+
+def make_worker(mocker, records, docs):
+    worker = mocker.MagicMock()
+    worker.errors_doc = dict(records, _id='broken_lots', _rev='1-a')
+    worker.db.get.side_effect = lambda lot_id: docs.get(lot_id)
+    worker.upstreams_available.return_value = True
+    worker.leases = None
+    processing = worker.lot_type_processing_configurator.get.return_value
+    return worker, processing
+
+
+def test_due_lots(mocker):
+    worker, _ = make_worker(mocker, {
+        'new': {'rev': '2-a', 'resolved': False},
+        'retried': {'rev': '2-a', 'resolved': False, 'redrive_attempts': 2},
+        'exhausted': {'rev': '2-a', 'resolved': False, 'redrive_attempts': 5},
+        'resolved': {'rev': '2-a', 'resolved': True},
+    }, {})
+    scheduler = RedriveScheduler(worker, base_delay=10, max_delay=35, max_attempts=5)
+
+    assert scheduler.due_lots(now=1000) == []
+    assert scheduler.schedule == {'new': 1010, 'retried': 1035}
+    assert sorted(scheduler.due_lots(now=1010)) == ['new']
+    assert sorted(scheduler.due_lots(now=1035)) == ['new', 'retried']
+    assert [scheduler.delay(n) for n in range(4)] == [10, 20, 35, 35]
+
+
+def server_error():
+    return RequestFailed(response=munchify({'text': 'Bad Gateway', 'status_code': 502}))
+
+
+def real_processing(mocker, worker):
+    lots_client = mocker.MagicMock()
+    lots_client.get_lot.return_value = munchify({'data': {'status': 'verification'}})
+    assets_client = mocker.MagicMock()
+    assets_client.get_asset.return_value = munchify({'data': {'status': 'pending', 'assetType': 'basic'}})
+    clients = {'lots_client': lots_client, 'assets_client': assets_client, 'db': worker.storage}
+    processing = ProcessingBasic(TEST_CONFIG['lots']['basic'], clients, worker.errors_doc)
+    worker.lot_type_processing_configurator.get.return_value = processing
+    return processing
+
+
+def test_redrive_success(mocker):
+    worker, _ = make_worker(mocker, {'lot_1': {'rev': '2-a', 'resolved': False}},
+                            {'lot_1': lot_doc('lot_1')})
+    processing = real_processing(mocker, worker)
+    scheduler = RedriveScheduler(worker)
+    scheduler.schedule['lot_1'] = 0
+
+    assert scheduler.redrive('lot_1') is True
+
+    assert processing.lots_client.patch_lot.call_args[0] == ('lot_1', {'data': {'status': 'active.salable'}})
+    assert worker.errors_doc['lot_1'] == {'rev': '2-a', 'resolved': True, 'redrive_attempts': 1}
+    worker.storage.save.assert_called_once_with(worker.errors_doc)
+    assert scheduler.schedule == {}
+
+
+def test_redrive_resumes_transition(mocker):
+    docs = {'lot_1': lot_doc('lot_1')}
+    worker, _ = make_worker(mocker, {}, docs)
+    processing = real_processing(mocker, worker)
+    processing.lots_client.patch_lot.side_effect = [server_error(), None]
+
+    # assets are attached to the lot, lot PATCH failed
+    lot = lot_from_row({'doc': docs['lot_1']})
+    processing.process_lots(lot)
+    record = worker.errors_doc['lot_1']
+    assert (record['message'], record['resolved'], record['assets_patched']) == \
+        ('patching lot to active.salable', False, True)
+    assert processing.assets_client.patch_asset.call_count == 2
+
+    scheduler = RedriveScheduler(worker)
+    assert scheduler.redrive('lot_1') is True
+
+    # remaining step is resumed, assets are neither checked nor patched again
+    assert processing.lots_client.patch_lot.call_args[0] == ('lot_1', {'data': {'status': 'active.salable'}})
+    assert processing.assets_client.get_asset.call_count == 1
+    assert processing.assets_client.patch_asset.call_count == 2
+    assert worker.errors_doc['lot_1']['resolved'] is True
+    assert processing.journal.started(lot) is False
+
+
+def test_redrive_leaves_unresumable_lot(mocker):
+    record = {'rev': '2-a', 'resolved': False, 'assets_patched': True, 'message': 'patching lot to active.salable'}
+    worker, _ = make_worker(mocker, {'lot_1': dict(record)}, {'lot_1': lot_doc('lot_1')})
+    processing = real_processing(mocker, worker)
+    processing.assets_client.get_asset.return_value = munchify({
+        'data': {'status': 'active', 'assetType': 'basic', 'relatedLot': 'lot_1'}
+    })
+    scheduler = RedriveScheduler(worker, max_attempts=5)
+
+    # journal entry is lost, starting over would patch lot to 'pending'
+    assert scheduler.redrive('lot_1') is False
+    assert processing.lots_client.patch_lot.call_count == 0
+    assert processing.assets_client.get_asset.call_count == 0
+    assert worker.errors_doc['lot_1'] == dict(record, redrive_attempts=5)
+    assert scheduler.due_lots() == []
+
+
+def test_redrive_failing_upstream(mocker):
+    worker, _ = make_worker(mocker, {
+        'lot_1': {'rev': '2-a', 'resolved': False}, 'lot_2': {'rev': '2-a', 'resolved': False}
+    }, {'lot_1': lot_doc('lot_1'), 'lot_2': lot_doc('lot_2')})
+    processing = real_processing(mocker, worker)
+    scheduler = RedriveScheduler(worker, base_delay=10)
+
+    # lot is skipped by processor, record is kept without counting attempt
+    processing.lots_client.get_lot.side_effect = server_error()
+    assert scheduler.redrive('lot_1') is None
+    assert worker.errors_doc['lot_1'] == {'rev': '2-a', 'resolved': False}
+    assert scheduler.schedule['lot_1'] > time.time() + 5
+
+    # processing failed on getting assets
+    processing.lots_client.get_lot.side_effect = None
+    processing.assets_client.get_asset.side_effect = server_error()
+    assert scheduler.redrive('lot_2') is False
+    assert worker.errors_doc['lot_2'] == {'rev': '2-a', 'resolved': False, 'redrive_attempts': 1}
+    assert scheduler.schedule['lot_2'] > time.time() + 15
+    assert processing.lots_client.patch_lot.call_count == 0
+
+
+def test_redrive_failure(mocker):
+    worker, processing = make_worker(mocker, {'lot_1': {'rev': '2-a', 'resolved': False}},
+                                     {'lot_1': lot_doc('lot_1')})
+    processing.process_lots.side_effect = lambda lot: log_broken_lot(
+        worker.storage, mocker.MagicMock(), worker.errors_doc, lot, 'patching assets to active'
+    )
+    scheduler = RedriveScheduler(worker, base_delay=10, max_attempts=1)
+
+    assert scheduler.redrive('lot_1') is False
+
+    record = worker.errors_doc['lot_1']
+    assert record['resolved'] is False
+    assert record['message'] == 'patching assets to active'
+    assert record['redrive_attempts'] == 1
+    assert scheduler.schedule['lot_1'] > time.time() + 15
+    assert scheduler.due_lots() == []
+    assert 'lot_1' not in scheduler.schedule
+
+
+def test_redrive_skips(mocker):
+    worker, processing = make_worker(mocker, {
+        'changed': {'rev': '1-a', 'resolved': False},
+        'unavailable': {'rev': '2-a', 'resolved': False},
+        'interrupted': {'rev': '2-a', 'resolved': False},
+    }, {'changed': lot_doc('changed'), 'unavailable': lot_doc('unavailable'), 'interrupted': lot_doc('interrupted')})
+    scheduler = RedriveScheduler(worker)
+
+    assert scheduler.redrive('changed') is None
+    assert scheduler.redrive('missing') is None
+    assert processing.process_lots.call_count == 0
+
+    worker.upstreams_available.return_value = False
+    assert scheduler.redrive('unavailable') is None
+    assert 'unavailable' in scheduler.schedule
+
+    worker.upstreams_available.return_value = True
+    processing.process_lots.side_effect = CircuitOpen('assets')
+    assert scheduler.redrive('interrupted') is None
+    assert 'redrive_attempts' not in worker.errors_doc['interrupted']
+    assert worker.storage.save.call_count == 0
+
+
+def test_redrive_takes_lease(mocker):
+    worker, processing = make_worker(mocker, {
+        'lot_1': {'rev': '2-a', 'resolved': False}, 'lot_2': {'rev': '2-a', 'resolved': False}
+    }, {'lot_1': lot_doc('lot_1'), 'lot_2': lot_doc('lot_2')})
+    leases_db = LeasesDB()
+    worker.leases = LeaseManager(leases_db, node_id='first')
+    other = LeaseManager(leases_db, node_id='second')
+    held = []
+    processing.process_lots.side_effect = lambda lot: held.append(worker.leases.held(lot['id'])) or PROCESSED
+    scheduler = RedriveScheduler(worker)
+
+    assert scheduler.redrive('lot_1') is True
+    assert held == [True]
+    assert not worker.leases.held('lot_1')
+
+    # lot is processed by another node
+    other.acquire([{'id': 'lot_2'}])
+    assert scheduler.redrive('lot_2') is None
+    assert processing.process_lots.call_count == 1
+    assert worker.errors_doc['lot_2'] == {'rev': '2-a', 'resolved': False}
+    assert 'lot_2' in scheduler.schedule
+
+
+def test_redrive_threads(mocker):
+    worker, processing = make_worker(mocker, {
+        'lot_{}'.format(i): {'rev': '2-a', 'resolved': False} for i in range(4)
+    }, {'lot_{}'.format(i): lot_doc('lot_{}'.format(i)) for i in range(4)})
+    processed = []  # mock call counters aren't thread-safe
+
+    def process_lots(lot):
+        processed.append(lot['id'])
+        return PROCESSED
+    processing.process_lots.side_effect = process_lots
+    scheduler = RedriveScheduler(worker, interval=0.05, base_delay=0, concurrency=2)
+
+    scheduler.start()
+    for _ in range(100):
+        if len(processed) == 4:
+            break
+        time.sleep(0.01)
+    scheduler.stop()
+
+    assert sorted(processed) == [
+        'lot_0', 'lot_1', 'lot_2', 'lot_3'
+    ]
+    assert all(worker.errors_doc['lot_{}'.format(i)]['resolved'] for i in range(4))
+    assert scheduler.queue.empty()
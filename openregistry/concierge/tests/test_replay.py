@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+from json import load
+
+from openregistry.concierge.tests.conftest import TEST_CONFIG
+from openregistry.concierge.replay import Replayer, read_changes, read_responses
+
+ROOT = os.path.dirname(__file__) + '/data/'
+
+
+def dump_changes(tmpdir, lots):
+    changes = tmpdir.join('changes.jsonl')
+    changes.write(''.join(json.dumps(lot) + '\n' for lot in lots))
+    return str(changes)
+
+
+def test_read_changes(tmpdir):
+    with open(ROOT + 'lots.json') as lots:
+        lots = [lot['data'] for lot in load(lots)]
+    path = dump_changes(tmpdir, lots)
+
+    result = read_changes(path)
+
+    assert 'next' and '__iter__' in dir(result)  # assert generator object is returned
+    assert list(result) == lots
+
+
+def test_replay_records_decisions(tmpdir):
+    with open(ROOT + 'lots.json') as lots:
+        lots = [lot['data'] for lot in load(lots)]
+    unknown_lot = dict(lots[2], lotType='wrong')
+    path = dump_changes(tmpdir, [lots[0], lots[1], lots[5], unknown_lot])
+    report = tmpdir.join('report.jsonl')
+
+    replayer = Replayer(TEST_CONFIG)
+    with open(str(report), 'w') as report_file:
+        summary = replayer.replay(read_changes(path), report_file)
+
+    assert summary['lots'] == 3
+    assert summary['skipped'] == 1
+    assert summary['errors'] == 0
+    assert summary['decisions'] == 9 + 5 + 3
+
+    results = list(read_changes(str(report)))
+    assert [r['id'] for r in results] == [lots[0]['id'], lots[1]['id'], lots[5]['id']]
+
+    basic_verification = [(d['resource'], d['action']) for d in results[0]['decisions']]
+    assert basic_verification == [('assets', 'patch_asset')] * 8 + [('lots', 'patch_lot')]
+    assert results[0]['decisions'][-1]['args'][1] == {'data': {'status': 'active.salable'}}
+    assert results[1]['decisions'][-1]['args'][1] == {'data': {'status': 'dissolved'}}
+
+
+def test_replay_uses_recorded_responses(tmpdir):
+    with open(ROOT + 'lots.json') as lots:
+        lots = [lot['data'] for lot in load(lots)]
+    lot = lots[0]
+    responses = tmpdir.join('responses.jsonl')
+    responses.write(json.dumps({
+        'resource': 'assets',
+        'id': lot['assets'][0],
+        'data': {'id': lot['assets'][0], 'status': 'active', 'assetType': 'basic'}
+    }) + '\n')
+
+    replayer = Replayer(TEST_CONFIG, read_responses(str(responses)))
+    replayer.replay(iter([lot]))
+
+    assert replayer.decisions == [{
+        'resource': 'lots',
+        'action': 'patch_lot',
+        'args': [lot['id'], {'data': {'status': 'pending'}}],
+        'kwargs': {}
+    }]
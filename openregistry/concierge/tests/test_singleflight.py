@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+import threading
+
+import pytest
+from openprocurement_client.exceptions import ResourceNotFound
+
+from openregistry.concierge.metrics import metrics
+from openregistry.concierge.singleflight import SingleFlightClient
+
+
+class SlowClient(object):
+
+    def __init__(self, error=None):
+        self.release = threading.Event()
+        self.calls = []
+        self.error = error
+
+    def get_asset(self, asset_id):
+        self.calls.append(asset_id)
+        self.release.wait(5)
+        if self.error:
+            raise self.error
+        return {'data': {'id': asset_id, 'status': 'pending'}}
+
+    def patch_asset(self, asset_id, data):
+        self.calls.append(('patch', asset_id))
+        return data
+
+
+def call_concurrently(func, times):
+    results = [None] * times
+
+    def run(i):
+        try:
+            results[i] = func()
+        except Exception as e:
+            results[i] = e
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(times)]
+    for thread in threads:
+        thread.start()
+    return threads, results
+
+
+def wait_for_waiters(client, key, number):
+    while True:
+        with client._flight._lock:
+            call = client._flight._calls.get(key)
+            if call is not None and call.waiters == number:
+                return
+        threading.Event().wait(0.01)
+
+
+def test_concurrent_gets_are_coalesced():
+    metrics.reset()
+    upstream = SlowClient()
+    client = SingleFlightClient(upstream, 'assets')
+
+    threads, results = call_concurrently(lambda: client.get_asset('asset_1'), 4)
+    wait_for_waiters(client, ('get_asset', ('asset_1',), ()), 3)
+    upstream.release.set()
+    for thread in threads:
+        thread.join()
+
+    assert upstream.calls == ['asset_1']
+    assert all(r == {'data': {'id': 'asset_1', 'status': 'pending'}} for r in results)
+    # every caller owns its result
+    assert len(set(id(r) for r in results)) == 4
+    assert metrics.get('singleflight.assets.coalesced') == 3
+    assert client._flight._calls == {}
+
+    client.get_asset('asset_1')
+    assert upstream.calls == ['asset_1', 'asset_1']
+
+
+def test_exception_is_raised_to_every_caller():
+    upstream = SlowClient(error=ResourceNotFound())
+    client = SingleFlightClient(upstream, 'assets')
+
+    threads, results = call_concurrently(lambda: client.get_asset('asset_1'), 3)
+    wait_for_waiters(client, ('get_asset', ('asset_1',), ()), 2)
+    upstream.release.set()
+    for thread in threads:
+        thread.join()
+
+    assert upstream.calls == ['asset_1']
+    assert all(isinstance(r, ResourceNotFound) for r in results)
+
+
+def test_other_calls_are_not_coalesced():
+    upstream = SlowClient()
+    upstream.release.set()
+    client = SingleFlightClient(upstream, 'assets')
+
+    assert client.patch_asset('asset_1', {'status': 'active'}) == {'status': 'active'}
+    assert client.get_asset('asset_2')['data']['id'] == 'asset_2'
+    with pytest.raises(AttributeError):
+        client.get_auction('auction_1')
+    assert upstream.calls == [('patch', 'asset_1'), 'asset_2']
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+import logging
+
+import pytest
+from couchdb.http import ResourceConflict
+
+from openregistry.concierge.journal import LotJournal
+from openregistry.concierge.storage import MemoryStorage, SQLiteStorage, init_storage
+from openregistry.concierge.utils import ConfigError, log_broken_lot, resolve_broken_lot
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def storage(request, tmpdir):
+    if request.param == 'memory':
+        return MemoryStorage()
+    return SQLiteStorage(str(tmpdir.join('state.sqlite')))
+
+
+def test_get_save(storage):
+    assert storage.get('broken_lots') is None
+    assert storage.get('broken_lots', {}) == {}
+
+    doc = {'_id': 'broken_lots'}
+    doc_id, rev = storage.save(doc)
+    assert doc_id == 'broken_lots'
+    assert rev.startswith('1-')
+    assert doc['_rev'] == rev
+
+    doc['lot_1'] = {'rev': '1-a', 'resolved': False}
+    storage.save(doc)
+    assert doc['_rev'].startswith('2-')
+    assert storage.get('broken_lots') == doc
+
+    # stored doc isn't changed by changes of saved one
+    doc['lot_2'] = {}
+    assert 'lot_2' not in storage.get('broken_lots')
+
+
+def test_conflict(storage):
+    doc = {'_id': 'lots_journal'}
+    storage.save(doc)
+    stale = storage.get('lots_journal')
+    storage.save(doc)
+
+    with pytest.raises(ResourceConflict):
+        storage.save(stale)
+    with pytest.raises(ResourceConflict):
+        storage.save({'_id': 'lots_journal'})
+
+
+def test_broken_lots_and_journal(storage):
+    logger = logging.getLogger('test_storage')
+    errors_doc = {'_id': 'broken_lots'}
+    storage.save(errors_doc)
+    lot = {'id': 'lot_1', 'rev': '1-a', 'status': 'verification', 'assets': ['asset_1']}
+
+    log_broken_lot(storage, logger, errors_doc, lot, 'patching assets to active')
+    resolve_broken_lot(storage, logger, errors_doc, dict(lot, rev='2-a'))
+    assert storage.get('broken_lots')['lot_1']['resolved'] is True
+    assert storage.get('broken_lots')['lot_1']['rev'] == '2-a'
+
+    journal = LotJournal(storage, batch_size=1)
+    journal.begin(lot)
+    journal.record(lot, 'asset.pre', 'asset_1')
+    assert LotJournal(storage).completed(lot, 'asset.pre', 'asset_1')
+
+
+def test_init_storage(tmpdir):
+    db = object()
+    assert init_storage({}, db) is db
+    assert init_storage({'storage': {'backend': 'couchdb'}}, db) is db
+    assert isinstance(init_storage({'storage': {'backend': 'memory'}}, db), MemoryStorage)
+    assert isinstance(init_storage({'storage': {'backend': 'sqlite', 'path': str(tmpdir.join('s.sqlite'))}}, db),
+                      SQLiteStorage)
+    with pytest.raises(ConfigError):
+        init_storage({'storage': {'backend': 'redis'}}, db)
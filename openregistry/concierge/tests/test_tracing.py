@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+import json
+
+from munch import munchify
+from openprocurement_client.exceptions import Conflict, ResourceNotFound
+from retrying import retry
+
+from openregistry.concierge.basic.processing import ProcessingBasic
+from openregistry.concierge.tests.conftest import TEST_CONFIG
+from openregistry.concierge.tracing import Tracer, TracingClient, current_trace, traced
+from openregistry.concierge.utils import retry_on_error
+
+
+def lot():
+    return {'id': 'lot_1', 'rev': '1-a', 'status': 'verification', 'assets': ['asset_1', 'asset_2'],
+            'lotType': 'basic'}
+
+
+def read_traces(path):
+    with open(path) as traces:
+        return [json.loads(line) for line in traces]
+
+
+def test_processing_trace(mocker, tmpdir):
+    path = str(tmpdir.join('traces.jsonl'))
+    lots_client = mocker.MagicMock()
+    lots_client.get_lot.return_value = munchify({'data': {'status': 'verification'}})
+    assets_client = mocker.MagicMock()
+    assets_client.get_asset.side_effect = [
+        munchify({'data': {'id': 'asset_1', 'assetType': 'basic', 'status': 'pending'}}),
+        ResourceNotFound(),
+    ]
+    clients = {'lots_client': TracingClient(lots_client, 'lots'),
+               'assets_client': TracingClient(assets_client, 'assets'),
+               'db': mocker.MagicMock(), 'auction_client': mocker.MagicMock()}
+    processing = ProcessingBasic(TEST_CONFIG['lots']['basic'], clients, {})
+    tracer = Tracer(path, slow_threshold=0)
+
+    # calls out of lot processing are not traced
+    assert processing.check_lot(lot()) is True
+    tracer.start(lot())
+    assert processing.check_lot(lot()) is True
+    assert processing.check_assets(lot()) is False
+    trace = tracer.stop()
+    tracer.close()
+    assert current_trace() is None
+
+    [written] = read_traces(path)
+    assert written['lot_id'] == 'lot_1'
+    assert written['step'] == 'verification'
+    assert written['lot_type'] == 'basic'
+    assert written['duration'] == round(trace.duration, 6)
+    spans = [(s['name'], s['parent'], s.get('upstream'), s.get('status_code'), s.get('error'))
+             for s in written['spans']]
+    assert spans == [
+        ('check_lot', None, None, None, None),
+        ('lots.get_lot', 0, 'lots', None, None),
+        ('check_assets', None, None, None, None),
+        ('assets.get_asset', 2, 'assets', None, None),
+        ('assets.get_asset', 2, 'assets', 404, 'ResourceNotFound'),
+    ]
+
+
+def test_retries(mocker, tmpdir):
+    client = mocker.MagicMock()
+    client.patch_asset.side_effect = [Conflict(), Conflict(), None]
+    client = TracingClient(client, 'assets')
+
+    @traced('_patch_single_asset', retried=True)
+    @retry(stop_max_attempt_number=5, retry_on_exception=retry_on_error, wait_fixed=1)
+    def patch(asset_id):
+        client.patch_asset(asset_id, {})
+
+    tracer = Tracer(str(tmpdir.join('traces.jsonl')))
+    trace = tracer.start(lot())
+    patch('asset_1')
+    tracer.stop()
+    tracer.close()
+
+    assert trace.spans[0].name == '_patch_single_asset'
+    assert trace.spans[0].attrs == {'retries': 2}
+    assert [span.attrs.get('status_code') for span in trace.spans[1:]] == [409, 409, None]
+
+
+def test_slow_filter(tmpdir):
+    path = str(tmpdir.join('traces.jsonl'))
+    tracer = Tracer(path, slow_threshold=10, slow_call_threshold=0.5)
+
+    for duration in (0.1, 0.6):
+        trace = tracer.start(lot())
+        span = trace.open('patch_lot')
+        trace.close(span)
+        span.duration = duration
+        tracer.stop()
+    tracer.close()
+
+    [written] = read_traces(path)
+    assert written['spans'][0]['duration'] == 0.6
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+import pytest
+from munch import munchify
+from openprocurement_client.exceptions import PreconditionFailed, UnprocessableEntity
+
+from openregistry.concierge.utils import ResourceChanged, patch_if_match, retry_on_error
+
+
+def test_patch_if_match(mocker):
+    client = mocker.MagicMock()
+    client.prefix_path = '/api/0.1/lots'
+
+    patch_if_match(client, 'lot_1', {'data': {'status': 'pending'}}, '2-a')
+
+    client._patch_resource_item.assert_called_once_with(
+        '/api/0.1/lots/lot_1', {'data': {'status': 'pending'}}, headers={'If-Match': '"2-a"'}
+    )
+
+
+def test_patch_if_match_changed(mocker):
+    client = mocker.MagicMock()
+    client.prefix_path = '/api/0.1/lots'
+    client._patch_resource_item.side_effect = PreconditionFailed(
+        response=munchify({'text': 'Precondition Failed', 'status_code': 412})
+    )
+
+    with pytest.raises(ResourceChanged) as e:
+        patch_if_match(client, 'lot_1', {'data': {'status': 'pending'}}, '2-a')
+    assert e.value.message == 'Resource lot_1 was changed since revision 2-a'
+    assert retry_on_error(e.value) is False
+
+    client._patch_resource_item.side_effect = UnprocessableEntity(
+        response=munchify({'text': 'Unprocessable Entity', 'status_code': 422})
+    )
+    with pytest.raises(UnprocessableEntity):
+        patch_if_match(client, 'lot_1', {'data': {'status': 'pending'}}, '2-a')
@@ -1,10 +1,12 @@
 # -*- coding: utf-8 -*-
 import os
+import signal
 from copy import deepcopy
 from json import load
 
 import pytest
 
+from openregistry.concierge.constants import DEFERRED, PROCESSED
 from openregistry.concierge.tests.conftest import TEST_CONFIG
 from openregistry.concierge.worker import BotWorker
 
@@ -135,3 +137,71 @@ def test_run(bot, logger, mocker, almost_always_true):
 
     assert mock_process_basic.process_lots.call_count == 6
     assert mock_process_loki.process_lots.call_count == 2
+
+
+def test_run_defers_lots_with_open_breaker(bot, logger, mocker):
+    mock_process_basic = mocker.MagicMock()
+    mock_process_loki = mocker.MagicMock()
+    bot.lot_type_processing_configurator = {'basic': mock_process_basic, 'loki': mock_process_loki}
+    with open(ROOT + 'lots.json') as lots:
+        lots = load(lots)
+    salable_lot = deepcopy(lots[5]['data'])
+    salable_lot['status'] = 'active.salable'
+    basic_lot = deepcopy(lots[0]['data'])
+    for lot in (salable_lot, basic_lot):
+        bot.errors_doc.pop(lot['id'], None)
+
+    mock_process_basic.process_lots.return_value = PROCESSED
+    for _ in range(bot.breakers['auctions'].failure_threshold):
+        bot.breakers['auctions'].record_failure()
+
+    assert bot.process_lot(salable_lot) == DEFERRED
+    assert bot.process_lot(basic_lot) == PROCESSED
+
+    assert mock_process_loki.process_lots.call_count == 0
+    assert mock_process_basic.process_lots.call_count == 1
+    assert bot.deferred_lots.keys() == [salable_lot['id']]
+
+    bot.process_deferred_lots()
+    assert mock_process_loki.process_lots.call_count == 0
+
+    bot.breakers['auctions'].record_success()
+    bot.process_deferred_lots()
+    assert mock_process_loki.process_lots.call_count == 1
+    assert mock_process_loki.process_lots.call_args[0][0] == salable_lot
+    assert bot.deferred_lots == {}
+
+
+def test_shutdown(bot, logger, mocker, almost_always_true):
+    mock_get_lot = mocker.patch.object(bot, 'get_lot', autospec=True)
+    mock_flush = mocker.patch.object(bot.journal, 'flush', autospec=True)
+    mock_force_exit = mocker.patch.object(bot, '_force_exit', autospec=True)
+    mock_process_basic = mocker.MagicMock()
+    bot.lot_type_processing_configurator = {'basic': mock_process_basic}
+    with open(ROOT + 'lots.json') as lots:
+        lots = load(lots)
+    for lot in lots[:2]:
+        lot['data']['rev'] = '123'
+        bot.errors_doc.pop(lot['data']['id'], None)
+    mock_get_lot.return_value = (lot['data'] for lot in lots[:2])
+
+    def process_lots(lot):
+        assert bot.in_flight == 1
+        bot.shutdown(signal.SIGTERM)
+        # handler only sets the flag, worker is stopped by the run loop
+        assert not bot.stop_event.is_set()
+    mock_process_basic.process_lots.side_effect = process_lots
+
+    mocker.patch('openregistry.concierge.worker.IS_BOT_WORKING', almost_always_true(3))
+    bot.run()
+
+    assert mock_get_lot.call_count == 1
+    assert mock_process_basic.process_lots.call_count == 1
+    assert bot.in_flight == 0
+    assert mock_flush.call_count == 2
+    assert bot._shutdown_timer.is_alive() is False
+    assert mock_force_exit.call_count == 0
+
+    log_strings = logger.log_capture_string.getvalue().split('\n')
+    assert log_strings[1] == 'Stopping worker (signal {}), waiting for 0 lots in processing'.format(signal.SIGTERM)
+    assert log_strings[2] == 'Worker stopped'
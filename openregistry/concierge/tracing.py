@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import threading
+import time
+from functools import wraps
+from logging.handlers import RotatingFileHandler
+
+from openregistry.concierge.metrics import metrics
+
+_local = threading.local()
+
+
+class Span(object):
+    __slots__ = ('name', 'parent', 'started', 'duration', 'attrs', 'children')
+
+    def __init__(self, name, parent, attrs):
+        self.name = name
+        self.parent = parent
+        self.started = time.time()
+        self.duration = None
+        self.attrs = attrs
+        self.children = 0
+
+
+class Trace(object):
+    """Spans of processing of a single lot, in order they were started."""
+
+    def __init__(self, lot):
+        self.lot = lot
+        self.started = time.time()
+        self.duration = None
+        self.spans = []
+        self.stack = []
+
+    def open(self, name, **attrs):
+        parent = self.stack[-1] if self.stack else None
+        span = Span(name, parent, attrs)
+        if parent is not None:
+            self.spans[parent].children += 1
+        self.stack.append(len(self.spans))
+        self.spans.append(span)
+        return span
+
+    def close(self, span, error=None):
+        span.duration = time.time() - span.started
+        if error is not None:
+            span.attrs['error'] = error.__class__.__name__
+            span.attrs['status_code'] = getattr(error, 'status_code', None)
+        self.stack.pop()
+
+    def to_dict(self):
+        return {
+            'lot_id': self.lot['id'],
+            'rev': self.lot.get('rev'),
+            'lot_type': self.lot.get('lotType'),
+            'step': self.lot.get('status'),
+            'started': self.started,
+            'duration': round(self.duration, 6),
+            'spans': [dict(span.attrs, id=i, name=span.name, parent=span.parent,
+                           offset=round(span.started - self.started, 6), duration=round(span.duration or 0, 6))
+                      for i, span in enumerate(self.spans)],
+        }
+
+
+def current_trace():
+    return getattr(_local, 'trace', None)
+
+
+def call_in_span(name, func, args, kwargs, upstream=None, retried=False):
+    trace = current_trace()
+    if trace is None:
+        return func(*args, **kwargs)
+    span = trace.open(name, upstream=upstream) if upstream else trace.open(name)
+    try:
+        result = func(*args, **kwargs)
+    except Exception as e:
+        trace.close(span, e)
+        raise
+    else:
+        trace.close(span)
+        return result
+    finally:
+        if retried:
+            span.attrs['retries'] = max(0, span.children - 1)
+
+
+def traced(name, retried=False):
+    """
+    Records call of the decorated function as a span of the current
+    trace. If 'retried' is set, function is expected to be wrapped in
+    @retry and make one upstream call per attempt, span gets number of
+    'retries'.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            return call_in_span(name, func, args, kwargs, retried=retried)
+        return wrapper
+    return decorator
+
+
+class TracingClient(object):
+    """
+    Proxy around API client or db, which records every call made during
+    lot processing as a span with 'upstream' and status code of error.
+    """
+
+    def __init__(self, client, upstream):
+        self._client = client
+        self._upstream = upstream
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            return call_in_span('{}.{}'.format(self._upstream, name), attr, args, kwargs, upstream=self._upstream)
+        return call
+
+
+class Tracer(object):
+    """
+    Collects traces of lot processing and writes slow ones as JSON lines
+    to rotating 'path' file: traces, which took 'slow_threshold' seconds
+    or more, or contain a span of 'slow_call_threshold' seconds or more.
+    """
+
+    def __init__(self, path='concierge_traces.jsonl', slow_threshold=5, slow_call_threshold=1,
+                 max_bytes=10485760, backup_count=5):
+        self.slow_threshold = slow_threshold
+        self.slow_call_threshold = slow_call_threshold
+        self.handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count)
+        self.handler.setFormatter(logging.Formatter('%(message)s'))
+
+    def start(self, lot):
+        """
+        Binds new trace of the lot to the current thread.
+
+        Returns:
+            Trace
+        """
+        _local.trace = Trace(lot)
+        return _local.trace
+
+    def stop(self):
+        trace, _local.trace = current_trace(), None
+        if trace is None:
+            return
+        trace.duration = time.time() - trace.started
+        if self.is_slow(trace):
+            self.write(trace)
+        return trace
+
+    def is_slow(self, trace):
+        return trace.duration >= self.slow_threshold or any(
+            span.duration >= self.slow_call_threshold for span in trace.spans if span.duration is not None
+        )
+
+    def write(self, trace):
+        record = logging.makeLogRecord({'msg': json.dumps(trace.to_dict(), sort_keys=True)})
+        self.handler.handle(record)
+        metrics.incr('tracing.written')
+
+    def close(self):
+        self.handler.close()
@@ -1,5 +1,8 @@
 # -*- coding: utf-8 -*-
+import time
+from threading import RLock
 from couchdb import Server, Session
+from couchdb.http import ResourceConflict
 from socket import error
 from logging import addLevelName, Logger
 
@@ -15,10 +18,21 @@ from openprocurement_client.exceptions import (
     PreconditionFailed,
 )
 
+from .changes import ChangesPage, lot_from_row
+from .circuit_breaker import CircuitBreaker, CircuitBreakerClient, CircuitOpen
+from .constants import FAILED, PROCESSED, SKIPPED
+from .concurrency import AdaptiveLimitClient, init_adaptive_limit
+from .deadline import DeadlineClient, DeadlineExceeded
 from .design import sync_design
+from .mirror import AssetMirror
+from .singleflight import SingleFlightClient
+from .tracing import TracingClient
 
 CONTINUOUS_CHANGES_FEED_FLAG = True
 EXCEPTIONS = (Forbidden, RequestFailed, ResourceNotFound, UnprocessableEntity, PreconditionFailed, Conflict)
+UPSTREAMS = ('lots', 'assets', 'auctions')
+# broken lots doc is shared by the main loop and re-drive threads
+BROKEN_LOTS_LOCK = RLock()
 STATUS_FILTER = """function(doc, req) {
   if(
     doc.status == "verification" || 
@@ -47,6 +61,19 @@ class ConfigError(Exception):
     pass
 
 
+class ResourceChanged(Exception):
+    """
+    Raised by conditional requests, if resource was changed since
+    the revision, request was conditioned on.
+    """
+
+    def __init__(self, resource_id, revision):
+        super(ResourceChanged, self).__init__(resource_id, revision)
+        self.resource_id = resource_id
+        self.revision = revision
+        self.message = 'Resource {} was changed since revision {}'.format(resource_id, revision)
+
+
 def prepare_couchdb(couch_url, db_name, logger, errors_doc):
     server = Server(couch_url, session=Session(retry_delays=range(10)))
     try:
@@ -69,7 +96,8 @@ def prepare_couchdb(couch_url, db_name, logger, errors_doc):
 
 
 def prepare_couchdb_filter(db, doc, filter_name, filter, logger):
-    design_doc = db['_design/{}'.format(doc)]
+    doc_id = '_design/{}'.format(doc)
+    design_doc = db.get(doc_id, {'_id': doc_id})
     if not design_doc.get('filters', ''):
         design_doc['filters'] = {}
     if filter_name not in design_doc['filters']:
@@ -79,43 +107,88 @@ def prepare_couchdb_filter(db, doc, filter_name, filter, logger):
         design_doc['filters'][filter_name] = filter
         logger.debug('Successfully updated {0}/{1} filter.'.format(doc, filter_name))
     else:
+        # saving unchanged design doc would create a new revision for nothing
         logger.debug('Filter {0}/{1} already exists.'.format(doc, filter_name))
+        return
     db.save(design_doc)
 
 
-def continuous_changes_feed(db, logger, limit=100, filter_doc='lots/status'):
+def continuous_changes_feed(db, logger, limit=100, filter_doc='lots/status', state=None, stream=False):
+    """
+    Yields lots from db changes feed, filtered by 'filter_doc'.
+
+    If 'state' dictionary is passed, it's updated with feed position:
+    'processed_seq' - seq of the last change consumer asked next item after,
+    'caught_up_seq' and 'caught_up_at' - seq and time of the last empty page.
 
+    If 'stream' is True, rows of every page are parsed and yielded as they
+    arrive (see ChangesPage), so memory usage doesn't depend on 'limit'.
+    """
+    if state is None:
+        state = {}
     last_seq_id = 0
     while CONTINUOUS_CHANGES_FEED_FLAG:
+        page = ChangesPage(db, last_seq_id, limit, filter_doc, stream=stream)
         try:
-            data = db.changes(include_docs=True, since=last_seq_id, limit=limit, filter=filter_doc)
+            for row in page:
+                yield lot_from_row(row)
+                state['processed_seq'] = row['seq']
         except error as e:
             logger.error('Failed to get lots from DB: [Errno {}] {}'.format(e.errno, e.strerror))
             break
-        last_seq_id = data['last_seq']
-        if len(data['results']) != 0:
-            for row in data['results']:
-                item = {
-                    'id': row['doc']['_id'],
-                    'rev': row['doc']['_rev'],
-                    'status': row['doc']['status'],
-                    'assets': row['doc']['assets'],
-                    'lotID': row['doc']['lotID'],
-                    'lotType': row['doc']['lotType'],
-                    'decisions': row['doc'].get('decisions'),
-                    'auctions': row['doc'].get('auctions'),
-                }
-                yield item
-        else:
+        last_seq_id = page.last_seq
+        state['processed_seq'] = last_seq_id
+        if page.count == 0:
+            state['caught_up_seq'] = last_seq_id
+            state['caught_up_at'] = time.time()
             break
 
 
-def log_broken_lot(db, logger, doc, lot, message):
-    lot['resolved'] = False
-    lot['message'] = message
+def seq_number(seq):
+    """
+    Returns numeric part of CouchDB seq, which is integer in CouchDB 1.x
+    and string like '123-g1AAAA...' in CouchDB 2.x.
+    """
+    if isinstance(seq, (int, long)):
+        return seq
+    return int(str(seq).split('-')[0])
+
+
+def patch_outcome(result):
+    """
+    Returns:
+        str: outcome of processing, which ended with lot PATCH
+             'result' (see 'patch_lot' of processors).
+    """
+    if result is None:
+        return SKIPPED
+    return PROCESSED if result else FAILED
+
+
+def save_broken_lots(db, doc, lot_id):
+    """
+    Saves document of broken lots. If it was saved by another concierge
+    node, entry of the lot is written over the stored document, so
+    entries of lots, processed by other nodes, are kept.
+    """
     try:
-        doc[lot['id']] = lot
         db.save(doc)
+    except ResourceConflict:
+        entry = doc[lot_id]
+        stored = db.get(doc['_id'])
+        # document is updated in place, as processors keep reference to it
+        doc.clear()
+        doc.update(stored)
+        doc[lot_id] = entry
+        db.save(doc)
+
+
+def log_broken_lot(db, logger, doc, lot, message):
+    lot = dict(lot, resolved=False, message=message)
+    try:
+        with BROKEN_LOTS_LOCK:
+            doc[lot['id']] = lot
+            save_broken_lots(db, doc, lot['id'])
     except error as e:
         logger.error('Database error: {}'.format(e.message))
         raise ConfigError(e.strerror)
@@ -125,9 +198,10 @@ def log_broken_lot(db, logger, doc, lot, message):
 
 def resolve_broken_lot(db, logger, doc, lot):
     try:
-        doc[lot['id']]['resolved'] = True
-        doc[lot['id']]['rev'] = lot['rev']
-        db.save(doc)
+        with BROKEN_LOTS_LOCK:
+            doc[lot['id']]['resolved'] = True
+            doc[lot['id']]['rev'] = lot['rev']
+            save_broken_lots(db, doc, lot['id'])
     except error as e:
         logger.error('Database error: {}'.format(e.message))
         raise ConfigError(e.strerror)
@@ -135,14 +209,45 @@ def resolve_broken_lot(db, logger, doc, lot):
         return doc
 
 
-def init_clients(config, logger):
+def update_broken_lot(db, logger, doc, lot_id, **fields):
+    try:
+        with BROKEN_LOTS_LOCK:
+            doc[lot_id].update(fields)
+            save_broken_lots(db, doc, lot_id)
+    except error as e:
+        logger.error('Database error: {}'.format(e.message))
+        raise ConfigError(e.strerror)
+    else:
+        return doc
+
+
+def couchdb_url(config):
+    if config['db'].get('login', '') \
+            and config['db'].get('password', ''):
+        return "http://{login}:{password}@{host}:{port}".format(**config['db'])
+    return "http://{host}:{port}".format(**config['db'])
+
+
+def open_couchdb(config):
+    """
+    Returns:
+        couchdb.Database: lots db, which is expected to be prepared
+                          (see 'prepare_couchdb').
+    """
+    server = Server(couchdb_url(config), session=Session(retry_delays=range(10)))
+    return server[config['db']['name']]
+
+
+def init_clients(config, logger, prepare_db=True):
     clients_from_config = {
-        'lots_client': {'section': 'lots', 'client_instance': LotsClient},
-        'assets_client': {'section': 'assets', 'client_instance': AssetsClient},
-        'auction_client': {'section': 'assets', 'client_instance': AuctionsClient}
+        'lots_client': {'section': 'lots', 'upstream': 'lots', 'client_instance': LotsClient},
+        'assets_client': {'section': 'assets', 'upstream': 'assets', 'client_instance': AssetsClient},
+        'auction_client': {'section': 'assets', 'upstream': 'auctions', 'client_instance': AuctionsClient}
     }
     result = ''
     exceptions = []
+    breakers = init_breakers(config)
+    adaptive_limit = init_adaptive_limit(config)
 
     for key, item in clients_from_config.items():
         section = item['section']
@@ -152,22 +257,27 @@ def init_clients(config, logger):
                 host_url=config[section]['api']['url'],
                 api_version=config[section]['api']['version']
             )
-            clients_from_config[key] = client
+            if adaptive_limit is not None:
+                client = AdaptiveLimitClient(client, adaptive_limit)
+            clients_from_config[key] = CircuitBreakerClient(client, breakers[item['upstream']])
+            if config.get('singleflight'):
+                # merged GETs pass the breaker once
+                clients_from_config[key] = SingleFlightClient(clients_from_config[key], item['upstream'])
+            if config.get('tracing'):
+                clients_from_config[key] = TracingClient(clients_from_config[key], item['upstream'])
+            if config.get('watchdog'):
+                clients_from_config[key] = DeadlineClient(clients_from_config[key], item['upstream'])
             result = ('ok', None)
         except Exception as e:
             exceptions.append(e)
             result = ('failed', e)
         logger.check('{} - {}'.format(key, result[0]), result[1])
     try:
-        if config['db'].get('login', '') \
-                and config['db'].get('password', ''):
-            db_url = "http://{login}:{password}@{host}:{port}".format(
-                **config['db']
-            )
+        if prepare_db:
+            clients_from_config['db'] = prepare_couchdb(couchdb_url(config), config['db']['name'], logger,
+                                                        config['errors_doc'])
         else:
-            db_url = "http://{host}:{port}".format(**config['db'])
-
-        clients_from_config['db'] = prepare_couchdb(db_url, config['db']['name'], logger, config['errors_doc'])
+            clients_from_config['db'] = open_couchdb(config)
         result = ('ok', None)
     except Exception as e:
         exceptions.append(e)
@@ -177,10 +287,71 @@ def init_clients(config, logger):
     if exceptions:
         raise exceptions[0]
 
+    clients_from_config['breakers'] = breakers
+    clients_from_config['adaptive_limit'] = adaptive_limit
     return clients_from_config
 
 
+def init_assets_mirror(config):
+    """
+    Creates assets mirror, if 'assets_mirror' section is present in
+    configuration. Mirror uses its own assets client to follow the feed.
+
+    Returns:
+        AssetMirror or None
+    """
+    if not config.get('assets_mirror'):
+        return
+    client = AssetsClient(
+        key=config['assets']['api']['token'],
+        host_url=config['assets']['api']['url'],
+        api_version=config['assets']['api']['version']
+    )
+    return AssetMirror(client, **config['assets_mirror'])
+
+
+def init_breakers(config):
+    """
+    Creates circuit breaker for every upstream API. Settings are taken
+    from 'circuit_breaker' section of configuration and could be
+    overridden in 'circuit_breaker' subsection of upstream section.
+
+    Returns:
+        dict: upstream name -> CircuitBreaker
+    """
+    breakers = {}
+    for upstream in UPSTREAMS:
+        settings = dict(config.get('circuit_breaker', {}))
+        settings.update(config.get(upstream, {}).get('circuit_breaker', {}))
+        breakers[upstream] = CircuitBreaker(upstream, **settings)
+    return breakers
+
+
+def patch_if_match(client, resource_id, patch_data, revision):
+    """
+    Makes PATCH request to the resource with 'If-Match' precondition on
+    known revision of its document, so resource is patched only if it
+    wasn't changed since.
+
+    Args:
+        client: API client, e.g. lots_client.
+        resource_id: id of the resource.
+        patch_data (dict): request body.
+        revision (str): revision of the resource document.
+
+    Raises:
+        ResourceChanged: if API responded with 412 Precondition Failed.
+    """
+    url = '{}/{}'.format(client.prefix_path, resource_id)
+    try:
+        return client._patch_resource_item(url, patch_data, headers={'If-Match': '"{}"'.format(revision)})
+    except PreconditionFailed:
+        raise ResourceChanged(resource_id, revision)
+
+
 def retry_on_error(exception):
+    if isinstance(exception, (CircuitOpen, DeadlineExceeded)):
+        return False
     if isinstance(exception, EXCEPTIONS) and (exception.status_code >= 500 or exception.status_code in [409, 412, 429]):
         return True
     return False
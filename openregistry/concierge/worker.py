@@ -3,8 +3,12 @@ import argparse
 import logging
 import logging.config
 import os
+import signal
+import sys
 import time
 import yaml
+from collections import OrderedDict
+from threading import Event, Lock, Timer
 from retrying import retry
 
 from openprocurement_client.exceptions import (
@@ -17,14 +21,35 @@ from openprocurement_client.exceptions import (
 )
 
 from openregistry.concierge.utils import (
+    log_broken_lot,
     resolve_broken_lot,
     continuous_changes_feed,
+    init_assets_mirror,
     init_clients
 )
+from openregistry.concierge.auction_index import AuctionIndex
+from openregistry.concierge.circuit_breaker import CircuitOpen
+from openregistry.concierge.deadline import DeadlineExceeded, Watchdog
+from openregistry.concierge.feed import PrefetchingFeed
+from openregistry.concierge.health import start_health_server
+from openregistry.concierge.journal import LotJournal
+from openregistry.concierge.leases import LeaseManager
+from openregistry.concierge.log import log_context, setup_logging_pipeline
+from openregistry.concierge.metrics import metrics
+from openregistry.concierge.multiprocess import ProcessPool
+from openregistry.concierge.not_found import init_not_found_cache
+from openregistry.concierge.pipelines import LotPipeline
+from openregistry.concierge.redrive import RedriveScheduler
+from openregistry.concierge.storage import init_storage
+from openregistry.concierge.tracing import Tracer, TracingClient
+from openregistry.concierge.replay import Replayer, read_changes, read_responses
 from openregistry.concierge.loki.processing import ProcessingLoki
 from openregistry.concierge.basic.processing import ProcessingBasic
 from openregistry.concierge.constants import (
+    BROKEN,
     DEFAULTS,
+    DEFERRED,
+    FAILED,
 )
 
 logger = logging.getLogger(__name__)
@@ -33,37 +58,106 @@ EXCEPTIONS = (Forbidden, RequestFailed, ResourceNotFound, UnprocessableEntity, P
 
 HANDLED_STATUSES = ('verification', 'recomposed', 'pending.dissolution', 'pending.sold', 'pending.deleted')
 
+LOT_UPSTREAMS = {
+    'active.salable': ('lots', 'assets', 'auctions'),
+}
+DEFAULT_LOT_UPSTREAMS = ('lots', 'assets')
+
 IS_BOT_WORKING = True
 
 
+def lots_feed(db, config, state):
+    """
+    Receiving lots from db, which are filtered by CouchDB filter
+    function specified in the configuration file. If 'prefetch' section
+    is present in configuration, next pages are fetched in background
+    while lots are processed. If 'stream_changes' is set, rows of
+    changes pages are parsed as they arrive.
+
+    Returns:
+        generator: Generator object with the received lots.
+    """
+    if config.get('prefetch'):
+        return iter(PrefetchingFeed(
+            db, logger,
+            filter_doc=config['db']['filter'],
+            state=state,
+            stream=config.get('stream_changes', False),
+            **config['prefetch']
+        ))
+    return continuous_changes_feed(
+        db, logger,
+        filter_doc=config['db']['filter'],
+        state=state,
+        stream=config.get('stream_changes', False)
+    )
+
+
 class BotWorker(object):
-    def __init__(self, config):
+    def __init__(self, config, storage=None, prepare_db=True):
         """
         Args:
             config: dictionary with configuration data
+            storage: storage of broken lots, journal and auctions index,
+                     created from configuration if not passed
+            prepare_db: if False, lots db is only opened, it's expected
+                        to be prepared by another process
         """
         self.lot_type_processing_configurator = {}
+        self.pipelines = {}
+        self.deferred_lots = OrderedDict()
         self.config = config
+        self.stop_event = Event()
+        self.stop_requested = False
+        self.stop_signal = None
+        self.feed_state = {}
+        self.heartbeat = time.time()
+        self.in_flight = 0
+        self._in_flight_lock = Lock()
+        self._shutdown_timer = None
 
-        created_clients = init_clients(config, logger)
+        created_clients = init_clients(config, logger, prepare_db)
+
+        created_clients['assets_mirror'] = init_assets_mirror(config)
+        created_clients['not_found_cache'] = init_not_found_cache(config)
 
         for key, item in created_clients.items():
             setattr(self, key, item)
-        self.errors_doc = self.db.get(self.config['errors_doc'])
+        # broken lots, journal and auctions index are kept in storage, lots db is used for the feed
+        self.storage = storage if storage is not None else init_storage(config, self.db)
+        self.tracer = Tracer(**config['tracing']) if config.get('tracing') else None
+        traced_storage = TracingClient(self.storage, 'couchdb') if self.tracer is not None else self.storage
+        self.errors_doc = self.storage.get(self.config['errors_doc'])
+        if self.errors_doc is None:
+            self.errors_doc = {'_id': self.config['errors_doc']}
+            self.storage.save(self.errors_doc)
+        self.journal = LotJournal(traced_storage, **config.get('journal', {}))
 
+        auction_index = AuctionIndex(traced_storage, **config.get('auction_index', {}))
+        processing_clients = dict(created_clients, db=traced_storage, auction_index=auction_index)
         if config['lots'].get('loki'):
-            process_loki = ProcessingLoki(config['lots']['loki'], created_clients, self.errors_doc)
-            self._register_aliases(process_loki)
+            process_loki = ProcessingLoki(config['lots']['loki'], processing_clients, self.errors_doc, self.journal)
+            self._register_aliases(process_loki, 'loki')
         if config['lots'].get('basic'):
-            process_basic = ProcessingBasic(config['lots']['basic'], created_clients, self.errors_doc)
-            self._register_aliases(process_basic)
+            process_basic = ProcessingBasic(config['lots']['basic'], processing_clients, self.errors_doc, self.journal)
+            self._register_aliases(process_basic, 'basic')
+
+        self.redrive = RedriveScheduler(self, **config['redrive']) if config.get('redrive') else None
+        self.watchdog = Watchdog(**config['watchdog']) if config.get('watchdog') else None
+        # leases are shared by all nodes, so they are kept in lots db regardless of storage
+        self.leases = LeaseManager(self.db, **config['leases']) if config.get('leases') else None
 
         self.sleep = self.config['time_to_sleep']
         self.patch_log_doc = self.db.get('patch_requests')
 
-    def _register_aliases(self, processing):
+    def _register_aliases(self, processing, name=None):
+        pipeline = None
+        if name and self.config['lots'][name].get('pipeline'):
+            pipeline = LotPipeline(name, self, limit=self.adaptive_limit, **self.config['lots'][name]['pipeline'])
         for lt in processing.handled_lot_types:
             self.lot_type_processing_configurator[lt] = processing
+            if pipeline:
+                self.pipelines[lt] = pipeline
 
     def run(self):
         """
@@ -78,41 +172,271 @@ class BotWorker(object):
         upload to document and marked as broken), received lot will be skipped
         and not passed to 'process_lots' method. If value of this field is differ,
         field 'resolved' of broken lot in db document will be changed from 'false'
-        to 'true' and lot will be passed to 'process_lots' method.
+        to 'true' and lot will be passed to 'process_lots' method. Unchanged
+        broken lots are retried in background, if 'redrive' is configured
+        (see RedriveScheduler).
+
+        Lots of types, which have 'pipeline' section in configuration, are
+        passed to their LotPipeline and processed in its threads, other
+        lots are processed in the loop.
+
+        If 'leases' are configured, only lots, which lease was acquired by
+        this node, are processed (see 'acquire_leases').
 
         Returns:
             None
         """
         logger.info("Starting worker")
-        while IS_BOT_WORKING:
-            for lot in self.get_lot():
-                if lot['lotType'] not in self.lot_type_processing_configurator:
-                    logger.warning('Such lotType %s is not supported by this concierge configuration' % lot['lotType'])
-                    continue
-                broken_lot = self.errors_doc.get(lot['id'], None)
-                if broken_lot:
-                    if broken_lot['rev'] == lot['rev']:
-                        continue
-                    else:
-                        errors_doc = resolve_broken_lot(self.db, logger, self.errors_doc, lot)
-                        self.lot_type_processing_configurator[lot['lotType']].process_lots(errors_doc[lot['id']])
-                else:
-                    self.lot_type_processing_configurator[lot['lotType']].process_lots(lot)
-            time.sleep(self.sleep)
+        if self.assets_mirror is not None:
+            self.assets_mirror.start()
+        if self.redrive is not None:
+            self.redrive.start()
+        if self.leases is not None:
+            self.leases.start()
+        for pipeline in set(self.pipelines.values()):
+            pipeline.start()
+        while IS_BOT_WORKING and not self.stopping():
+            self.heartbeat = time.time()
+            self.process_deferred_lots()
+            for lot in self.acquire_leases(self.get_lot()):
+                self.heartbeat = time.time()
+                if self.stopping():
+                    break
+                self.dispatch_lot(lot)
+            self.journal.flush()
+            if self.leases is not None:
+                self.leases.flush()
+            deadline = time.time() + self.sleep
+            while not self.stopping() and time.time() < deadline:
+                self.stop_event.wait(min(0.5, deadline - time.time()))
+        if self.stopping():
+            self.finish_shutdown()
 
-    def get_lot(self):
+    def shutdown(self, signum=None, frame=None):
+        """
+        Requests stop of the worker, which is performed by 'run' loop
+        (see 'stopping').
+
+        Could be used as a signal handler.
+        """
+        # only the flag is set here: logging, events and timers take locks,
+        # which the interrupted thread could hold
+        self.stop_signal = signum
+        self.stop_requested = True
+
+    def stopping(self):
+        """
+        Stops reading of the feed, if stop was requested. Lots, which are
+        in processing, are allowed to finish within 'shutdown_timeout'
+        seconds, after that pending writes are flushed and process exits
+        forcibly.
+
+        Returns:
+            bool: True if worker is stopping.
+        """
+        if self.stop_requested and not self.stop_event.is_set():
+            logger.info('Stopping worker (signal {}), waiting for {} lots in processing'.format(
+                self.stop_signal, self.in_flight))
+            self.stop_event.set()
+            self._shutdown_timer = Timer(self.config.get('shutdown_timeout', 30), self._force_exit)
+            self._shutdown_timer.daemon = True
+            self._shutdown_timer.start()
+        return self.stop_event.is_set()
+
+    def finish_shutdown(self):
+        """
+        Waits for lots in processing, flushes pending writes and
+        cancels the forced exit.
+        """
+        deadline = time.time() + self.config.get('shutdown_timeout', 30)
+        if self.redrive is not None:
+            self.redrive.stop(max(0, deadline - time.time()))
+        for pipeline in set(self.pipelines.values()):
+            pipeline.stop(max(0, deadline - time.time()))
+        while self.in_flight and time.time() < deadline:
+            time.sleep(0.1)
+        self.flush()
+        if self.leases is not None:
+            self.leases.stop()
+        if self.assets_mirror is not None:
+            self.assets_mirror.stop()
+        if self.tracer is not None:
+            self.tracer.close()
+        if self._shutdown_timer is not None:
+            self._shutdown_timer.cancel()
+        logger.info('Worker stopped')
+
+    def _force_exit(self):
+        logger.error('Shutdown timeout expired with {} lots in processing'.format(self.in_flight))
+        self.flush()
+        logging.shutdown()
+        os._exit(1)
+
+    def flush(self):
+        """
+        Saves all pending writes of the worker. Broken lots are saved
+        immediately, so only journal is flushed.
+        """
+        self.journal.flush()
+
+    def acquire_leases(self, lots):
+        """
+        Skips lots of not supported types and, if 'leases' are configured,
+        lots, which are processed by other nodes. Leases of lots, processed
+        in the loop, are acquired in batches, lots of pipelines acquire
+        leases in their threads (see 'process_lot').
+
+        Returns:
+            generator: Generator object with lots to dispatch.
+        """
+        batch = []
+        for lot in lots:
+            if lot['lotType'] not in self.lot_type_processing_configurator:
+                logger.warning('Such lotType %s is not supported by this concierge configuration' % lot['lotType'])
+                continue
+            if self.leases is None or lot['lotType'] in self.pipelines:
+                yield lot
+                continue
+            batch.append(lot)
+            if len(batch) >= self.leases.batch_size:
+                for acquired in self.leases.acquire(batch):
+                    yield acquired
+                batch = []
+        if batch:
+            for acquired in self.leases.acquire(batch):
+                yield acquired
+
+    def _track_in_flight(self, delta):
+        with self._in_flight_lock:
+            self.in_flight += delta
+            metrics.set('in_flight', self.in_flight)
+
+    def dispatch_lot(self, lot):
+        """
+        Passes lot to the pipeline of its lotType or processes it in place.
+
+        Returns:
+            None
+        """
+        self.deferred_lots.pop(lot['id'], None)
+        pipeline = self.pipelines.get(lot['lotType'])
+        if pipeline is None:
+            self.process_lot(lot)
+        elif not pipeline.offer(lot):
+            logger.debug('Queue of {} pipeline is full, lot {} is left for the next pass'.format(
+                pipeline.name, lot['id']))
+
+    def process_lot(self, lot):
         """
-        Receiving lots from db, which are filtered by CouchDB filter
-        function specified in the configuration file.
+        Passes lot to the processor of its lotType, taking into account
+        lots marked as broken (see 'run'). If circuit breaker of any
+        upstream, needed for the lot, is open, lot is not processed but
+        deferred to the retry queue.
+
+        If 'watchdog' is configured, lot, which processing exceeded its
+        deadline, is marked as broken with timings of upstream calls.
+        If 'tracing' is configured, processing of the lot is traced
+        (see Tracer). If 'leases' are configured, lot is processed only
+        if its lease is held by this node, lease is released afterwards.
 
         Returns:
-            generator: Generator object with the received lots.
+            str: outcome of the processing (see constants), DEFERRED if
+                 the lot was deferred or is processed by another node.
+        """
+        if self.leases is None:
+            return self._process_lot(lot)
+        if not self.leases.acquire([lot]):
+            logger.debug('Lot {} is processed by another node'.format(lot['id']))
+            return DEFERRED
+        try:
+            return self._process_lot(lot)
+        finally:
+            self.leases.release(lot['id'])
+
+    def _process_lot(self, lot):
+        if not self.upstreams_available(lot):
+            self.defer_lot(lot)
+            return DEFERRED
+        broken_lot = self.errors_doc.get(lot['id'], None)
+        if broken_lot:
+            if broken_lot['rev'] == lot['rev']:
+                return BROKEN
+            errors_doc = resolve_broken_lot(self.storage, logger, self.errors_doc, lot)
+            lot = errors_doc[lot['id']]
+        started = time.time()
+        self._track_in_flight(1)
+        with log_context(lot_id=lot['id'], lot_type=lot['lotType'], step=lot['status']):
+            deadline = self.watchdog.start(lot) if self.watchdog is not None else None
+            if self.tracer is not None:
+                self.tracer.start(lot)
+            try:
+                outcome = self.lot_type_processing_configurator[lot['lotType']].process_lots(lot)
+            except CircuitOpen as e:
+                logger.warning('Processing of lot {} interrupted, {}'.format(lot['id'], e.message))
+                self.defer_lot(lot)
+                outcome = DEFERRED
+            except DeadlineExceeded as e:
+                logger.warning('Processing of lot {} interrupted, {}'.format(lot['id'], e.message))
+                outcome = FAILED
+            finally:
+                self._track_in_flight(-1)
+                if deadline is not None:
+                    self.watchdog.stop()
+                if self.tracer is not None:
+                    self.tracer.stop()
+            if deadline is not None and deadline.exceeded:
+                log_broken_lot(self.storage, logger, self.errors_doc, dict(lot, timing=deadline.timing()),
+                               'processing deadline of {}s exceeded'.format(deadline.timeout))
+                outcome = BROKEN
+            duration = time.time() - started
+            logger.debug('Processed lot %s in %.6fs', lot['id'], duration,
+                         extra={'MESSAGE_ID': 'process_lot', 'DURATION': duration})
+        return outcome
+
+    def upstreams_available(self, lot):
+        for upstream in LOT_UPSTREAMS.get(lot['status'], DEFAULT_LOT_UPSTREAMS):
+            if not self.breakers[upstream].available:
+                return False
+        return True
+
+    def defer_lot(self, lot):
+        if lot['id'] not in self.deferred_lots:
+            logger.info('Lot {} deferred until upstreams are available'.format(lot['id']))
+        self.deferred_lots[lot['id']] = lot
+        metrics.set('deferred_lots', len(self.deferred_lots))
+
+    def process_deferred_lots(self):
+        """
+        Retries deferred lots, which upstreams became available.
+        Lots, which upstreams are still unavailable, stay in the queue.
+
+        Returns:
+            None
+        """
+        for lot_id, lot in self.deferred_lots.items():
+            if self.stopping():
+                break
+            if self.upstreams_available(lot):
+                self.dispatch_lot(lot)
+        metrics.set('deferred_lots', len(self.deferred_lots))
+
+    def get_lot(self):
+        """
+        Returns:
+            generator: Generator object with lots received from db (see 'lots_feed').
         """
         logger.info('Getting Lots')
-        return continuous_changes_feed(
-            self.db, logger,
-            filter_doc=self.config['db']['filter']
-        )
+        return lots_feed(self.db, self.config, self.feed_state)
+
+
+def replay(config, params):
+    responses = read_responses(params.responses) if params.responses else {}
+    replayer = Replayer(config, responses)
+    if params.report:
+        with open(params.report, 'w') as report:
+            replayer.replay(read_changes(params.replay), report)
+    else:
+        replayer.replay(read_changes(params.replay))
 
 
 def main():
@@ -121,6 +445,12 @@ def main():
     parser.add_argument('-t', dest='check', action='store_const',
                         const=True, default=False,
                         help='Clients check only')
+    parser.add_argument('--replay', dest='replay', type=str, default=None,
+                        help='Dry-run lot changes from JSON-lines dump instead of db')
+    parser.add_argument('--responses', dest='responses', type=str, default=None,
+                        help='JSON-lines file with recorded API responses for replay')
+    parser.add_argument('--report', dest='report', type=str, default=None,
+                        help='File to write replay decisions and timings to')
     params = parser.parse_args()
     config = {}
     if os.path.isfile(params.config):
@@ -128,10 +458,26 @@ def main():
             config = yaml.load(config_object.read())
         logging.config.dictConfig(config)
     DEFAULTS.update(config)
-    worker = BotWorker(DEFAULTS)
-    if params.check:
-        exit()
-    worker.run()
+    if DEFAULTS['processes'].get('workers') and not (params.replay or params.check):
+        # every process sets up its own logging pipeline
+        sys.exit(ProcessPool(DEFAULTS).run())
+    listener = setup_logging_pipeline(DEFAULTS)
+    try:
+        if params.replay:
+            replay(DEFAULTS, params)
+            return
+        worker = BotWorker(DEFAULTS)
+        if params.check:
+            return
+        if DEFAULTS.get('health'):
+            start_health_server(worker, **DEFAULTS['health'])
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, worker.shutdown)
+            # let interrupted HTTP requests of lots in processing continue
+            signal.siginterrupt(signum, False)
+        worker.run()
+    finally:
+        listener.stop()
 
 
 if __name__ == "__main__":
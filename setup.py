@@ -28,7 +28,8 @@ test_require = {
 
 entry_points = {
     'console_scripts': [
-        'concierge_worker = openregistry.concierge.worker:main'
+        'concierge_worker = openregistry.concierge.worker:main',
+        'concierge_redrive = openregistry.concierge.bulk:main'
     ],
     'openregistry.pytests': [
         'concierge = openregistry.concierge.tests.main:suite'